@@ -0,0 +1,94 @@
+"""
+Benchmarks of the peak merging subsystem, run them with `asv run`.
+`time_*` benchmarks record wall time, `peakmem_*` ones record peak memory.
+"""
+
+import numpy as np
+from napari_spot_detection import _image_processing as ip
+from .synthetic import make_spots_cloud
+
+
+NB_POINTS = [1_000, 10_000, 100_000, 1_000_000, 10_000_000]
+MAX_Z = 3
+MAX_XY = 1
+
+
+class Distances:
+    params = NB_POINTS
+    param_names = ['nb_points']
+    timeout = 600
+
+    def setup(self, nb_points):
+        self.coords, _, _ = make_spots_cloud(nb_points)
+        self.pairs = ip.find_close_pairs(self.coords, MAX_Z, MAX_XY)
+        self.source = self.coords[self.pairs[:, 0]]
+        self.target = self.coords[self.pairs[:, 1]]
+        self.dist_z, self.dist_xy = ip.compute_distances(self.source, self.target)
+
+    def time_compute_distances(self, nb_points):
+        ip.compute_distances(self.source, self.target)
+
+    def peakmem_compute_distances(self, nb_points):
+        ip.compute_distances(self.source, self.target)
+
+    def time_compute_pair_distances(self, nb_points):
+        ip.compute_pair_distances(self.coords, self.pairs, max_z=MAX_Z, max_xy=MAX_XY)
+
+    def peakmem_compute_pair_distances(self, nb_points):
+        ip.compute_pair_distances(self.coords, self.pairs, max_z=MAX_Z, max_xy=MAX_XY)
+
+    def time_cut_graph_bidistance(self, nb_points):
+        ip.cut_graph_bidistance(self.dist_z, self.dist_xy, MAX_Z, MAX_XY, pairs=self.pairs)
+
+    def peakmem_cut_graph_bidistance(self, nb_points):
+        ip.cut_graph_bidistance(self.dist_z, self.dist_xy, MAX_Z, MAX_XY, pairs=self.pairs)
+
+
+class MergeClusterNodes:
+    params = (NB_POINTS, ['numpy', 'numba'])
+    param_names = ['nb_points', 'backend']
+    timeout = 600
+
+    def setup(self, nb_points, backend):
+        if backend == 'numba' and not ip.NUMBA_AVAILABLE:
+            raise NotImplementedError("numba is not installed")
+        self.coords, self.weights, _ = make_spots_cloud(nb_points)
+        self.pairs = ip.find_close_pairs(self.coords, MAX_Z, MAX_XY)
+        # compile kernels before timing
+        ip.merge_cluster_nodes(self.coords[:10], self.pairs[:0], backend=backend)
+
+    def time_merge_cluster_nodes(self, nb_points, backend):
+        ip.merge_cluster_nodes(self.coords, self.pairs, self.weights, backend=backend)
+
+    def peakmem_merge_cluster_nodes(self, nb_points, backend):
+        ip.merge_cluster_nodes(self.coords, self.pairs, self.weights, backend=backend)
+
+
+class FilterNearbyPeaks:
+    params = NB_POINTS
+    param_names = ['nb_points']
+    timeout = 600
+
+    def setup(self, nb_points):
+        self.coords, _, _ = make_spots_cloud(nb_points)
+        self.coords = np.round(self.coords).astype(int)
+        # sparse weight image would be too big, use a small one with wrapped coordinates
+        self.weight_img = np.random.default_rng(0).random((64, 128, 128)).astype(np.float32)
+        self.coords_img = self.coords % self.weight_img.shape
+
+    def time_filter_nearby_peaks(self, nb_points):
+        ip.filter_nearby_peaks(self.coords, MAX_Z, MAX_XY)
+
+    def peakmem_filter_nearby_peaks(self, nb_points):
+        ip.filter_nearby_peaks(self.coords, MAX_Z, MAX_XY)
+
+    def time_filter_nearby_peaks_weighted(self, nb_points):
+        ip.filter_nearby_peaks(self.coords_img, MAX_Z, MAX_XY, weight_img=self.weight_img)
+
+    def time_filter_nearby_peaks_tiled(self, nb_points):
+        for _ in ip.filter_nearby_peaks_tiled(self.coords, MAX_Z, MAX_XY, tile_shape=64):
+            pass
+
+    def peakmem_filter_nearby_peaks_tiled(self, nb_points):
+        for _ in ip.filter_nearby_peaks_tiled(self.coords, MAX_Z, MAX_XY, tile_shape=64):
+            pass
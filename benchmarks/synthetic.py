@@ -0,0 +1,58 @@
+"""
+Synthetic point clouds mimicking local maxima detected around spots.
+"""
+
+import numpy as np
+
+
+def make_spots_cloud(nb_points, density=1e-3, points_per_spot=5, spread_z=1.5, 
+                     spread_xy=0.5, background=0.2, anisotropy=4, seed=0):
+    """
+    Make an anisotropic point cloud of peaks clustered around spots.
+
+    Parameters
+    ----------
+    nb_points : int
+        Total number of peaks.
+    density : float
+        Number of peaks per unit volume, defines the size of the volume.
+    points_per_spot : int
+        Mean number of peaks around each spot.
+    spread_z : float
+        Standard deviation of peaks positions around spots along z.
+    spread_xy : float
+        Standard deviation of peaks positions around spots in the xy plane.
+    background : float
+        Fraction of peaks uniformly distributed in the volume.
+    anisotropy : float
+        Ratio of the volume size along x/y and along z.
+    seed : int
+        Seed of the random generator.
+
+    Returns
+    -------
+    coords : ndarray
+        Peaks coordinates, array of shape nb_points x 3.
+    weights : array
+        Weights of peaks, higher close to the spots centers.
+    shape : tuple
+        Shape of the volume containing peaks.
+    """
+
+    rng = np.random.default_rng(seed)
+    size_z = (nb_points / density / anisotropy**2)**(1 / 3)
+    shape = np.array([size_z, size_z * anisotropy, size_z * anisotropy])
+
+    nb_background = int(nb_points * background)
+    nb_clustered = nb_points - nb_background
+    nb_spots = max(nb_clustered // points_per_spot, 1)
+    centers = rng.random((nb_spots, 3)) * shape
+    spot_ids = rng.integers(0, nb_spots, size=nb_clustered)
+    offsets = rng.normal(size=(nb_clustered, 3)) * [spread_z, spread_xy, spread_xy]
+    clustered = centers[spot_ids] + offsets
+    coords = np.vstack([clustered, rng.random((nb_background, 3)) * shape])
+    coords = np.clip(coords, 0, shape - 1)
+
+    dist = np.sqrt(np.sum((offsets / [spread_z, spread_xy, spread_xy])**2, axis=1))
+    weights = np.concatenate([np.exp(-dist**2 / 2), rng.random(nb_background) * 0.1])
+    return coords, weights, tuple(np.ceil(shape).astype(int))
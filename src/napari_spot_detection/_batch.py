@@ -0,0 +1,370 @@
+"""
+Headless batch processing: replay detection parameters saved by the widget
+over many images, without Qt.
+
+Usage example:
+
+    napari-spot-detection-batch params.json "data/*.tif" -o spots/ -n 2
+
+With the GPU engine, the `SPOTS3D` module of opm-merfish-analysis has to be
+importable, for instance by adding its directory to the PYTHONPATH environment
+variable. The CPU engine runs without it.
+"""
+
+import argparse
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+import tifffile
+
+from ._psf import get_psf
+from ._chunking import DEFAULT_MEMORY_BUDGET, GPU_MAX_CHUNK_SIZE, plan_chunks, format_plan
+from ._dog import get_dog_sigmas
+from ._model import (
+    SpotModel,
+    import_spots3d,
+    run_deconvolution,
+    run_dog_filter,
+    run_find_candidates,
+    plan_fit,
+    run_fit_candidates,
+    run_filter_spots,
+)
+from ._spots_io import SPOTS_FORMATS, save_spots
+
+
+def load_detection_parameters(path):
+    """
+    Load detection parameters saved by the widget and rebuild the PSF.
+
+    Parameters
+    ----------
+    path : str | Path
+        JSON file of detection parameters.
+
+    Returns
+    -------
+    detection_parameters : dict
+        Parameters of all pipeline steps.
+    psf : ndarray
+        PSF loaded from `psf_origin`, or generated from physical parameters
+        and cached on disk.
+    """
+
+    with open(path, "r") as read_file:
+        detection_parameters = json.load(read_file)
+
+    if detection_parameters['psf_origin'] == 'generated':
+        metadata = detection_parameters['metadata']
+        microscope_params = detection_parameters['microscope_params']
+        psf = get_psf(
+            na=microscope_params['na'],
+            ri=microscope_params['ri'],
+            wvl=metadata['wvl'],
+            dc=metadata['pixel_size'],
+            dstage=metadata['scan_step'],
+            theta=microscope_params['theta'] / 180 * np.pi,
+        )
+    else:
+        psf = tifffile.imread(detection_parameters['psf_origin'])
+    return detection_parameters, psf
+
+
+def read_image(path):
+    """
+    Read a TIFF image, or lazily a Zarr array.
+    """
+
+    path = str(path)
+    if path.rstrip('/\\').endswith('.zarr'):
+        import dask.array as da
+        return da.from_zarr(path)
+    return tifffile.imread(path)
+
+
+def make_spots_table(spots3d):
+    """
+    Gather fitted spots parameters in a table with the columns used by the widget.
+
+    Parameters
+    ----------
+    spots3d : SPOTS3D | SpotModel
+        Model on which fitting and filtering steps have been run.
+
+    Returns
+    -------
+    df_spots : DataFrame
+        Table of spots parameters.
+    """
+
+    fit_params = spots3d._fit_params
+    centers = fit_params[:, 3:0:-1]
+    # only the first `n_spots_to_fit` candidates are fitted
+    centers_guess = spots3d._spot_candidates[:len(fit_params), :3]
+    df_spots = pd.DataFrame({
+        'amplitudes': fit_params[:, 0],
+        'z': centers[:, 0],
+        'y': centers[:, 1],
+        'x': centers[:, 2],
+        'sigmas_xy': fit_params[:, 4],
+        'sigmas_z': fit_params[:, 5],
+        'offsets': fit_params[:, 6],
+        'chi_squareds': spots3d._chi_sqrs,
+        'dist_fit_xy': np.sqrt((centers_guess[:, 1] - centers[:, 1])**2 +
+                               (centers_guess[:, 2] - centers[:, 2])**2),
+        'dist_fit_z': np.abs(centers_guess[:, 0] - centers[:, 0]),
+        'spot_select': spots3d._to_keep,
+    })
+    return df_spots
+
+
+def set_chunk_size(spots3d, stage, img, memory_budget, engine='GPU', n_threads=None, **kwargs):
+    """
+    Set the chunk size of the model to the largest one fitting the memory budget,
+    and the GPU limits with the GPU engine. The plan is returned for the number
+    of threads of CPU steps.
+    """
+
+    if engine == 'CPU':
+        n_workers = os.cpu_count() if n_threads is None else n_threads
+        max_chunk_size = None
+    else:
+        n_workers, max_chunk_size = 1, GPU_MAX_CHUNK_SIZE[stage]
+    plan = plan_chunks(stage, img.shape, img.dtype, memory_budget=memory_budget, 
+                       n_workers=n_workers, max_chunk_size=max_chunk_size, **kwargs)
+    print(format_plan(plan))
+    spots3d.scan_chunk_size = plan['chunk_size']
+    return plan
+
+
+def run_pipeline(img, psf, detection_parameters, memory_budget=DEFAULT_MEMORY_BUDGET,
+                 engine=None, n_threads=None):
+    """
+    Run all the detection steps on an image, as the widget does.
+
+    Parameters
+    ----------
+    img : ndarray
+        Image to analyze.
+    psf : ndarray
+        PSF of the microscope.
+    detection_parameters : dict
+        Parameters saved by the widget.
+    memory_budget : int
+        Memory in bytes used to choose the size of chunks of each step.
+    engine : str, optional
+        'GPU' to run the `SPOTS3D` model, or 'CPU' to run all steps on CPU.
+        The engine saved in parameters is used by default, or the GPU.
+    n_threads : int, optional
+        Number of threads of CPU steps, all CPUs by default.
+
+    Returns
+    -------
+    df_spots : DataFrame
+        Table of fitted spots with the filtering result.
+    """
+
+    if engine is None:
+        engine = detection_parameters.get('engine', 'GPU')
+    if engine == 'CPU':
+        model_class = SpotModel
+    else:
+        model_class = import_spots3d()
+        if model_class is None:
+            raise ImportError("SPOTS3D is needed by the GPU engine, add its directory to "
+                              "PYTHONPATH or use the CPU engine")
+    spots3d = model_class(
+        data=img,
+        psf=psf,
+        metadata=detection_parameters['metadata'],
+        microscope_params=detection_parameters['microscope_params'],
+        )
+    if detection_parameters['dog_filter_source_data'] == 'decon':
+        spots3d.decon_params = detection_parameters['decon_params']
+        plan = set_chunk_size(spots3d, 'deconvolution', img, memory_budget, engine=engine, 
+                              n_threads=n_threads, psf_shape=psf.shape, 
+                              tv_tau=spots3d.decon_params['tv_tau'])
+        if engine == 'CPU':
+            run_deconvolution(spots3d, n_workers=plan['n_workers'])
+        else:
+            spots3d.run_deconvolution()
+    spots3d.dog_filter_source_data = detection_parameters['dog_filter_source_data']
+    spots3d.DoG_filter_params = detection_parameters['DoG_filter_params']
+    metadata = detection_parameters['metadata']
+    _, sigmas_large = get_dog_sigmas(
+        spots3d.DoG_filter_params,
+        sigma_z=spots3d._sigma_z,
+        sigma_xy=spots3d._sigma_xy,
+        spacing=[metadata['scan_step'], metadata['pixel_size'], metadata['pixel_size']],
+        )
+    plan = set_chunk_size(spots3d, 'DoG filter', img, memory_budget, engine=engine, 
+                          n_threads=n_threads, sigmas=sigmas_large)
+    if engine == 'CPU':
+        run_dog_filter(spots3d, n_workers=plan['n_workers'])
+    else:
+        spots3d.run_DoG_filter()
+    # saved parameters use factor keys, the model is given the same keys as in the widget
+    find_candidates_params = detection_parameters['find_candidates_params']
+    spots3d.find_candidates_params = {
+        'threshold' : find_candidates_params['threshold'],
+        'min_spot_xy' : find_candidates_params.get('min_spot_xy_factor',
+                                                   find_candidates_params.get('min_spot_xy')),
+        'min_spot_z' : find_candidates_params.get('min_spot_z_factor',
+                                                  find_candidates_params.get('min_spot_z')),
+        }
+    spots3d.fit_candidate_spots_params = detection_parameters['fit_candidate_spots_params']
+    spots3d.spot_filter_params = detection_parameters['spot_filter_params']
+    if engine == 'CPU':
+        run_find_candidates(spots3d)
+        plan = plan_fit(spots3d, memory_budget=memory_budget, 
+                        n_workers=os.cpu_count() if n_threads is None else n_threads)
+        print(format_plan(plan))
+        run_fit_candidates(spots3d, batch_size=plan['chunk_size'], n_workers=plan['n_workers'])
+        run_filter_spots(spots3d)
+    else:
+        set_chunk_size(spots3d, 'find candidates', spots3d._dog_data, memory_budget)
+        spots3d.run_find_candidates()
+        spots3d.run_fit_candidates()
+        spots3d.run_filter_spots()
+    return make_spots_table(spots3d)
+
+
+def get_output_path(path_img, dir_save, spots_format='csv'):
+    name = Path(str(path_img).rstrip('/\\')).name
+    for ext in ['.ome.tiff', '.ome.tif', '.tiff', '.tif', '.zarr']:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    return Path(dir_save) / (name + '_spots' + SPOTS_FORMATS[spots_format])
+
+
+def process_file(path_img, path_save, detection_parameters, psf, memory_budget=DEFAULT_MEMORY_BUDGET,
+                 engine=None, n_threads=None):
+    """
+    Detect spots in a file and save the table of spots. The table is written
+    under a temporary name and renamed at the end, so an existing table
+    always comes from a complete run.
+    """
+
+    img = read_image(path_img)
+    df_spots = run_pipeline(img, psf, detection_parameters, memory_budget=memory_budget,
+                            engine=engine, n_threads=n_threads)
+    # keep the extension so the format of the temporary table is known
+    path_tmp = path_save.with_name('tmp_' + path_save.name)
+    save_spots(path_tmp, df_spots)
+    if path_save.is_dir():
+        # Zarr tables are directories that can't be replaced
+        shutil.rmtree(path_save)
+    os.replace(path_tmp, path_save)
+    return path_save
+
+
+def run_batch(path_params, inputs, dir_save, n_workers=1, overwrite=False, spots_format='csv',
+              memory_budget=DEFAULT_MEMORY_BUDGET, engine=None):
+    """
+    Detect spots in many files with a pool of processes.
+
+    Parameters
+    ----------
+    path_params : str | Path
+        JSON file of detection parameters saved by the widget.
+    inputs : list
+        Paths or glob patterns of TIFF / Zarr images.
+    dir_save : str | Path
+        Directory where tables of spots are saved.
+    n_workers : int
+        Number of files processed in parallel. With the GPU engine each one
+        runs a GPU pipeline, with the CPU engine they share the CPUs.
+    overwrite : bool
+        If False, files whose table of spots already exists are skipped,
+        so an interrupted batch can be resumed.
+    spots_format : str
+        Format of tables of spots, 'csv', 'parquet', 'feather' or 'zarr'.
+    memory_budget : int
+        Memory in bytes used to choose the size of chunks, for each worker.
+    engine : str, optional
+        'GPU' or 'CPU', the engine saved in parameters by default.
+
+    Returns
+    -------
+    failed : list
+        Paths of files that could not be processed.
+    """
+
+    paths = []
+    for pattern in inputs:
+        matches = sorted(glob.glob(pattern))
+        paths.extend(matches if len(matches) > 0 else [pattern])
+    dir_save = Path(dir_save)
+    dir_save.mkdir(parents=True, exist_ok=True)
+
+    jobs = {}
+    for path_img in paths:
+        path_save = get_output_path(path_img, dir_save, spots_format)
+        if path_save.exists() and not overwrite:
+            print("skipping", path_img, "already processed")
+        else:
+            jobs[path_img] = path_save
+    print(f"processing {len(jobs)} files out of {len(paths)}")
+    if len(jobs) == 0:
+        return []
+    # parameters are read and the PSF is made once for all files
+    detection_parameters, psf = load_detection_parameters(path_params)
+    if engine is None:
+        engine = detection_parameters.get('engine', 'GPU')
+    # CPU steps of all workers share the cores
+    n_threads = max(os.cpu_count() // n_workers, 1) if engine == 'CPU' else None
+    print(f"running the {engine} engine")
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(process_file, path_img, path_save, detection_parameters, 
+                                   psf, memory_budget, engine, n_threads): path_img
+                   for path_img, path_save in jobs.items()}
+        for future in as_completed(futures):
+            path_img = futures[future]
+            try:
+                print("saved", future.result())
+            except Exception as error:
+                print("failed", path_img, error)
+                failed.append(path_img)
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Detect spots in many images with parameters saved by the napari widget.")
+    parser.add_argument('params', help="JSON file of detection parameters")
+    parser.add_argument('inputs', nargs='+', help="TIFF / Zarr images, or glob patterns")
+    parser.add_argument('-o', '--output-dir', default='.', help="directory of spots tables")
+    parser.add_argument('-n', '--n-workers', type=int, default=1,
+                        help="number of files processed in parallel, each one running "
+                             "a GPU pipeline with the GPU engine")
+    parser.add_argument('-e', '--engine', choices=['GPU', 'CPU'],
+                        help="engine of all steps, the one saved in parameters by default. "
+                             "The CPU engine shares the CPUs between workers and doesn't "
+                             "need SPOTS3D")
+    parser.add_argument('--overwrite', action='store_true',
+                        help="process again files whose spots table exists")
+    parser.add_argument('-f', '--format', default='csv', choices=list(SPOTS_FORMATS.keys()),
+                        help="format of spots tables")
+    parser.add_argument('-m', '--memory', type=float, default=DEFAULT_MEMORY_BUDGET / 2**30,
+                        help="memory in GB used to choose the size of chunks, per worker")
+    args = parser.parse_args(argv)
+
+    failed = run_batch(args.params, args.inputs, args.output_dir,
+                       n_workers=args.n_workers, overwrite=args.overwrite,
+                       spots_format=args.format, memory_budget=int(args.memory * 2**30),
+                       engine=args.engine)
+    return 1 if len(failed) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
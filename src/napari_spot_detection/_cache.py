@@ -0,0 +1,197 @@
+"""
+Content-addressed cache of pipeline stages outputs, with an in-memory LRU tier
+and an optional on-disk Zarr tier.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+import threading
+
+import numpy as np
+
+
+def _iter_blocks(arr, block_bytes):
+    # slices along the first axis of about `block_bytes`
+    if arr.ndim == 0 or arr.shape[0] == 0:
+        yield arr
+        return
+    row_bytes = max(arr.nbytes // arr.shape[0], 1)
+    nb_rows = max(block_bytes // row_bytes, 1)
+    for start in range(0, arr.shape[0], nb_rows):
+        yield arr[start:start + nb_rows]
+
+
+def fingerprint_array(arr, block_bytes=2**26):
+    """
+    Make a fingerprint of an array from its shape, dtype and values.
+
+    All values are hashed, block by block along the first axis, so that
+    memory-mapped or dask arrays are never fully loaded in memory.
+
+    Parameters
+    ----------
+    arr : ndarray
+        Array to fingerprint.
+    block_bytes : int
+        Approximate size of blocks loaded at once.
+
+    Returns
+    -------
+    fingerprint : str
+        Hexadecimal digest.
+    """
+
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(str((arr.shape, str(arr.dtype))).encode())
+    for block in _iter_blocks(arr, block_bytes):
+        hasher.update(np.ascontiguousarray(np.asarray(block)).data)
+    return hasher.hexdigest()
+
+
+def make_key(stage, *parts):
+    """
+    Make a cache key from a stage name and its inputs: fingerprints,
+    upstream keys or dictionaries of parameters.
+
+    Example
+    -------
+    >>> make_key('dog', 'a1b2', {'sigma': 1})
+    'dog-...'
+    """
+
+    hasher = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        hasher.update(json.dumps(part, sort_keys=True, default=str).encode())
+    return f"{stage}-{hasher.hexdigest()}"
+
+
+def _nbytes(value):
+    return sum(arr.nbytes for arr in value.values())
+
+
+class StageCache:
+    """
+    Cache of stages outputs, values are dictionaries of arrays.
+
+    Recently used values are kept in memory up to `max_bytes`. If `dir_cache`
+    is given, values are also written in Zarr stores in this directory, and the
+    least recently used stores are deleted above `max_disk_bytes`.
+    """
+
+    def __init__(self, max_bytes=2**32, dir_cache=None, max_disk_bytes=2**36):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.dir_cache = None if dir_cache is None else Path(dir_cache)
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        # values are put by background workers and read by the GUI
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached value of a key, or None if it is not cached.
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        value = self._read_disk(key)
+        if value is not None:
+            self._put_memory(key, value)
+        return value
+
+    def put(self, key, value):
+        """
+        Cache a dictionary of arrays.
+
+        Values bigger than the memory budget, like dask arrays of a whole
+        dataset, are not loaded in memory and only written to the disk tier.
+        """
+        if _nbytes(value) <= self.max_bytes:
+            value = {name: np.asarray(arr) for name, arr in value.items()}
+        # values above the budget only remove a previous value of the key
+        self._put_memory(key, value)
+        self._write_disk(key, value)
+
+    def clear(self):
+        """
+        Remove all values from the memory and disk tiers.
+        """
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        for path in self._disk_entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _put_memory(self, key, value):
+        nbytes = _nbytes(value)
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= _nbytes(self._memory.pop(key))
+            if nbytes > self.max_bytes:
+                return
+            self._memory[key] = value
+            self._memory_bytes += nbytes
+            # evict least recently used values
+            while self._memory_bytes > self.max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= _nbytes(evicted)
+
+    def _disk_entries(self):
+        if self.dir_cache is None or not self.dir_cache.exists():
+            return []
+        return [path for path in self.dir_cache.iterdir() if path.suffix == '.zarr']
+
+    def _read_disk(self, key):
+        if self.dir_cache is None:
+            return None
+        path = self.dir_cache / (key + '.zarr')
+        if not path.exists():
+            return None
+        import zarr
+        group = zarr.open_group(str(path), mode='r')
+        value = {name: arr[...] for name, arr in group.arrays()}
+        # mark as recently used for eviction
+        os.utime(path)
+        return value
+
+    def _write_disk(self, key, value):
+        if self.dir_cache is None:
+            return
+        import zarr
+        self.dir_cache.mkdir(parents=True, exist_ok=True)
+        path = self.dir_cache / (key + '.zarr')
+        if path.exists():
+            os.utime(path)
+            return
+        path_tmp = self.dir_cache / (key + '.tmp')
+        group = zarr.open_group(str(path_tmp), mode='w')
+        for name, arr in value.items():
+            stored = group.zeros(name=name, shape=arr.shape, dtype=arr.dtype)
+            # written by blocks so that dask arrays are not loaded at once
+            start = 0
+            for block in _iter_blocks(arr, 2**26):
+                if arr.ndim == 0:
+                    stored[...] = np.asarray(block)
+                else:
+                    stored[start:start + len(block)] = np.asarray(block)
+                    start += len(block)
+        os.replace(path_tmp, path)
+        self._evict_disk()
+
+    def _evict_disk(self):
+        entries = []
+        for path in self._disk_entries():
+            size = sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+            entries.append((path.stat().st_mtime, size, path))
+        total = sum(size for _, size, _ in entries)
+        # delete least recently used stores first
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_disk_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
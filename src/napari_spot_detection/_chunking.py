@@ -0,0 +1,261 @@
+"""
+Choice of the number of planes processed at once by pipeline stages, from
+their memory footprint and a memory budget, and parallel processing of chunks
+with progress reports.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import os
+
+import numpy as np
+
+
+DEFAULT_MEMORY_BUDGET = 2**32
+
+# number of float32 arrays of the size of a chunk allocated by each stage:
+# inputs, outputs, FFTs, OTFs and temporary arrays of filters
+STAGE_BUFFERS = {
+    'deconvolution': 12,
+    'DoG filter': 4,
+    'find candidates': 4,
+}
+# gradients and curvature of the total variation regularization
+TV_BUFFERS = 9
+# largest chunks the GPU engine processes without running out of GPU memory
+# or hitting the kernel timeout, the memory budget only bounds RAM
+GPU_MAX_CHUNK_SIZE = {
+    'deconvolution': 128,
+    'DoG filter': 64,
+    'find candidates': 64,
+}
+# bytes per ROI voxel of a fitted spot: pixels, mask, coordinates, indices,
+# model, jacobian and residuals
+FIT_VOXEL_BYTES = 96
+# spots per batch of fits, batches are smaller only if the budget requires it,
+# and threads are removed before batches get smaller than the minimum
+FIT_BATCH_SIZE = 2000
+FIT_MIN_BATCH_SIZE = 100
+
+
+def get_stage_footprint(stage, shape, dtype, psf_shape=None, sigmas=None, tv_tau=0, truncate=4.0):
+    """
+    Estimate the memory used per plane of a chunk by a stage, and the planes
+    added around chunks.
+
+    Parameters
+    ----------
+    stage : str
+        'deconvolution', 'DoG filter' or 'find candidates'.
+    shape : tuple
+        Shape (z, y, x) of the image processed by the stage.
+    dtype : dtype
+        Data type of the image.
+    psf_shape : tuple, optional
+        Shape of the PSF, needed for the deconvolution.
+    sigmas : array, optional
+        Sigmas in pixels of the large gaussian of the DoG filter, needed for the DoG filter.
+    tv_tau : float
+        Weight of the total variation regularization of the deconvolution.
+    truncate : float
+        Gaussian kernels of the DoG filter are truncated at this many sigmas.
+
+    Returns
+    -------
+    plane_bytes : int
+        Bytes per plane of a chunk.
+    extra_planes : int
+        Planes added to each chunk by halos and padding.
+    """
+
+    nb_buffers = STAGE_BUFFERS[stage]
+    plane_area = shape[1] * shape[2]
+    extra_planes = 0
+    if stage == 'deconvolution':
+        if psf_shape is None:
+            raise ValueError("The PSF shape is needed to plan chunks of the deconvolution")
+        # halo of one PSF size, and chunks padded by half the PSF along all axes
+        pads = [size // 2 for size in psf_shape]
+        plane_area = (shape[1] + 2 * pads[1]) * (shape[2] + 2 * pads[2])
+        extra_planes = 2 * psf_shape[0] + 2 * pads[0]
+        if tv_tau > 0:
+            nb_buffers += TV_BUFFERS
+    elif stage == 'DoG filter':
+        if sigmas is None:
+            raise ValueError("The DoG sigmas are needed to plan chunks of the DoG filter")
+        extra_planes = 2 * int(truncate * sigmas[0] + 0.5)
+    plane_bytes = plane_area * (np.dtype(dtype).itemsize + 4 * nb_buffers)
+    return plane_bytes, extra_planes
+
+
+def plan_chunks(stage, shape, dtype, memory_budget=DEFAULT_MEMORY_BUDGET, n_workers=1,
+                psf_shape=None, sigmas=None, tv_tau=0, max_chunk_size=None):
+    """
+    Pick the largest number of planes per chunk whose footprint fits the memory budget.
+
+    Chunks are kept at least as large as their halo, so that most of the work
+    isn't spent on halos, and the number of workers is reduced instead when
+    the budget can't hold that many chunks at once.
+
+    Parameters
+    ----------
+    stage : str
+        'deconvolution', 'DoG filter' or 'find candidates'.
+    shape : tuple
+        Shape (z, y, x) of the image processed by the stage.
+    dtype : dtype
+        Data type of the image.
+    memory_budget : int
+        Memory available to the stage, in bytes.
+    n_workers : int
+        Maximum number of chunks processed at the same time, sharing the budget.
+    psf_shape, sigmas, tv_tau
+        Parameters of stages, see `get_stage_footprint`.
+    max_chunk_size : int, optional
+        Upper bound of the chunk size, like `GPU_MAX_CHUNK_SIZE` for the GPU engine.
+
+    Returns
+    -------
+    plan : dict
+        Chunk size, number of chunks, number of workers and estimated memory of the stage.
+    """
+
+    plane_bytes, extra_planes = get_stage_footprint(
+        stage, shape, dtype, psf_shape=psf_shape, sigmas=sigmas, tv_tau=tv_tau)
+    max_size = shape[0] if max_chunk_size is None else max(min(max_chunk_size, shape[0]), 1)
+    # halos are on both sides of chunks
+    min_size = min(max(extra_planes // 2, 1), max_size)
+    min_bytes = (min_size + extra_planes) * plane_bytes
+    n_workers = min(max(n_workers, 1), max(memory_budget // min_bytes, 1))
+    worker_budget = memory_budget // n_workers
+    chunk_size = int(worker_budget // plane_bytes) - extra_planes
+    chunk_size = min(max(chunk_size, min_size), max_size)
+    nb_chunks = -(-shape[0] // chunk_size)
+    n_workers = min(n_workers, nb_chunks)
+    # chunks can't be longer than the image, halos included
+    chunk_planes = min(chunk_size + extra_planes, shape[0] + extra_planes)
+    plan = {
+        'stage': stage,
+        'chunk_size': chunk_size,
+        'nb_chunks': nb_chunks,
+        'n_workers': n_workers,
+        'chunk_bytes': chunk_planes * plane_bytes,
+        'peak_bytes': n_workers * chunk_planes * plane_bytes,
+        'memory_budget': memory_budget,
+    }
+    return plan
+
+
+def plan_fit_batches(nb_spots, roi_shape, memory_budget=DEFAULT_MEMORY_BUDGET, n_workers=1,
+                     batch_size=FIT_BATCH_SIZE):
+    """
+    Pick the number of spots fitted at once and the number of threads of the
+    gaussian fits from the memory budget.
+
+    Parameters
+    ----------
+    nb_spots : int
+        Number of candidate spots.
+    roi_shape : tuple
+        Shape of ROIs around spots.
+    memory_budget : int
+        Memory available to the fits, in bytes.
+    n_workers : int
+        Maximum number of batches fitted at the same time, sharing the budget.
+    batch_size : int
+        Maximum number of spots per batch.
+
+    Returns
+    -------
+    plan : dict
+        Batch size, number of batches, number of workers and estimated memory of the fits.
+    """
+
+    spot_bytes = int(np.prod(roi_shape)) * FIT_VOXEL_BYTES
+    max_size = max(min(batch_size, nb_spots), 1)
+    min_size = min(FIT_MIN_BATCH_SIZE, max_size)
+    n_workers = min(max(n_workers, 1), max(memory_budget // (min_size * spot_bytes), 1))
+    batch_size = min(max(int(memory_budget // n_workers // spot_bytes), min_size), max_size)
+    nb_batches = -(-nb_spots // batch_size)
+    n_workers = min(n_workers, max(nb_batches, 1))
+    plan = {
+        'stage': 'fit spots',
+        'chunk_size': batch_size,
+        'nb_chunks': nb_batches,
+        'n_workers': n_workers,
+        'chunk_bytes': batch_size * spot_bytes,
+        'peak_bytes': n_workers * batch_size * spot_bytes,
+        'memory_budget': memory_budget,
+    }
+    return plan
+
+
+def format_plan(plan):
+    """
+    Describe a chunk plan in one line, to log it.
+    """
+
+    text = (f"{plan['stage']}: {plan['nb_chunks']} chunks of {plan['chunk_size']}, "
+            f"{plan['n_workers']} workers, ~{plan['peak_bytes'] / 2**30:.2f} GB "
+            f"for a budget of {plan['memory_budget'] / 2**30:.2f} GB")
+    if plan['peak_bytes'] > plan['memory_budget']:
+        text += " (exceeds the budget with 1 worker and chunks as large as their halo)"
+    return text
+
+
+def map_chunks(function, starts, n_workers=None):
+    """
+    Apply a function on chunks in a pool of threads, yielding progress as chunks are done.
+
+    At most `n_workers` chunks are submitted at once, so when the generator
+    isn't iterated anymore, like when a stage is cancelled, no new chunk is started.
+
+    Parameters
+    ----------
+    function : callable
+        Function processing the chunk starting at a given index.
+    starts : iterable
+        First indices of chunks.
+    n_workers : int, optional
+        Number of threads, all CPUs by default.
+
+    Yields
+    ------
+    nb_done, nb_chunks : int
+        Number of processed chunks and total number of chunks.
+    """
+
+    starts = list(starts)
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    executor = ThreadPoolExecutor(max_workers=n_workers)
+    pending = set()
+    nb_submitted = 0
+    nb_done = 0
+    try:
+        while nb_done < len(starts):
+            while nb_submitted < len(starts) and len(pending) < n_workers:
+                pending.add(executor.submit(function, starts[nb_submitted]))
+                nb_submitted += 1
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                # raise errors of chunks
+                future.result()
+            nb_done += len(done)
+            yield nb_done, len(starts)
+    finally:
+        for future in pending:
+            future.cancel()
+        # chunks being processed when the generator is closed finish in the background
+        executor.shutdown(wait=False)
+
+
+def exhaust(steps):
+    """
+    Run a generator of progress reports to its end, and return its returned value.
+    """
+
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
@@ -0,0 +1,163 @@
+"""
+CPU engine of the Richardson-Lucy deconvolution with total variation
+regularization, for nodes without GPU.
+"""
+
+import numpy as np
+from scipy import fft
+
+from ._chunking import map_chunks, exhaust
+
+
+def make_otf(psf, shape):
+    """
+    Compute the optical transfer function of a PSF for real FFTs of a given shape.
+
+    Parameters
+    ----------
+    psf : ndarray
+        Point spread function, normalized to a sum of 1.
+    shape : tuple
+        Shape of arrays the PSF is convolved with.
+
+    Returns
+    -------
+    otf : ndarray
+        Complex64 array of shape `rfftn` of `shape`.
+    """
+
+    psf = np.asarray(psf, dtype=np.float32)
+    psf = psf / psf.sum()
+    padded = np.zeros(shape, dtype=np.float32)
+    padded[tuple(slice(0, size) for size in psf.shape)] = psf
+    # center the PSF on the origin
+    padded = np.roll(padded, [-(size // 2) for size in psf.shape], axis=tuple(range(psf.ndim)))
+    return fft.rfftn(padded).astype(np.complex64)
+
+
+def _convolve(img, otf):
+    return fft.irfftn(fft.rfftn(img) * otf, s=img.shape).astype(np.float32)
+
+
+def _tv_divergence(img, eps=1e-4):
+    # divergence of the normalized gradient, curvature term of the total variation
+    grads = np.gradient(img)
+    norm = np.sqrt(sum(grad**2 for grad in grads) + eps).astype(np.float32)
+    return sum(np.gradient(grad / norm, axis=axis) for axis, grad in enumerate(grads))
+
+
+def richardson_lucy_tv(img, otf, iterations=30, tv_tau=0):
+    """
+    Deconvolve an image with the Richardson-Lucy algorithm, with total variation
+    regularization if `tv_tau` > 0.
+
+    Parameters
+    ----------
+    img : ndarray
+        Image with the same shape as the one given to `make_otf`.
+    otf : ndarray
+        Optical transfer function from `make_otf`.
+    iterations : int
+        Number of iterations.
+    tv_tau : float
+        Weight of the total variation regularization.
+
+    Returns
+    -------
+    estimate : ndarray
+        Deconvolved image in float32.
+    """
+
+    eps = np.float32(1e-6)
+    img = np.maximum(np.asarray(img, dtype=np.float32), 0)
+    otf_conj = np.conj(otf)
+    estimate = np.full(img.shape, img.mean(), dtype=np.float32)
+    for _ in range(iterations):
+        ratio = img / np.maximum(_convolve(estimate, otf), eps)
+        correction = _convolve(ratio, otf_conj)
+        if tv_tau > 0:
+            correction /= np.maximum(1 - np.float32(tv_tau) * _tv_divergence(estimate), eps)
+        estimate *= correction
+    return estimate
+
+
+def deconvolve(img, psf, iterations=30, tv_tau=0, chunk_size=128, halo=None,
+               n_workers=None, out=None):
+    """
+    Deconvolve an image by overlapping chunks along its first axis.
+
+    Chunks are extended by a halo of real data, padded by reflection to a common
+    shape so the OTF is computed once, deconvolved in parallel, and the halo is
+    trimmed before writing the result.
+
+    Parameters
+    ----------
+    img : ndarray
+        3D image, only chunks are loaded so it can be a memory-mapped or a dask array.
+    psf : ndarray
+        Point spread function.
+    iterations : int
+        Number of Richardson-Lucy iterations.
+    tv_tau : float
+        Weight of the total variation regularization.
+    chunk_size : int
+        Number of planes along the first axis per chunk.
+    halo : int, optional
+        Number of planes added on both sides of chunks, the PSF size by default.
+    n_workers : int, optional
+        Number of threads, all CPUs by default.
+    out : ndarray, optional
+        Float32 array where the result is written, it can be memory-mapped.
+
+    Returns
+    -------
+    decon : ndarray
+        Deconvolved image in float32.
+    """
+
+    return exhaust(deconvolve_chunks(img, psf, iterations=iterations, tv_tau=tv_tau,
+                                     chunk_size=chunk_size, halo=halo, n_workers=n_workers, out=out))
+
+
+def deconvolve_chunks(img, psf, iterations=30, tv_tau=0, chunk_size=128, halo=None,
+                      n_workers=None, out=None):
+    """
+    Deconvolve an image like `deconvolve`, yielding progress after each chunk
+    so that the computation can be followed and stopped between chunks.
+
+    Parameters are those of `deconvolve`.
+
+    Yields
+    ------
+    nb_done, nb_chunks : int
+        Number of deconvolved chunks and total number of chunks.
+
+    Returns
+    -------
+    decon : ndarray
+        Deconvolved image in float32.
+    """
+
+    nb_planes = img.shape[0]
+    if halo is None:
+        halo = psf.shape[0]
+    if out is None:
+        out = np.empty(img.shape, dtype=np.float32)
+    # borders padded by half the PSF to limit wrap-around of circular convolutions
+    pads = [size // 2 for size in psf.shape]
+    chunk_planes = min(chunk_size + 2 * halo, nb_planes)
+    shape = (chunk_planes + 2 * pads[0], *[size + 2 * pad for size, pad in zip(img.shape[1:], pads[1:])])
+    otf = make_otf(psf, shape)
+
+    def deconvolve_chunk(start):
+        stop = min(start + chunk_size, nb_planes)
+        lower = max(min(start - halo, nb_planes - chunk_planes), 0)
+        upper = lower + chunk_planes
+        chunk = np.asarray(img[lower:upper], dtype=np.float32)
+        chunk = np.pad(chunk, [(pad, pad) for pad in pads], mode='reflect')
+        decon = richardson_lucy_tv(chunk, otf, iterations=iterations, tv_tau=tv_tau)
+        decon = decon[tuple(slice(pad, size - pad) for pad, size in zip(pads, decon.shape))]
+        out[start:stop] = decon[start - lower:stop - lower]
+
+    yield from map_chunks(deconvolve_chunk, range(0, nb_planes, chunk_size), n_workers)
+    return out
@@ -0,0 +1,118 @@
+"""
+2D histograms of pairs of fitted parameters, used to display their joint
+distributions for millions of spots.
+"""
+
+import itertools
+import numpy as np
+
+
+class PairHistograms:
+    """
+    2D histograms of all pairs of variables.
+
+    Each variable is binned once, the histogram of a pair of variables is
+    then a single `np.bincount` of combined bin indices. When the range of
+    a variable changes, only this variable is binned again and only the
+    histograms of pairs including it are updated.
+
+    Parameters
+    ----------
+    variables : dict
+        1D arrays of values of each variable, all of the same length.
+    ranges : dict
+        Range (min, max) of values of each variable, values outside
+        their range are not counted.
+    bins : int
+        Number of bins along each variable.
+
+    Example
+    -------
+    >>> hists = PairHistograms({'a': np.array([0, 1, 1]), 'b': np.array([0, 0, 1])},
+    ...                        {'a': (0, 1), 'b': (0, 1)}, bins=2)
+    >>> hists.histograms[('a', 'b')]
+    array([[1, 0],
+           [1, 1]])
+    """
+
+    def __init__(self, variables, ranges, bins=64):
+        self.variables = variables
+        self.bins = bins
+        self.pairs = list(itertools.combinations(variables.keys(), 2))
+        self.ranges = {}
+        self._bin_idx = {}
+        self.histograms = {}
+        for name, value_range in ranges.items():
+            self._digitize(name, value_range)
+        for pair in self.pairs:
+            self._compute(pair)
+
+    def _digitize(self, name, value_range):
+        mini, maxi = float(value_range[0]), float(value_range[1])
+        data = np.asarray(self.variables[name])
+        width = maxi - mini if maxi > mini else 1
+        with np.errstate(invalid='ignore'):
+            idx = np.floor((data - mini) / width * self.bins)
+            # include the upper edge in the last bin
+            idx[data == maxi] = self.bins - 1
+            idx[~((data >= mini) & (data <= maxi))] = -1
+        self._bin_idx[name] = idx.astype(np.int32)
+        self.ranges[name] = (mini, maxi)
+
+    def _compute(self, pair):
+        idx_x = self._bin_idx[pair[0]]
+        idx_y = self._bin_idx[pair[1]]
+        valid = (idx_x >= 0) & (idx_y >= 0)
+        counts = np.bincount(idx_x[valid] * self.bins + idx_y[valid], minlength=self.bins**2)
+        self.histograms[pair] = counts.reshape(self.bins, self.bins)
+
+    def set_ranges(self, ranges):
+        """
+        Update ranges of variables and the histograms they affect.
+
+        Parameters
+        ----------
+        ranges : dict
+            New ranges of some variables.
+
+        Returns
+        -------
+        updated : list
+            Pairs of variables whose histogram changed.
+        """
+
+        changed = [name for name, value_range in ranges.items()
+                   if (float(value_range[0]), float(value_range[1])) != self.ranges[name]]
+        for name in changed:
+            self._digitize(name, ranges[name])
+        updated = [pair for pair in self.pairs if pair[0] in changed or pair[1] in changed]
+        for pair in updated:
+            self._compute(pair)
+        return updated
+
+    def sample(self, nb_points, select=None, seed=0):
+        """
+        Draw random indices of values, to overlay a few points on histograms.
+
+        Parameters
+        ----------
+        nb_points : int
+            Maximum number of indices.
+        select : array, optional
+            Boolean selection of values in which indices are drawn.
+        seed : int
+            Seed of the random generator, so that overlays stay stable.
+
+        Returns
+        -------
+        indices : array
+            Sorted indices of values.
+        """
+
+        candidates = np.arange(len(next(iter(self.variables.values()))))
+        if select is not None:
+            candidates = candidates[select]
+        if len(candidates) <= nb_points:
+            return candidates
+        rng = np.random.default_rng(seed)
+        return np.sort(rng.choice(candidates, size=nb_points, replace=False))
@@ -0,0 +1,117 @@
+"""
+CPU engine of the Difference of Gaussians filter, for nodes without GPU.
+"""
+
+import numpy as np
+from scipy import ndimage as ndi
+
+from ._chunking import map_chunks, exhaust
+
+
+def get_dog_sigmas(DoG_filter_params, sigma_z, sigma_xy, spacing):
+    """
+    Convert sigma factors of the DoG filter into sigmas in pixels.
+
+    Parameters
+    ----------
+    DoG_filter_params : dict
+        Factors 'sigma_small_{x,y,z}_factor' and 'sigma_large_{x,y,z}_factor',
+        relative to the expected spot size.
+    sigma_z : float
+        Expected spot sigma along z.
+    sigma_xy : float
+        Expected spot sigma along x and y.
+    spacing : array
+        Pixel spacing along z, y and x, in the same unit as sigmas.
+
+    Returns
+    -------
+    sigmas_small, sigmas_large : array
+        Sigmas of both gaussian filters along z, y and x, in pixels.
+    """
+
+    spot_sigmas = np.array([sigma_z, sigma_xy, sigma_xy])
+    sigmas_small = np.array([DoG_filter_params[f'sigma_small_{axis}_factor'] for axis in 'zyx'])
+    sigmas_large = np.array([DoG_filter_params[f'sigma_large_{axis}_factor'] for axis in 'zyx'])
+    spacing = np.asarray(spacing, dtype=float)
+    return sigmas_small * spot_sigmas / spacing, sigmas_large * spot_sigmas / spacing
+
+
+def _dog_chunk(img, sigmas_small, sigmas_large, truncate):
+    img = np.asarray(img, dtype=np.float32)
+    # gaussian_filter is separable, it filters one axis after the other
+    dog = ndi.gaussian_filter(img, sigmas_small, output=np.float32, truncate=truncate)
+    dog -= ndi.gaussian_filter(img, sigmas_large, output=np.float32, truncate=truncate)
+    return dog
+
+
+def dog_filter(img, sigmas_small, sigmas_large, chunk_size=64, n_workers=None,
+               truncate=4.0, out=None):
+    """
+    Apply a Difference of Gaussians filter by chunks along the first axis.
+
+    Chunks are extended by a halo given by the largest sigma along the first axis,
+    so the result is identical to filtering the whole image. Chunks are filtered
+    in a pool of threads, SciPy releasing the GIL during filtering.
+
+    Parameters
+    ----------
+    img : ndarray
+        3D image, only chunks are loaded so it can be a memory-mapped or a dask array.
+    sigmas_small : array
+        Sigmas of the small gaussian filter along each axis, in pixels.
+    sigmas_large : array
+        Sigmas of the large gaussian filter along each axis, in pixels.
+    chunk_size : int
+        Number of planes along the first axis per chunk.
+    n_workers : int, optional
+        Number of threads, all CPUs by default.
+    truncate : float
+        Gaussian kernels are truncated at this many sigmas.
+    out : ndarray, optional
+        Float32 array where the result is written, it can be memory-mapped.
+
+    Returns
+    -------
+    dog : ndarray
+        Filtered image in float32, positive for spots brighter than their surroundings.
+    """
+
+    return exhaust(dog_filter_chunks(img, sigmas_small, sigmas_large, chunk_size=chunk_size,
+                                     n_workers=n_workers, truncate=truncate, out=out))
+
+
+def dog_filter_chunks(img, sigmas_small, sigmas_large, chunk_size=64, n_workers=None,
+                      truncate=4.0, out=None):
+    """
+    Apply a DoG filter like `dog_filter`, yielding progress after each chunk
+    so that the computation can be followed and stopped between chunks.
+
+    Parameters are those of `dog_filter`.
+
+    Yields
+    ------
+    nb_done, nb_chunks : int
+        Number of filtered chunks and total number of chunks.
+
+    Returns
+    -------
+    dog : ndarray
+        Filtered image in float32.
+    """
+
+    nb_planes = img.shape[0]
+    if out is None:
+        out = np.empty(img.shape, dtype=np.float32)
+    halo = int(truncate * max(sigmas_small[0], sigmas_large[0]) + 0.5)
+
+    def filter_chunk(start):
+        stop = min(start + chunk_size, nb_planes)
+        lower = max(start - halo, 0)
+        upper = min(stop + halo, nb_planes)
+        # the halo is the kernel radius, so planes kept from the chunk are exact
+        dog = _dog_chunk(img[lower:upper], sigmas_small, sigmas_large, truncate)
+        out[start:stop] = dog[start - lower:stop - lower]
+
+    yield from map_chunks(filter_chunk, range(0, nb_planes, chunk_size), n_workers)
+    return out
@@ -0,0 +1,134 @@
+"""
+Incremental filtering of fitted spots, to preview the selection of spots
+while filtering parameters are tuned. The selection of exported spots is
+made by the `SPOTS3D` model with the GPU engine, and by this class with
+the CPU engine, see `_model.run_filter_spots`.
+"""
+
+import numpy as np
+
+from ._image_processing import find_close_pairs, compute_pair_distances
+
+
+# parameters of `spot_filter_params` used by each condition
+CONDITIONS = {
+    'amplitude': ['amp_min'],
+    'sigma_xy': ['sigma_min_xy_factor', 'sigma_max_xy_factor'],
+    'sigma_z': ['sigma_min_z_factor', 'sigma_max_z_factor'],
+    'sigma_ratio': ['min_sigma_ratio', 'max_sigma_ratio'],
+    'fit_dist_z': ['fit_dist_max_err_z_factor'],
+    'fit_dist_xy': ['fit_dist_max_err_xy_factor'],
+    'dist_boundary': ['dist_boundary_z_factor', 'dist_boundary_xy_factor'],
+    'min_spot_sep': ['min_spot_sep_z_factor', 'min_spot_sep_xy_factor'],
+}
+
+
+class SpotFilter:
+    """
+    Boolean matrix of filtering conditions of fitted spots, one column per
+    condition. When parameters change, only the columns of conditions whose
+    parameters changed are evaluated again.
+
+    Distances and sigmas are expressed as factors of the expected spot sigmas
+    `sigma_z` and `sigma_xy`, like the filtering parameters of the widget.
+    The distance to the boundary is measured from the fitted center to the
+    border of the fitted ROI, as a fraction of the ROI size.
+    Pairs of spots closer than `max_sep_z_factor` and `max_sep_xy_factor` are
+    found once with a KD-tree, the minimum separation condition then only
+    thresholds their distances and rejects the dimmer spot of each close pair.
+    """
+
+    def __init__(self, centers, amplitudes, sigmas_xy_factors, sigmas_z_factors,
+                 dist_fit_xy_factors, dist_fit_z_factors, sigma_xy, sigma_z,
+                 roi_xy_factor, roi_z_factor, max_sep_xy_factor=5, max_sep_z_factor=5):
+        self.amplitudes = amplitudes
+        self.sigmas_xy_factors = sigmas_xy_factors
+        self.sigmas_z_factors = sigmas_z_factors
+        self.sigma_ratios = sigmas_z_factors * sigma_z / (sigmas_xy_factors * sigma_xy)
+        self.dist_fit_xy_factors = dist_fit_xy_factors
+        self.dist_fit_z_factors = dist_fit_z_factors
+        self.roi_xy_factor = roi_xy_factor
+        self.roi_z_factor = roi_z_factor
+
+        pairs = find_close_pairs(centers, max_z=max_sep_z_factor * sigma_z,
+                                 max_xy=max_sep_xy_factor * sigma_xy)
+        dist_z, dist_xy = compute_pair_distances(centers, pairs)
+        self._close_pairs = pairs
+        self._close_dist_z_factors = dist_z / sigma_z
+        self._close_dist_xy_factors = dist_xy / sigma_xy
+
+        self.condition_names = list(CONDITIONS.keys())
+        self.conditions = np.ones((len(amplitudes), len(CONDITIONS)), dtype=bool, order='F')
+        self.to_keep = np.ones(len(amplitudes), dtype=bool)
+        self.params = {}
+
+    def _evaluate(self, name, params):
+        if name == 'amplitude':
+            return self.amplitudes >= params['amp_min']
+        if name in ['sigma_xy', 'sigma_z']:
+            axis = name.split('_')[1]
+            factors = self.sigmas_xy_factors if axis == 'xy' else self.sigmas_z_factors
+            return ((factors >= params[f'sigma_min_{axis}_factor']) &
+                    (factors <= params[f'sigma_max_{axis}_factor']))
+        if name == 'sigma_ratio':
+            return ((self.sigma_ratios >= params['min_sigma_ratio']) &
+                    (self.sigma_ratios <= params['max_sigma_ratio']))
+        if name == 'fit_dist_z':
+            return self.dist_fit_z_factors <= params['fit_dist_max_err_z_factor']
+        if name == 'fit_dist_xy':
+            return self.dist_fit_xy_factors <= params['fit_dist_max_err_xy_factor']
+        if name == 'dist_boundary':
+            dist_z = self.roi_z_factor / 2 - self.dist_fit_z_factors
+            dist_xy = self.roi_xy_factor / 2 - self.dist_fit_xy_factors
+            return ((dist_z >= params['dist_boundary_z_factor'] * self.roi_z_factor) &
+                    (dist_xy >= params['dist_boundary_xy_factor'] * self.roi_xy_factor))
+        if name == 'min_spot_sep':
+            is_close = ((self._close_dist_z_factors <= params['min_spot_sep_z_factor']) &
+                        (self._close_dist_xy_factors <= params['min_spot_sep_xy_factor']))
+            pairs = self._close_pairs[is_close]
+            dimmer = np.where(self.amplitudes[pairs[:, 0]] < self.amplitudes[pairs[:, 1]],
+                              pairs[:, 0], pairs[:, 1])
+            condition = np.ones(len(self.amplitudes), dtype=bool)
+            condition[dimmer] = False
+            return condition
+        raise ValueError(f"Unknown condition {name}")
+
+    def update(self, params):
+        """
+        Evaluate conditions whose parameters changed and update the selection of spots.
+
+        Parameters
+        ----------
+        params : dict
+            Filtering parameters, with the keys of `spot_filter_params`.
+
+        Returns
+        -------
+        to_keep : array
+            Boolean selection of spots passing all conditions.
+        """
+
+        for _ in self.iter_update(params):
+            pass
+        return self.to_keep
+
+    def iter_update(self, params):
+        """
+        Update the selection of spots like `update`, yielding progress after
+        each condition so that filtering can be followed and stopped.
+
+        Yields
+        ------
+        nb_done, nb_conditions : int
+            Number of checked conditions and total number of conditions.
+        """
+
+        changed = False
+        for col, (name, keys) in enumerate(CONDITIONS.items()):
+            if any(self.params.get(key) != params[key] for key in keys):
+                self.conditions[:, col] = self._evaluate(name, params)
+                changed = True
+            yield col + 1, len(CONDITIONS)
+        self.params = {**self.params, **params}
+        if changed:
+            self.to_keep = self.conditions.all(axis=1)
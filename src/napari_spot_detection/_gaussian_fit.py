@@ -0,0 +1,257 @@
+"""
+CPU engine fitting 3D gaussians on candidate spots, for nodes without GPU.
+
+Fitted parameters have the layout of the GPU fit of the `SPOTS3D` model:
+amplitude, x, y, z, sigma_xy, sigma_z, offset.
+"""
+
+import numpy as np
+
+from ._chunking import map_chunks, exhaust
+from ._image_processing import _gather_pixels
+
+
+NB_PARAMS = 7
+
+
+def gaussian3d(coords, params):
+    """
+    Evaluate 3D gaussians with a common sigma along x and y.
+
+    Parameters
+    ----------
+    coords : ndarray
+        Coordinates (z, y, x) of voxels, array of shape nb_spots x nb_voxels x 3.
+    params : ndarray
+        Parameters of gaussians, array of shape nb_spots x 7 with columns
+        amplitude, x, y, z, sigma_xy, sigma_z, offset.
+
+    Returns
+    -------
+    values : ndarray
+        Values of gaussians, array of shape nb_spots x nb_voxels.
+    gauss : ndarray
+        Values of gaussians of unit amplitude without offset.
+    """
+
+    amp, cx, cy, cz, sigma_xy, sigma_z, offset = [params[:, i:i + 1] for i in range(NB_PARAMS)]
+    dist_xy = (coords[..., 2] - cx)**2 + (coords[..., 1] - cy)**2
+    dist_z = (coords[..., 0] - cz)**2
+    gauss = np.exp(-dist_xy / (2 * sigma_xy**2) - dist_z / (2 * sigma_z**2))
+    return amp * gauss + offset, gauss
+
+
+def _jacobian(coords, params, gauss):
+    amp, cx, cy, cz, sigma_xy, sigma_z, _ = [params[:, i:i + 1] for i in range(NB_PARAMS)]
+    dx = coords[..., 2] - cx
+    dy = coords[..., 1] - cy
+    dz = coords[..., 0] - cz
+    amp_gauss = amp * gauss
+    jac = np.empty((*gauss.shape, NB_PARAMS), dtype=np.float32)
+    jac[..., 0] = gauss
+    jac[..., 1] = amp_gauss * dx / sigma_xy**2
+    jac[..., 2] = amp_gauss * dy / sigma_xy**2
+    jac[..., 3] = amp_gauss * dz / sigma_z**2
+    jac[..., 4] = amp_gauss * (dx**2 + dy**2) / sigma_xy**3
+    jac[..., 5] = amp_gauss * dz**2 / sigma_z**3
+    jac[..., 6] = 1
+    return jac
+
+
+def fit_gaussians_lm(rois, mask, coords, init_params, max_iter=50, tol=1e-6):
+    """
+    Fit 3D gaussians on a batch of ROIs with a vectorized Levenberg-Marquardt algorithm.
+
+    Parameters
+    ----------
+    rois : ndarray
+        Flattened ROIs, array of shape nb_spots x nb_voxels.
+    mask : ndarray
+        Boolean array of valid voxels, False for voxels outside the image.
+    coords : ndarray
+        Coordinates (z, y, x) of voxels, array of shape nb_spots x nb_voxels x 3.
+    init_params : ndarray
+        Initial parameters, array of shape nb_spots x 7.
+    max_iter : int
+        Maximum number of iterations.
+    tol : float
+        Fits stop when the relative decrease of their chi squared is below `tol`.
+
+    Returns
+    -------
+    params : ndarray
+        Fitted parameters, array of shape nb_spots x 7.
+    chi_sqrs : ndarray
+        Reduced chi squared of fits.
+    """
+
+    params = np.array(init_params, dtype=np.float64)
+    weights = mask.astype(np.float32)
+    model, gauss = gaussian3d(coords, params)
+    residuals = (rois - model) * weights
+    chi = np.sum(residuals**2, axis=1)
+    damping = np.full(len(params), 1e-3)
+    active = np.ones(len(params), dtype=bool)
+    eye = np.eye(NB_PARAMS)
+
+    for _ in range(max_iter):
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+        jac = _jacobian(coords[idx], params[idx], gauss[idx]) * weights[idx, :, None]
+        jtj = np.einsum('nvi,nvj->nij', jac, jac, dtype=np.float64)
+        grad = np.einsum('nvi,nv->ni', jac, residuals[idx], dtype=np.float64)
+        diag = np.einsum('nii->ni', jtj)
+        # damp along the diagonal, with a small floor for degenerate parameters
+        lhs = jtj + (damping[idx, None] * diag + 1e-9 * diag.max(axis=1, keepdims=True) + 1e-30)[:, :, None] * eye
+        step = np.linalg.solve(lhs, grad[:, :, None])[:, :, 0]
+
+        new_params = params[idx] + step
+        new_model, new_gauss = gaussian3d(coords[idx], new_params)
+        new_residuals = (rois[idx] - new_model) * weights[idx]
+        new_chi = np.sum(new_residuals**2, axis=1)
+        better = new_chi < chi[idx]
+
+        accepted = idx[better]
+        converged = accepted[(chi[accepted] - new_chi[better]) <= tol * chi[accepted]]
+        params[accepted] = new_params[better]
+        gauss[accepted] = new_gauss[better]
+        residuals[accepted] = new_residuals[better]
+        chi[accepted] = new_chi[better]
+        damping[idx] = np.where(better, damping[idx] / 10, damping[idx] * 10)
+        active[converged] = False
+        # stop fits that can't decrease their chi squared anymore
+        active[idx[damping[idx] > 1e10]] = False
+
+    params[:, 4:6] = np.abs(params[:, 4:6])
+    dof = np.maximum(mask.sum(axis=1) - NB_PARAMS, 1)
+    return params, chi / dof
+
+
+def get_roi_half_sizes(affine, sigma_xy, sigma_z, roi_factors):
+    """
+    Half sizes in pixels along each axis of the data of ROIs fitted around spots,
+    ROIs having `2 * half_sizes + 1` pixels along each axis.
+
+    Parameters
+    ----------
+    affine : ndarray
+        4 x 4 affine transform from pixel indices to physical coordinates.
+    sigma_xy, sigma_z : float
+        Expected spot sigmas.
+    roi_factors : tuple
+        Sizes of ROIs along z, y and x, as factors of expected sigmas.
+
+    Returns
+    -------
+    half_sizes : array
+        Half sizes of ROIs along each axis, at least 1 pixel.
+    """
+
+    # pixel spacing along each axis of the data
+    spacing = np.linalg.norm(affine[:3, :3], axis=0)
+    roi_sizes = np.array(roi_factors) * np.array([sigma_z, sigma_xy, sigma_xy])
+    return np.maximum(np.ceil(roi_sizes / spacing / 2).astype(int), 1)
+
+
+def _fit_batch(img, candidates, affine, sigma_xy, sigma_z, half_sizes, max_iter):
+    # centers of ROIs in pixels of the data
+    inv_affine = np.linalg.inv(affine)
+    centers = np.round(candidates @ inv_affine[:3, :3].T + inv_affine[:3, 3]).astype(int)
+    grid = np.stack(np.meshgrid(*[np.arange(-half, half + 1) for half in half_sizes],
+                                indexing='ij'), axis=-1).reshape(-1, 3)
+    idx = centers[:, None, :] + grid[None, :, :]
+    shape = np.array(img.shape)
+    mask = np.all((idx >= 0) & (idx < shape), axis=-1)
+    idx = np.clip(idx, 0, shape - 1)
+    rois = _gather_pixels(img, tuple(idx.reshape(-1, 3).T)).reshape(mask.shape).astype(np.float32)
+    coords = (idx @ affine[:3, :3].T + affine[:3, 3]).astype(np.float32)
+
+    roi_min = np.where(mask, rois, np.inf).min(axis=1)
+    roi_max = np.where(mask, rois, -np.inf).max(axis=1)
+    init_params = np.column_stack([
+        roi_max - roi_min,
+        candidates[:, 2],
+        candidates[:, 1],
+        candidates[:, 0],
+        np.full(len(candidates), sigma_xy),
+        np.full(len(candidates), sigma_z),
+        roi_min,
+    ])
+    return fit_gaussians_lm(rois, mask, coords, init_params, max_iter=max_iter)
+
+
+def fit_candidates(img, candidates, affine, sigma_xy, sigma_z, roi_factors,
+                   batch_size=2000, n_workers=None, max_iter=50):
+    """
+    Fit 3D gaussians around candidate spots.
+
+    ROIs of all spots of a batch are gathered in one contiguous buffer and
+    fitted at once, batches are fitted in a pool of threads.
+
+    Parameters
+    ----------
+    img : ndarray
+        3D image, it can be a memory-mapped or a dask array.
+    candidates : ndarray
+        Coordinates (z, y, x) of candidate spots, in physical units.
+    affine : ndarray
+        4 x 4 affine transform from pixel indices to physical coordinates, like
+        a scaling matrix, or `get_deskew_affine` for skewed data.
+    sigma_xy : float
+        Expected spot sigma along x and y, initial value of fits.
+    sigma_z : float
+        Expected spot sigma along z.
+    roi_factors : tuple
+        Sizes of ROIs along z, y and x, as factors of expected sigmas.
+    batch_size : int
+        Number of spots fitted at once.
+    n_workers : int, optional
+        Number of threads, all CPUs by default.
+    max_iter : int
+        Maximum number of iterations of the Levenberg-Marquardt algorithm.
+
+    Returns
+    -------
+    fit_params : ndarray
+        Fitted parameters, array of shape nb_spots x 7 with columns amplitude,
+        x, y, z, sigma_xy, sigma_z and offset.
+    chi_sqrs : ndarray
+        Reduced chi squared of fits.
+    """
+
+    return exhaust(fit_candidates_batches(img, candidates, affine, sigma_xy, sigma_z, roi_factors,
+                                          batch_size=batch_size, n_workers=n_workers, max_iter=max_iter))
+
+
+def fit_candidates_batches(img, candidates, affine, sigma_xy, sigma_z, roi_factors,
+                           batch_size=2000, n_workers=None, max_iter=50):
+    """
+    Fit 3D gaussians like `fit_candidates`, yielding progress after each batch
+    of spots so that fits can be followed and stopped between batches.
+
+    Parameters are those of `fit_candidates`.
+
+    Yields
+    ------
+    nb_done, nb_batches : int
+        Number of fitted batches and total number of batches.
+
+    Returns
+    -------
+    fit_params, chi_sqrs : ndarray
+        Fitted parameters and reduced chi squared of fits.
+    """
+
+    candidates = np.asarray(candidates, dtype=float)
+    half_sizes = get_roi_half_sizes(affine, sigma_xy, sigma_z, roi_factors)
+    fit_params = np.empty((len(candidates), NB_PARAMS))
+    chi_sqrs = np.empty(len(candidates))
+
+    def fit_batch(start):
+        stop = min(start + batch_size, len(candidates))
+        fit_params[start:stop], chi_sqrs[start:stop] = _fit_batch(
+            img, candidates[start:stop], affine, sigma_xy, sigma_z, half_sizes, max_iter)
+
+    yield from map_chunks(fit_batch, range(0, len(candidates), batch_size), n_workers)
+    return fit_params, chi_sqrs
@@ -1,5 +1,137 @@
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from tysserand import tysserand as ty
+from scipy import ndimage as ndi
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+
+try:
+    from . import _numba_kernels
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+try:
+    # Python >= 3.8, the parallel merge of peaks falls back to the serial one without it
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+# backend used by graph utilities when not specified, 'numba' or 'numpy'
+DEFAULT_BACKEND = 'numba' if NUMBA_AVAILABLE else 'numpy'
+
+
+def _get_backend(backend):
+    if backend is None:
+        backend = DEFAULT_BACKEND
+    if backend not in ('numba', 'numpy'):
+        raise ValueError("`backend` has to be 'numba' or 'numpy'")
+    if backend == 'numba' and not NUMBA_AVAILABLE:
+        raise ImportError("numba is required for the 'numba' backend")
+    return backend
+
+
+def get_tilt_vector(pixel_size, scan_step, theta):
+    """
+    Make the tilt vector of skewed data from an oblique plane microscope.
+
+    Parameters
+    ----------
+    pixel_size : float
+        Camera pixel size.
+    scan_step : float
+        Distance between frames, in the same unit as `pixel_size`.
+    theta : float
+        Angle of the tilted plane, in degrees.
+
+    Returns
+    -------
+    tilt_vector : array
+        Components of a scan step along the normal axis and along 
+        the tilted axis of the tilted plane, in pixels.
+    
+    Example
+    -------
+    >>> get_tilt_vector(0.115, 0.4, 30)
+    array([1.73913043, 3.01226227])
+    """
+
+    theta = np.deg2rad(theta)
+    tilt_vector = np.array([np.sin(theta), np.cos(theta)]) * scan_step / pixel_size
+    return tilt_vector
+
+
+def tilted_frame_coords(coords, tilt_vector, inverse=False):
+    """
+    Convert coordinates of skewed data, i.e. (scan, tilted axis, x) indices,
+    into the orthonormal frame of the tilted plane: (normal axis, tilted axis, x).
+
+    Parameters
+    ----------
+    coords : ndarray
+        Coordinates of nodes, array of shape nb_nodes x 3.
+    tilt_vector : array
+        Components of a scan step along the normal axis and along 
+        the tilted axis, as given by `get_tilt_vector`.
+    inverse : bool
+        If True, convert coordinates in the tilted plane frame back into skewed coordinates.
+
+    Returns
+    -------
+    frame_coords : ndarray
+        Converted coordinates.
+
+    Example
+    -------
+    >>> coords = np.array([[1, 0, 0], [2, 5, 3]])
+    >>> tilted_frame_coords(coords, [0.5, 2])
+    array([[0.5, 2. , 0. ],
+           [1. , 9. , 3. ]])
+    """
+
+    frame_coords = np.array(coords, dtype=float)
+    if inverse:
+        frame_coords[:, 0] /= tilt_vector[0]
+        frame_coords[:, 1] -= frame_coords[:, 0] * tilt_vector[1]
+    else:
+        frame_coords[:, 1] += frame_coords[:, 0] * tilt_vector[1]
+        frame_coords[:, 0] *= tilt_vector[0]
+    return frame_coords
+
+
+def get_deskew_affine(pixel_size, scan_step, theta):
+    """
+    Make the affine transform from skewed data indices (scan, camera y, camera x)
+    to physical deskewed coordinates (z, y, x), to display raw data of an
+    oblique plane microscope without deskewing it.
+
+    Parameters
+    ----------
+    pixel_size : float
+        Camera pixel size.
+    scan_step : float
+        Distance between frames, in the same unit as `pixel_size`.
+    theta : float
+        Angle of the tilted plane, in degrees.
+
+    Returns
+    -------
+    affine : ndarray
+        Homogeneous affine matrix of shape 4 x 4.
+
+    Example
+    -------
+    >>> get_deskew_affine(0.115, 0.4, 30)[:3, :3]
+    array([[0.        , 0.0575    , 0.        ],
+           [0.4       , 0.09959292, 0.        ],
+           [0.        , 0.        , 0.115     ]])
+    """
+
+    theta = np.deg2rad(theta)
+    affine = np.eye(4)
+    affine[0, :3] = [0, pixel_size * np.sin(theta), 0]
+    affine[1, :3] = [scan_step, pixel_size * np.cos(theta), 0]
+    affine[2, :3] = [0, 0, pixel_size]
+    return affine
 
 
 def compute_distances(source, target, method='xy_z_orthog', dist_fct='euclidian', tilt_vector=None):
@@ -14,6 +146,12 @@ def compute_distances(source, target, method='xy_z_orthog', dist_fct='euclidian'
         Method used to compute distances. If 'xyz', standard distances are computed considering all axes
         simultaneously. If 'xy_z_orthog' 2 distances are computed, for the xy pkane and along the z axis 
         respectively. If 'xy_z_tilted' 2 distances are computed for the tilted plane and  its normal axis.
+    dist_fct : str | callable
+        Distance function, 'euclidian', 'L1' or a function with an `axis` argument.
+    tilt_vector : array, optional
+        For method 'xy_z_tilted', components of a scan step along the normal axis 
+        and along the tilted axis of the tilted plane, see `get_tilt_vector`.
+        Coordinates are then the raw skewed (scan, tilted axis, x) coordinates.
     
     Example
     -------
@@ -45,7 +183,88 @@ def compute_distances(source, target, method='xy_z_orthog', dist_fct='euclidian'
             dist_z = dist_fct(source[:, 0], target[:, 0])
         return dist_z, dist_xy
     elif method == 'xy_z_tilted':
-        raise NotImplementedError("Method 'xy_z_tilted' will be implemented soon")
+        if tilt_vector is None:
+            raise ValueError("`tilt_vector` has to be given for method 'xy_z_tilted'")
+        # the tilted plane frame is a linear transform of skewed coordinates
+        source = tilted_frame_coords(source, tilt_vector)
+        target = tilted_frame_coords(target, tilt_vector)
+        return compute_distances(source, target, method='xy_z_orthog', dist_fct=dist_fct)
+
+
+def compute_pair_distances(coords, pairs, method='xy_z_orthog', dist_fct='euclidian', 
+                           tilt_vector=None, max_z=None, max_xy=None, out=None, 
+                           chunk_size=1_000_000):
+    """
+    Compute distances between pairs of nodes block by block of edges, 
+    without gathering the coordinates of all pairs at once.
+
+    Parameters
+    ----------
+    coords : ndarray
+        Coordinates of nodes, array of shape nb_nodes x 3.
+    pairs : ndarray
+        Array of pairs of nodes' indices defining the network, of shape nb_edges x 2.
+    method : str
+        Method used to compute distances, see `compute_distances`.
+    dist_fct : str | callable
+        Distance function, see `compute_distances`.
+    tilt_vector : array, optional
+        For method 'xy_z_tilted', see `compute_distances`.
+    max_z : float, optional
+        Distance threshold along the z axis. If given with `max_xy`, the graph cut of 
+        `cut_graph_bidistance` is applied on each block and only the selection is returned.
+    max_xy : float, optional
+        Distance threshold in the xy plane.
+    out : ndarray | tuple, optional
+        Arrays where results are written: a boolean array if thresholds are given,
+        else one float32 array for method 'xyz' or a tuple of 2 float32 arrays.
+    chunk_size : int
+        Number of edges processed at once.
+
+    Returns
+    -------
+    select : array
+        If thresholds are given, boolean filter of pairs of nodes close to each other.
+    dist_z, dist_xy : array
+        Else, distances between nodes along the z axis and in the xy plane, or the
+        single distance array for method 'xyz'.
+    
+    Example
+    -------
+    >>> coords = np.array([[0, 0, 0], [1, 0, 0], [0, 3, 4]])
+    >>> pairs = np.array([[0, 1], [0, 2]])
+    >>> compute_pair_distances(coords, pairs)
+    (array([1., 0.], dtype=float32), array([0., 5.], dtype=float32))
+    >>> compute_pair_distances(coords, pairs, max_z=2, max_xy=2)
+    array([ True, False])
+    """
+
+    nb_edges = len(pairs)
+    fuse_cut = max_z is not None and max_xy is not None
+    if fuse_cut and method == 'xyz':
+        raise ValueError("Thresholds can only be applied with 2 distances methods")
+    if out is None:
+        if fuse_cut:
+            out = np.empty(nb_edges, dtype=bool)
+        elif method == 'xyz':
+            out = np.empty(nb_edges, dtype=np.float32)
+        else:
+            out = (np.empty(nb_edges, dtype=np.float32), np.empty(nb_edges, dtype=np.float32))
+    
+    for start in range(0, nb_edges, chunk_size):
+        block = pairs[start:start + chunk_size]
+        stop = start + len(block)
+        dist = compute_distances(coords[block[:, 0]], coords[block[:, 1]], method=method,
+                                 dist_fct=dist_fct, tilt_vector=tilt_vector)
+        if fuse_cut:
+            # threshold the full precision distances
+            out[start:stop] = cut_graph_bidistance(*dist, max_z, max_xy)
+        elif method == 'xyz':
+            out[start:stop] = dist
+        else:
+            out[0][start:stop] = dist[0]
+            out[1][start:stop] = dist[1]
+    return out
 
 
 def cut_graph_bidistance(dist_z, dist_xy, max_z, max_xy, pairs=None):
@@ -78,12 +297,99 @@ def cut_graph_bidistance(dist_z, dist_xy, max_z, max_xy, pairs=None):
     select = np.logical_and(dist_z <= max_z, dist_xy  <= max_xy)
     if pairs is not None:
         filtered_pairs = pairs[select, :]
-        return select, pairs
+        return select, filtered_pairs
     else:
         return select
 
 
-def find_neighbors(pairs, n):
+def find_close_pairs(coords, max_z, max_xy, tilt_vector=None):
+    """
+    Find all pairs of nodes closer than a distance threshold along the z axis
+    and an other one in the xy plane, i.e. inside a cylinder around each other.
+
+    Axes are rescaled so that both thresholds become 1, a KD-tree is queried once
+    for pairs within this box, and the box corners are trimmed with the exact 
+    cylinder test. This avoids building the graph for the sphere of radius 
+    `max(max_z, max_xy)` when thresholds are very different.
+
+    Parameters
+    ----------
+    coords : ndarray
+        Coordinates of nodes, array of shape nb_nodes x 3.
+    max_z : float
+        Distance threshold along the z axis.
+    max_xy : float
+        Distance threshold in the xy plane.
+    tilt_vector : array, optional
+        If given, `coords` are skewed coordinates and thresholds apply along the normal
+        axis and in the tilted plane, see `get_tilt_vector`.
+
+    Returns
+    -------
+    pairs : ndarray
+        Array of pairs of nodes' indices inside the cylinder, int32 array
+        of shape nb_edges x 2.
+
+    Examples
+    --------
+    >>> coords = np.array([[0, 0, 0], [3, 1, 0], [0, 3, 0], [9, 0, 0]])
+    >>> find_close_pairs(coords, max_z=4, max_xy=1.5)
+    array([[0, 1]], dtype=int32)
+    """
+
+    coords = np.asarray(coords)
+    if tilt_vector is not None:
+        coords = tilted_frame_coords(coords, tilt_vector)
+    eps = np.finfo(float).eps
+    scale = np.full(coords.shape[1], 1 / max(max_xy, eps))
+    scale[0] = 1 / max(max_z, eps)
+    tree = cKDTree(coords * scale)
+    pairs = tree.query_pairs(r=1, p=np.inf, output_type='ndarray').astype(np.int32)
+    # trim pairs in the corners of the box
+    select = compute_pair_distances(coords, pairs, max_z=max_z, max_xy=max_xy)
+    pairs = pairs[select]
+    return pairs
+
+
+def build_adjacency(pairs, nb_nodes=None):
+    """
+    Build a compact adjacency index of an undirected network defined 
+    by edges between pairs of nodes, in the CSR format.
+    
+    Parameters
+    ----------
+    pairs : array_like
+        Pairs of nodes' id that define the network's edges.
+    nb_nodes : int, optional
+        Total number of nodes, if None it is deduced from the highest node id.
+        
+    Returns
+    -------
+    adjacency : tuple
+        The `(offsets, neighbors)` int32 arrays, neighbors of node `n` are
+        `neighbors[offsets[n]:offsets[n+1]]`.
+    
+    Examples
+    --------
+    >>> pairs = np.array([[0, 1], [0, 2], [2, 3]])
+    >>> build_adjacency(pairs)
+    (array([0, 2, 3, 5, 6], dtype=int32), array([1, 2, 0, 0, 3, 2], dtype=int32))
+    """
+
+    pairs = np.asarray(pairs).reshape(-1, 2)
+    if nb_nodes is None:
+        nb_nodes = pairs.max() + 1 if len(pairs) > 0 else 0
+    # each edge is stored in both directions, left neighbors first
+    source = np.concatenate((pairs[:, 1], pairs[:, 0]))
+    target = np.concatenate((pairs[:, 0], pairs[:, 1]))
+    order = np.argsort(source, kind='stable')
+    neighbors = target[order].astype(np.int32)
+    offsets = np.zeros(nb_nodes + 1, dtype=np.int32)
+    np.cumsum(np.bincount(source, minlength=nb_nodes), out=offsets[1:])
+    return offsets, neighbors
+
+
+def find_neighbors(pairs, n, adjacency=None, backend=None):
     """
     Return the list of neighbors of a node in a network defined 
     by edges between pairs of nodes. 
@@ -92,8 +398,14 @@ def find_neighbors(pairs, n):
     ----------
     pairs : array_like
         Pairs of nodes' id that define the network's edges.
-    n : int
-        The node for which we look for the neighbors.
+    n : int | array_like
+        The node for which we look for the neighbors. If `adjacency` is given,
+        it can be an array of nodes whose neighbors are gathered at once.
+    adjacency : tuple, optional
+        Adjacency index made by `build_adjacency`, if given `pairs` is not used.
+    backend : str, optional
+        'numba' or 'numpy' implementation used with `adjacency`, 
+        the default is 'numba' if it is installed.
         
     Returns
     -------
@@ -101,6 +413,19 @@ def find_neighbors(pairs, n):
         The indices of neighboring nodes.
     """
     
+    if adjacency is not None:
+        offsets, neighbors = adjacency
+        nodes = np.atleast_1d(n)
+        if _get_backend(backend) == 'numba':
+            return _numba_kernels.gather_neighbors_kernel(offsets, neighbors, nodes)
+        nodes = nodes[nodes < len(offsets) - 1]
+        starts = offsets[nodes]
+        counts = offsets[nodes + 1] - starts
+        # positions of all neighbors of the frontier in a single gather
+        shifts = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        neigh = neighbors[shifts + np.arange(counts.sum())]
+        return neigh
+
     left_neigh = pairs[pairs[:,1] == n, 0]
     right_neigh = pairs[pairs[:,0] == n, 1]
     neigh = np.hstack( (left_neigh, right_neigh) ).flatten()
@@ -108,7 +433,7 @@ def find_neighbors(pairs, n):
     return neigh
 
 
-def neighbors_k_order(pairs, n, order):
+def neighbors_k_order(pairs, n, order, adjacency=None, backend=None):
     """
     Return the list of up the kth neighbors of a node 
     in a network defined by edges between pairs of nodes
@@ -121,6 +446,11 @@ def neighbors_k_order(pairs, n, order):
         The node for which we look for the neighbors.
     order : int
         Max order of neighbors.
+    adjacency : tuple, optional
+        Adjacency index made by `build_adjacency`. If None it is built from `pairs`,
+        pass it to avoid rebuilding it when querying many nodes.
+    backend : str, optional
+        'numba' or 'numpy' implementation, the default is 'numba' if it is installed.
         
     Returns
     -------
@@ -150,10 +480,23 @@ def neighbors_k_order(pairs, n, order):
                         [330, 110]])
     >>> neighbors_k_order(pairs, 0, 2)
     [[array([0]), 0],
-     [array([10, 20, 30]), 1],
-     [array([110, 120, 130, 210, 220, 230, 310, 320, 330]), 2]]
+     [array([10, 20, 30], dtype=int32), 1],
+     [array([110, 120, 130, 210, 220, 230, 310, 320, 330], dtype=int32), 2]]
     """
     
+    if adjacency is None:
+        adjacency = build_adjacency(pairs)
+    if _get_backend(backend) == 'numba':
+        nodes, orders = _numba_kernels.bfs_kernel(*adjacency, n, order)
+        nodes = nodes.astype(adjacency[1].dtype)
+        all_neigh = [[np.array([n]), 0]]
+        for k in range(1, orders[-1] + 1):
+            all_neigh.append([np.sort(nodes[orders == k]), k])
+        if orders[-1] < order:
+            # the numpy implementation registers the last empty order
+            all_neigh.append([np.empty(0, dtype=nodes.dtype), orders[-1] + 1])
+        return all_neigh
+
     # all_neigh stores all the unique neighbors and their oder
     all_neigh = [[np.array([n]), 0]]
     unique_neigh = np.array([n])
@@ -161,23 +504,17 @@ def neighbors_k_order(pairs, n, order):
     for k in range(order):
         # detected neighbor nodes at the previous order
         last_neigh = all_neigh[k][0]
-        k_neigh = []
-        for node in last_neigh:
-            # aggregate arrays of neighbors for each previous order neighbor
-            neigh = np.unique(find_neighbors(pairs, node))
-            k_neigh.append(neigh)
-        # aggregate all unique kth order neighbors
-        if len(k_neigh) > 0:
-            k_unique_neigh = np.unique(np.concatenate(k_neigh, axis=0))
-            # select the kth order neighbors that have never been detected in previous orders
-            keep_neigh = np.in1d(k_unique_neigh, unique_neigh, invert=True)
-            k_unique_neigh = k_unique_neigh[keep_neigh]
-            # register the kth order unique neighbors along with their order
-            all_neigh.append([k_unique_neigh, k+1])
-            # update array of unique detected neighbors
-            unique_neigh = np.concatenate([unique_neigh, k_unique_neigh], axis=0)
-        else:
+        if len(last_neigh) == 0:
             break
+        # aggregate all unique kth order neighbors of the whole frontier
+        k_unique_neigh = np.unique(find_neighbors(pairs, last_neigh, adjacency=adjacency))
+        # select the kth order neighbors that have never been detected in previous orders
+        keep_neigh = np.isin(k_unique_neigh, unique_neigh, invert=True)
+        k_unique_neigh = k_unique_neigh[keep_neigh]
+        # register the kth order unique neighbors along with their order
+        all_neigh.append([k_unique_neigh, k+1])
+        # update array of unique detected neighbors
+        unique_neigh = np.concatenate([unique_neigh, k_unique_neigh], axis=0)
         
     return all_neigh
 
@@ -210,10 +547,7 @@ def flatten_neighbors(all_neigh):
     Code from the mosna library https://github.com/AlexCoul/mosna
     """
     
-    list_neigh = []
-    for neigh, order in all_neigh:
-        list_neigh.append(neigh)
-    flat_neigh = np.concatenate(list_neigh, axis=0)
+    flat_neigh = np.concatenate([neigh for neigh, order in all_neigh], axis=0)
 
     return flat_neigh
 
@@ -248,7 +582,54 @@ def merge_nodes(coords, weight):
     return merged_coords
 
 
-def merge_cluster_nodes(coords, pairs, weights=None, split_big_clust=False, cluster_size=None):
+def label_clusters(pairs, nb_nodes, backend=None):
+    """
+    Label the connected clusters of a graph in a single pass.
+
+    Parameters
+    ----------
+    pairs : ndarray
+        Array of pairs of nodes' indices defining the network, of shape nb_edges x 2.
+    nb_nodes : int
+        Total number of nodes, isolated nodes get their own cluster.
+    backend : str, optional
+        'numba' to use a compiled union-find or 'numpy' to use scipy's sparse graph
+        labeling, the default is 'numba' if it is installed.
+
+    Returns
+    -------
+    labels : array
+        Cluster label of each node. Clusters are numbered by increasing
+        smallest node index, i.e. in the order they are visited by iterating
+        over nodes.
+    nb_clusters : int
+        Number of clusters.
+
+    Examples
+    --------
+    >>> pairs = np.array([[3, 1], [2, 4]])
+    >>> label_clusters(pairs, 6)
+    (array([0, 1, 2, 1, 2, 3], dtype=int32), 4)
+    """
+
+    pairs = np.asarray(pairs).reshape(-1, 2)
+    if _get_backend(backend) == 'numba':
+        return _numba_kernels.label_clusters_kernel(pairs, nb_nodes)
+    adjacency = sparse.coo_matrix(
+        (np.ones(len(pairs), dtype=np.int32), (pairs[:, 0], pairs[:, 1])),
+        shape=(nb_nodes, nb_nodes),
+        )
+    nb_clusters, labels = csgraph.connected_components(adjacency, directed=False)
+    # renumber clusters by order of their first node
+    _, first_nodes = np.unique(labels, return_index=True)
+    order = np.empty(nb_clusters, dtype=labels.dtype)
+    order[np.argsort(first_nodes)] = np.arange(nb_clusters)
+    labels = order[labels]
+    return labels, nb_clusters
+
+
+def merge_cluster_nodes(coords, pairs, weights=None, split_big_clust=False, cluster_size=None,
+                        backend=None):
     """
     Merge nodes that are in the same connected cluster, for all cluster in a graph.
 
@@ -261,6 +642,8 @@ def merge_cluster_nodes(coords, pairs, weights=None, split_big_clust=False, clus
     weight : array
         Weight of nodes for coordinates averaging. The image intensity at nodes
         coordinates can be used as weights.
+    backend : str, optional
+        'numba' or 'numpy' implementation, the default is 'numba' if it is installed.
 
     Returns
     -------
@@ -268,48 +651,268 @@ def merge_cluster_nodes(coords, pairs, weights=None, split_big_clust=False, clus
         Coordinates of merged nodes.
     """
 
+    backend = _get_backend(backend)
     nb_nodes = len(coords)
     if weights is None:
         weights = np.ones(nb_nodes)
-    # make list of nodes indices on which we will iterate
-    iter_nodes = np.arange(nb_nodes)
-    # variable storing new merged coordinates
-    merged_coords = []
-    # for each node, detect all its connected neighbors, even indirectly
-    for i in np.arange(nb_nodes):
-        # check if we have processed all nodes
-        if i >= len(iter_nodes):
-            break
-        else:
-            node_id = iter_nodes[i]
-            detected_neighbors = flatten_neighbors(neighbors_k_order(pairs, node_id, nb_nodes))
-            # delete these coordinates nodes indices to avoid reprocessing the same neighbors
-            select = np.isin(iter_nodes, detected_neighbors, assume_unique=True, invert=True)
-            iter_nodes = iter_nodes[select]
-            # merge nodes coordinates
-            if len(detected_neighbors) == 1:
-                merged_coords.append(coords[node_id])
-            else:
-                # detect if cluster likely contains multiple spots
-                if split_big_clust:
-                    if cluster_size is None:
-                        raise ValueError("`cluster_size` has to be given to split big clusters")
-                    # work on it latter, for now use small distance thresholds
-                    # actually merge peaks
-                    cluster_coords = merge_nodes(coords[detected_neighbors], 
-                                                 weights[detected_neighbors].reshape(-1, 1))
-                else:
-                    cluster_coords = merge_nodes(coords[detected_neighbors], 
-                                                 weights[detected_neighbors].reshape(-1, 1))
-                merged_coords.append(cluster_coords)
-    merged_coords = np.vstack(merged_coords)
+    weights = np.asarray(weights, dtype=float).ravel()
+    # detect all connected neighbors of each node, even indirectly
+    labels, nb_clusters = label_clusters(pairs, nb_nodes, backend=backend)
+    clust_sizes = np.bincount(labels, minlength=nb_clusters)
+    if split_big_clust and np.any(clust_sizes > 1):
+        # detect if cluster likely contains multiple spots
+        if cluster_size is None:
+            raise ValueError("`cluster_size` has to be given to split big clusters")
+        # work on it latter, for now use small distance thresholds
+    if np.all(clust_sizes == 1):
+        return coords.copy()
+    if backend == 'numba':
+        return _numba_kernels.weighted_centroids_kernel(coords, weights, labels, nb_clusters)
+    # weighted average of coordinates with grouped sums over clusters
+    tot_weight = np.bincount(labels, weights=weights, minlength=nb_clusters)
+    merged_coords = np.empty((nb_clusters, coords.shape[1]))
+    for dim in range(coords.shape[1]):
+        merged_coords[:, dim] = np.bincount(labels, weights=coords[:, dim] * weights, 
+                                            minlength=nb_clusters)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        merged_coords /= tot_weight.reshape(-1, 1)
+    # isolated nodes keep their exact coordinates
+    single = clust_sizes[labels] == 1
+    merged_coords[labels[single]] = coords[single]
     return merged_coords
 
 
+def _gather_pixels(img, idx):
+    """
+    Read pixels of an image at integer coordinates, for numpy, memory-mapped
+    or dask arrays, without loading the whole image.
+    """
+    if hasattr(img, 'vindex'):
+        # dask arrays need vindex for pointwise indexing
+        return np.asarray(img.vindex[idx])
+    return np.asarray(img[idx])
+
+
+def sample_weights(weight_img, coords, order=1, block_size=1_000_000):
+    """
+    Get the pixel values of an image at several coordinates.
+
+    Parameters
+    ----------
+    weight_img : ndarray
+        Image from which values are read, only the pixels around coordinates are loaded,
+        so it can be a memory-mapped or a dask array.
+    coords : ndarray
+        Coordinates of pixels, array of shape nb_nodes x 3.
+    order : int
+        For float coordinates, 0 to use the nearest pixel value, 1 for a linear
+        (trilinear in 3D) interpolation between surrounding pixels.
+        Integer coordinates directly give the pixel value.
+    block_size : int
+        Number of coordinates processed at once.
+
+    Returns
+    -------
+    weights : array
+        Values of pixels.
+
+    Example
+    -------
+    >>> img = np.arange(8).reshape((2, 2, 2))
+    >>> sample_weights(img, np.array([[0, 1, 1], [0.5, 0.5, 0.5]]))
+    array([3. , 3.5])
+    """
+
+    coords = np.asarray(coords)
+    if np.issubdtype(coords.dtype, np.integer):
+        order = None
+    shape = np.array(weight_img.shape)
+    weights = []
+    for start in range(0, len(coords), block_size):
+        block = coords[start:start + block_size]
+        if order is None:
+            weights.append(_gather_pixels(weight_img, tuple(block.T)))
+        elif order == 0:
+            idx = np.clip(np.round(block).astype(int), 0, shape - 1)
+            weights.append(_gather_pixels(weight_img, tuple(idx.T)))
+        elif order == 1:
+            block = np.clip(block, 0, shape - 1)
+            lower = np.minimum(np.floor(block).astype(int), np.maximum(shape - 2, 0))
+            frac = block - lower
+            block_weights = np.zeros(len(block))
+            # sum the contributions of the 2**nb_dims surrounding pixels
+            for corner in itertools.product([0, 1], repeat=len(shape)):
+                corner = np.array(corner)
+                idx = np.minimum(lower + corner, shape - 1)
+                coef = np.prod(np.where(corner, frac, 1 - frac), axis=1)
+                block_weights += coef * _gather_pixels(weight_img, tuple(idx.T))
+            weights.append(block_weights)
+        else:
+            raise ValueError("`order` has to be 0 or 1")
+    if len(weights) == 0:
+        return np.empty(0)
+    weights = np.concatenate(weights)
+    return weights
+
+
+def find_local_maxima(img, size=3, min_value=0, block_size=64):
+    """
+    Find all local maxima of an image, sorted by increasing value so that
+    maxima above any threshold are selected with a binary search.
+
+    Parameters
+    ----------
+    img : ndarray
+        Image, like the result of a DoG filter. It is read by blocks along
+        the first axis, so it can be a memory-mapped or a dask array.
+    size : int
+        Size of the neighborhood in which a pixel has to be the maximum.
+    min_value : float
+        Only maxima strictly above this value are kept.
+    block_size : int
+        Number of planes along the first axis processed at once.
+
+    Returns
+    -------
+    coords : ndarray
+        Coordinates of local maxima, array of shape nb_maxima x nb_dims.
+    values : ndarray
+        Sorted values of local maxima.
+
+    Example
+    -------
+    >>> img = np.zeros((5, 5, 5))
+    >>> img[1, 1, 1] = 2
+    >>> img[3, 3, 3] = 1
+    >>> find_local_maxima(img)
+    (array([[3, 3, 3],
+           [1, 1, 1]]), array([1., 2.]))
+    """
+
+    halo = size // 2
+    nb_planes = img.shape[0]
+    coords = []
+    values = []
+    for start in range(0, nb_planes, block_size):
+        stop = min(start + block_size, nb_planes)
+        # add planes on both sides to find maxima on blocks borders
+        lower = max(start - halo, 0)
+        upper = min(stop + halo, nb_planes)
+        block = np.asarray(img[lower:upper])
+        is_max = (block == ndi.maximum_filter(block, size=size, mode='nearest')) & (block > min_value)
+        is_max[:start - lower] = False
+        is_max[stop - lower:] = False
+        block_coords = np.argwhere(is_max)
+        values.append(block[is_max])
+        block_coords[:, 0] += lower
+        coords.append(block_coords)
+    coords = np.vstack(coords)
+    values = np.concatenate(values)
+    order = np.argsort(values, kind='stable')
+    return coords[order], values[order]
+
+
+def select_local_maxima(coords, values, threshold):
+    """
+    Select local maxima strictly above a threshold.
+
+    Parameters
+    ----------
+    coords : ndarray
+        Coordinates of local maxima.
+    values : ndarray
+        Values of local maxima sorted by increasing values, as
+        returned by `find_local_maxima`.
+    threshold : float
+        Minimum value of selected maxima.
+
+    Returns
+    -------
+    coords : ndarray
+        Coordinates of local maxima above the threshold.
+    """
+
+    start = np.searchsorted(values, threshold, side='right')
+    return coords[start:]
+
+
+def sample_tiles(shape, tile_shape, nb_tiles, seed=0):
+    """
+    Draw random non-overlapping tiles of an image, on a regular grid.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the image.
+    tile_shape : tuple
+        Shape of tiles, None or 0 along an axis selects the full axis.
+    nb_tiles : int
+        Number of tiles, limited by the number of tiles in the grid.
+    seed : int
+        Seed of the random generator.
+
+    Returns
+    -------
+    tiles : list
+        Tuples of slices selecting each tile, sorted by position.
+
+    Example
+    -------
+    >>> sample_tiles((10, 100, 100), (0, 50, 50), 1, seed=0)
+    [(slice(0, 10, None), slice(50, 100, None), slice(50, 100, None))]
+    """
+
+    shape = np.array(shape)
+    tile_shape = np.array([size if (tile is None or tile <= 0) else min(tile, size)
+                           for tile, size in zip(tile_shape, shape)])
+    grid = shape // tile_shape
+    nb_grid = int(np.prod(grid))
+    rng = np.random.default_rng(seed)
+    tile_ids = np.sort(rng.choice(nb_grid, size=min(nb_tiles, nb_grid), replace=False))
+    tiles = []
+    for tile_id in tile_ids:
+        corner = np.array(np.unravel_index(tile_id, grid)) * tile_shape
+        tiles.append(tuple(slice(int(start), int(start + size)) 
+                           for start, size in zip(corner, tile_shape)))
+    return tiles
+
+
+def assemble_tiles(img, tiles, gap=8):
+    """
+    Place tiles of an image side by side along the last axis, separated by 
+    gaps of zeros, to process several tiles at once.
+
+    Parameters
+    ----------
+    img : ndarray
+        Image, only tiles are loaded so it can be a memory-mapped or a dask array.
+    tiles : list
+        Tuples of slices of tiles, all tiles having the same shape.
+    gap : int
+        Number of pixels between tiles. It has to be at least the support of
+        filters and ROIs applied to the mosaic, so tiles don't bleed into each other.
+
+    Returns
+    -------
+    mosaic : ndarray
+        Tiles placed side by side.
+    """
+
+    blocks = [np.asarray(img[tile]) for tile in tiles]
+    tile_shape = blocks[0].shape
+    width = tile_shape[-1]
+    mosaic = np.zeros((*tile_shape[:-1], len(blocks) * (width + gap) - gap), dtype=blocks[0].dtype)
+    for i, block in enumerate(blocks):
+        start = i * (width + gap)
+        mosaic[..., start:start + width] = block
+    return mosaic
+
+
 def filter_nearby_peaks(coords, max_z, max_xy, weight_img=None,
-                        split_big_clust=False, cluster_size=None):
+                        split_big_clust=False, cluster_size=None,
+                        n_workers=None, tile_shape=None, tilt_vector=None):
     """
-    Merge nearby peaks in an image by building a radial distance graph and cutting it given
+    Merge nearby peaks in an image by building the graph of peaks closer than
     distance thresholds in the xy plane and along the z axis.
 
     Parameters
@@ -322,12 +925,24 @@ def filter_nearby_peaks(coords, max_z, max_xy, weight_img=None,
         Distance threshold in the xy plane.
     weight_img : ndarray
         Image used to find peaks, now used to weight peaks coordinates during merge.
+        It is interpolated at float coordinates, and can be a memory-mapped or dask array.
         If None, equal weight is given to peaks coordinates.
     split_big_clust : bool
         If True, cluster big enough to contain multiple objects of interest (like spots)
         are split into sub-clusters.
     cluster_size : list | array
         The threshold z and x/y size of clusters above which they are split.
+    n_workers : int, optional
+        If bigger than 1, peaks are partitioned in spatial tiles merged in parallel 
+        by a pool of processes. The result is the same as the serial merge.
+        Peaks are merged serially on Python 3.7, without shared memory.
+    tile_shape : float | array, optional
+        Size of tiles along each axis used when `n_workers` > 1. If None, the 
+        y axis is split in 4 slabs per worker.
+    tilt_vector : array, optional
+        If given, `coords` are skewed coordinates and peaks are merged given distances
+        along the normal axis and in the tilted plane, see `get_tilt_vector`.
+        Merged coordinates are skewed coordinates too.
     
     Returns
     -------
@@ -335,19 +950,18 @@ def filter_nearby_peaks(coords, max_z, max_xy, weight_img=None,
         The coordinates of merged peaks.
     """
 
-    # build the radial distance network using the bigest radius: max distance along z axis
-    pairs = ty.build_rdn(coords=coords, r=max_z)
-    source = coords[pairs[:, 0]]
-    target = coords[pairs[:, 1]]
-    # compute the 2 distances arrays
-    dist_z, dist_xy = compute_distances(source, target)
-    # perform grph cut from the 2 distance thresholds
-    _, pairs = cut_graph_bidistance(dist_z, dist_xy, max_z, max_xy, pairs=pairs)
+    if n_workers is not None and n_workers > 1 and shared_memory is not None:
+        return _filter_nearby_peaks_parallel(coords, max_z, max_xy, weight_img=weight_img,
+                                             split_big_clust=split_big_clust, 
+                                             cluster_size=cluster_size,
+                                             n_workers=n_workers, tile_shape=tile_shape,
+                                             tilt_vector=tilt_vector)
+
+    # build the network of peaks within the z / xy distance thresholds
+    pairs = find_close_pairs(coords, max_z, max_xy, tilt_vector=tilt_vector)
 
     if weight_img is not None:
-        # need ravel_multi_index to get pixel values of weight_img at several 3D coordinates
-        amplitudes_id = np.ravel_multi_index(coords.transpose(), weight_img.shape)
-        weights = weight_img.ravel()[amplitudes_id]
+        weights = sample_weights(weight_img, coords)
     else:
         weights = None  # array of ones will be generated in merge_cluster_nodes
     # merge nearby nodes coordinates
@@ -356,3 +970,276 @@ def filter_nearby_peaks(coords, max_z, max_xy, weight_img=None,
                                         cluster_size=cluster_size)
 
     return merged_coords
+
+
+def _plan_tiles(coords, halo, tile_shape, block_size=1_000_000):
+    """
+    Assign peaks to a grid of tiles.
+
+    Returns
+    -------
+    tiling : dict
+        Grid parameters, tile id of each peak, and peaks indices sorted by tile
+        with the start and end position of each non empty tile.
+    """
+
+    nb_nodes, nb_dims = coords.shape
+    tile_shape = np.broadcast_to(np.asarray(tile_shape, dtype=float), (nb_dims,))
+    if np.any(tile_shape < halo):
+        raise ValueError("`tile_shape` has to be at least `max_z` / `max_xy` along each axis")
+
+    # read peaks block by block to avoid big temporary arrays
+    origin = np.full(nb_dims, np.inf)
+    end = np.full(nb_dims, -np.inf)
+    for start in range(0, nb_nodes, block_size):
+        block = np.asarray(coords[start:start + block_size])
+        origin = np.minimum(origin, block.min(axis=0))
+        end = np.maximum(end, block.max(axis=0))
+    grid_shape = np.floor((end - origin) / tile_shape).astype(int) + 1
+    tile_ids = np.empty(nb_nodes, dtype=np.int64)
+    for start in range(0, nb_nodes, block_size):
+        block = np.asarray(coords[start:start + block_size])
+        tile_idx = np.floor((block - origin) / tile_shape).astype(int)
+        tile_ids[start:start + block_size] = np.ravel_multi_index(tile_idx.T, grid_shape)
+    order = np.argsort(tile_ids, kind='stable')
+    used_tiles, tiles_start = np.unique(tile_ids[order], return_index=True)
+    tiles_end = np.append(tiles_start[1:], nb_nodes)
+
+    tiling = {
+        'origin': origin,
+        'tile_shape': tile_shape,
+        'grid_shape': grid_shape,
+        'halo': halo,
+        'tile_ids': tile_ids,
+        'order': order,
+        'used_tiles': used_tiles,
+        'tiles_start': tiles_start,
+        'tiles_end': tiles_end,
+    }
+    return tiling
+
+
+def _get_tile_nodes(coords, tiling, tile_id):
+    """
+    Select peaks of a tile and of its halo.
+
+    Returns
+    -------
+    nodes : array
+        Sorted indices of peaks in the tile or in its halo.
+    is_core : array
+        Boolean filter of peaks in the tile.
+    """
+
+    used_tiles = tiling['used_tiles']
+    grid_shape = tiling['grid_shape']
+    # tiles touched by the halo of the tile
+    tile_idx = np.array(np.unravel_index(tile_id, grid_shape))
+    shifts = np.array(list(itertools.product([-1, 0, 1], repeat=len(grid_shape))))
+    neigh_idx = tile_idx + shifts
+    neigh_idx = neigh_idx[np.all((neigh_idx >= 0) & (neigh_idx < grid_shape), axis=1)]
+    neigh_ids = np.ravel_multi_index(neigh_idx.T, grid_shape)
+    pos = np.searchsorted(used_tiles, neigh_ids[np.isin(neigh_ids, used_tiles)])
+    # keep the global order of nodes to merge clusters in the same order
+    nodes = np.sort(np.concatenate(
+        [tiling['order'][tiling['tiles_start'][i]:tiling['tiles_end'][i]] for i in pos]))
+    tile_coords = np.asarray(coords[nodes])
+    lower = tiling['origin'] + tile_idx * tiling['tile_shape'] - tiling['halo']
+    upper = tiling['origin'] + (tile_idx + 1) * tiling['tile_shape'] + tiling['halo']
+    in_halo = np.all((tile_coords >= lower) & (tile_coords <= upper), axis=1)
+    nodes = nodes[in_halo]
+    is_core = tiling['tile_ids'][nodes] == tile_id
+    return nodes, is_core
+
+
+def _merge_tile_nodes(tile_coords, is_core, weights, max_z, max_xy,
+                      split_big_clust=False, cluster_size=None):
+    """
+    Merge clusters of peaks of a tile, clusters reaching the halo are not merged.
+
+    Returns
+    -------
+    merged_coords : ndarray
+        The coordinates of merged clusters lying in the tile.
+    first_nodes : array
+        Local index of the first node of these clusters.
+    is_crossing : array
+        Boolean filter of nodes whose cluster reaches the halo.
+    """
+
+    pairs = find_close_pairs(tile_coords, max_z, max_xy)
+    labels, nb_clusters = label_clusters(pairs, len(tile_coords))
+    is_crossing = np.zeros(nb_clusters, dtype=bool)
+    is_crossing[labels[~is_core]] = True
+    if np.all(is_crossing):
+        return np.empty((0, tile_coords.shape[1])), np.empty(0, dtype=int), is_crossing[labels]
+    merged_coords = merge_cluster_nodes(tile_coords, pairs, weights,
+                                        split_big_clust=split_big_clust, 
+                                        cluster_size=cluster_size)
+    _, first_nodes = np.unique(labels, return_index=True)
+    return merged_coords[~is_crossing], first_nodes[~is_crossing], is_crossing[labels]
+
+
+def filter_nearby_peaks_tiled(coords, max_z, max_xy, tile_shape, weight_img=None,
+                              split_big_clust=False, cluster_size=None, block_size=1_000_000):
+    """
+    Merge nearby peaks tile by tile, yielding merged coordinates as they are computed.
+
+    Peaks of each tile are merged together with peaks in a halo of `max_z` and `max_xy`
+    around the tile. Clusters lying entirely in the tile are yielded, clusters reaching 
+    the halo cross the tile border and their peaks are set aside to be merged 
+    together after all tiles are processed. The merged coordinates are the same 
+    as the ones of `filter_nearby_peaks`, but in a different order.
+    Graphs and weights are only built for one tile at a time, so `coords` and `weight_img`
+    can be memory-mapped arrays.
+
+    Parameters
+    ----------
+    coords : ndarray
+        Coordinates of nodes, array of shape nb_nodes x 3.
+    max_z : float
+        Distance threshold along the z axis.
+    max_xy : float
+        Distance threshold in the xy plane.
+    tile_shape : float | array
+        Size of tiles along each axis, they have to be bigger than the halo.
+    weight_img : ndarray
+        Image used to find peaks, now used to weight peaks coordinates during merge.
+        It is interpolated at float coordinates, and can be a memory-mapped or dask array.
+        If None, equal weight is given to peaks coordinates.
+    split_big_clust : bool
+        If True, cluster big enough to contain multiple objects of interest (like spots)
+        are split into sub-clusters.
+    cluster_size : list | array
+        The threshold z and x/y size of clusters above which they are split.
+    block_size : int
+        Number of peaks read at once when assigning peaks to tiles.
+    
+    Yields
+    ------
+    merged_coords : ndarray
+        The coordinates of merged peaks of a tile, and finally of clusters crossing tiles.
+    """
+
+    nb_nodes, nb_dims = coords.shape
+    if nb_nodes == 0:
+        return
+    halo = np.full(nb_dims, float(max_xy))
+    halo[0] = max_z
+    tiling = _plan_tiles(coords, halo, tile_shape, block_size=block_size)
+
+    crossing_nodes = []
+    for tile_id in tiling['used_tiles']:
+        nodes, is_core = _get_tile_nodes(coords, tiling, tile_id)
+        tile_coords = np.asarray(coords[nodes])
+        if weight_img is not None:
+            weights = sample_weights(weight_img, tile_coords)
+        else:
+            weights = None
+        merged_coords, _, is_crossing = _merge_tile_nodes(
+            tile_coords, is_core, weights, max_z, max_xy,
+            split_big_clust=split_big_clust, cluster_size=cluster_size)
+        # clusters reaching the halo are merged after all tiles
+        crossing_nodes.append(nodes[is_core & is_crossing])
+        if len(merged_coords) > 0:
+            yield merged_coords
+
+    # stitch clusters crossing tiles borders
+    crossing_nodes = np.sort(np.concatenate(crossing_nodes))
+    if len(crossing_nodes) > 0:
+        yield filter_nearby_peaks(np.asarray(coords[crossing_nodes]), max_z, max_xy, 
+                                  weight_img=weight_img, split_big_clust=split_big_clust, 
+                                  cluster_size=cluster_size)
+
+
+def _merge_tile_shared(shared_arrays, nodes, is_core, max_z, max_xy,
+                       split_big_clust, cluster_size):
+    """
+    Merge clusters of a tile from coordinates and weights in shared memory,
+    run by the workers of `_filter_nearby_peaks_parallel`.
+    """
+
+    buffers = [shared_memory.SharedMemory(name=name) for name, _, _ in shared_arrays]
+    try:
+        coords, weights = [np.ndarray(shape, dtype=dtype, buffer=buffer.buf) 
+                           for buffer, (_, shape, dtype) in zip(buffers, shared_arrays)]
+        tile_coords = coords[nodes]
+        tile_weights = weights[nodes]
+        del coords, weights
+    finally:
+        for buffer in buffers:
+            buffer.close()
+    merged_coords, first_nodes, is_crossing = _merge_tile_nodes(
+        tile_coords, is_core, tile_weights, max_z, max_xy,
+        split_big_clust=split_big_clust, cluster_size=cluster_size)
+    return merged_coords, nodes[first_nodes], nodes[is_core & is_crossing]
+
+
+def _filter_nearby_peaks_parallel(coords, max_z, max_xy, weight_img=None,
+                                  split_big_clust=False, cluster_size=None,
+                                  n_workers=2, tile_shape=None, tilt_vector=None):
+    """
+    Merge nearby peaks with tiles processed by a pool of processes.
+    Coordinates and weights are shared with workers without copy, and merged
+    clusters are sorted by their first node to give the same result as the serial merge.
+    """
+
+    coords = np.asarray(coords)
+    if len(coords) == 0:
+        return np.empty(coords.shape, dtype=float)
+    if weight_img is not None:
+        weights = sample_weights(weight_img, coords).astype(float)
+    else:
+        weights = np.ones(len(coords))
+    if tilt_vector is not None:
+        # tiles are made in the frame of the tilted plane
+        coords = tilted_frame_coords(coords, tilt_vector)
+    nb_nodes, nb_dims = coords.shape
+    halo = np.full(nb_dims, float(max_xy))
+    halo[0] = max_z
+    if tile_shape is None:
+        # slabs along y, as thin as 4 slabs per worker
+        # tiles are at least as big as the halo, even if peaks are in a single plane
+        span = np.maximum(np.ptp(coords, axis=0) + 1, halo)
+        tile_shape = span.astype(float)
+        tile_shape[1] = max(span[1] / (4 * n_workers), halo[1])
+    tiling = _plan_tiles(coords, halo, tile_shape)
+
+    buffers = []
+    shared_arrays = []
+    try:
+        for arr in [coords, weights]:
+            buffer = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            buffers.append(buffer)
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=buffer.buf)[:] = arr
+            shared_arrays.append((buffer.name, arr.shape, arr.dtype))
+        tiles = [_get_tile_nodes(coords, tiling, tile_id) for tile_id in tiling['used_tiles']]
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_merge_tile_shared, shared_arrays, nodes, is_core, 
+                                       max_z, max_xy, split_big_clust, cluster_size)
+                       for nodes, is_core in tiles]
+            results = [future.result() for future in futures]
+    finally:
+        for buffer in buffers:
+            buffer.close()
+            buffer.unlink()
+
+    merged_coords = [res[0] for res in results]
+    first_nodes = [res[1] for res in results]
+    # stitch clusters crossing tiles borders
+    crossing_nodes = np.sort(np.concatenate([res[2] for res in results]))
+    if len(crossing_nodes) > 0:
+        pairs = find_close_pairs(coords[crossing_nodes], max_z, max_xy)
+        labels, _ = label_clusters(pairs, len(crossing_nodes))
+        _, first_crossing = np.unique(labels, return_index=True)
+        merged_coords.append(merge_cluster_nodes(coords[crossing_nodes], pairs, 
+                                                 weights[crossing_nodes],
+                                                 split_big_clust=split_big_clust, 
+                                                 cluster_size=cluster_size))
+        first_nodes.append(crossing_nodes[first_crossing])
+    # deterministic order, the one of the serial merge
+    order = np.argsort(np.concatenate(first_nodes), kind='stable')
+    merged_coords = np.vstack(merged_coords)[order]
+    if tilt_vector is not None:
+        merged_coords = tilted_frame_coords(merged_coords, tilt_vector, inverse=True)
+    return merged_coords
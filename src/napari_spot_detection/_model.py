@@ -0,0 +1,302 @@
+"""
+CPU steps of the spot localization model, for nodes without the GPU stack.
+
+The steps read their parameters from, and write their outputs to, a model
+with the attributes of the `SPOTS3D` model of opm-merfish-analysis: either
+a `SPOTS3D` instance, or a `SpotModel` when `SPOTS3D` is not installed.
+Steps are generators yielding `(step, nb_steps)` after each chunk of data,
+so the widget reports their progress and cancels them between chunks, and
+the `run_*` functions run them to the end.
+"""
+
+import os
+
+import numpy as np
+
+from ._chunking import DEFAULT_MEMORY_BUDGET, FIT_BATCH_SIZE, plan_fit_batches, exhaust
+from ._deconvolution import deconvolve_chunks
+from ._dog import get_dog_sigmas, dog_filter_chunks
+from ._filtering import SpotFilter
+from ._gaussian_fit import fit_candidates_batches, get_roi_half_sizes
+from ._image_processing import (
+    find_local_maxima,
+    find_close_pairs,
+    merge_cluster_nodes,
+    sample_weights,
+    get_deskew_affine,
+)
+
+
+def import_spots3d():
+    """
+    Import the `SPOTS3D` model class, or return None if it's not installed.
+    """
+
+    try:
+        # GPU stack of opm-merfish-analysis, imported here so the CPU steps run without it
+        from SPOTS3D import SPOTS3D
+    except ImportError:
+        return None
+    return SPOTS3D
+
+
+def get_model_affine(model):
+    """
+    Affine transform from pixel indices of the model image to physical coordinates.
+    """
+
+    pixel_size = model._image_params['pixel_size']
+    scan_step = model._image_params['scan_step']
+    theta = model._image_params['theta']
+    if theta > 0:
+        return get_deskew_affine(pixel_size, scan_step, theta)
+    return np.diag([scan_step, pixel_size, pixel_size, 1.])
+
+
+def _get_dog_source(model):
+    if model.dog_filter_source_data == 'decon':
+        return model._decon_data
+    return model.data
+
+
+def iter_deconvolution(model, n_workers=None):
+    """
+    Deconvolve the model image with the CPU engine.
+    """
+
+    model._decon_data = yield from deconvolve_chunks(
+        model.data,
+        model.psf,
+        iterations=model.decon_params['iterations'],
+        tv_tau=model.decon_params['tv_tau'],
+        chunk_size=model.scan_chunk_size,
+        n_workers=n_workers,
+        )
+
+
+def iter_dog_filter(model, n_workers=None):
+    """
+    Apply the DoG filter on the raw or deconvolved model image with the CPU engine.
+    """
+
+    sigmas_small, sigmas_large = get_dog_sigmas(
+        model.DoG_filter_params,
+        sigma_z=model._sigma_z,
+        sigma_xy=model._sigma_xy,
+        spacing=[model._image_params['scan_step'],
+                 model._image_params['pixel_size'],
+                 model._image_params['pixel_size']],
+        )
+    model._dog_data = yield from dog_filter_chunks(
+        _get_dog_source(model), sigmas_small, sigmas_large,
+        chunk_size=model.scan_chunk_size, n_workers=n_workers)
+
+
+def iter_find_candidates(model):
+    """
+    Find local maxima of the DoG above the threshold and merge those closer
+    than the minimum spot sizes, with the CPU engine.
+
+    Candidates are sorted by decreasing DoG value, their columns are the
+    physical coordinates z, y, x and the DoG value.
+    """
+
+    params = model.find_candidates_params
+    coords, values = find_local_maxima(model._dog_data, min_value=params['threshold'])
+    yield 1, 2
+    affine = get_model_affine(model)
+    centers = coords @ affine[:3, :3].T + affine[:3, 3]
+    if len(centers) > 0:
+        pairs = find_close_pairs(centers, max_z=params['min_spot_z'] * model._sigma_z,
+                                 max_xy=params['min_spot_xy'] * model._sigma_xy)
+        centers = merge_cluster_nodes(centers, pairs, weights=values)
+    # DoG values at merged centers
+    inv_affine = np.linalg.inv(affine)
+    amps = sample_weights(model._dog_data, centers @ inv_affine[:3, :3].T + inv_affine[:3, 3])
+    order = np.argsort(-amps, kind='stable')
+    model._amps = amps[order]
+    model._spot_candidates = np.column_stack([centers[order], model._amps])
+    yield 2, 2
+
+
+def get_fit_candidates(model):
+    """
+    Centers of the candidates fitted by the model, the `n_spots_to_fit` brightest ones.
+    """
+
+    n_spots_to_fit = model.fit_candidate_spots_params.get('n_spots_to_fit')
+    return model._spot_candidates[:n_spots_to_fit, :3]
+
+
+def plan_fit(model, memory_budget=DEFAULT_MEMORY_BUDGET, n_workers=None):
+    """
+    Plan batches of gaussian fits of the model candidates from a memory budget,
+    see `plan_fit_batches`.
+    """
+
+    params = model.fit_candidate_spots_params
+    half_sizes = get_roi_half_sizes(
+        get_model_affine(model), model._sigma_xy, model._sigma_z,
+        (params['roi_z_factor'], params['roi_y_factor'], params['roi_x_factor']))
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    return plan_fit_batches(len(get_fit_candidates(model)), 2 * half_sizes + 1,
+                            memory_budget=memory_budget, n_workers=n_workers)
+
+
+def iter_fit_candidates(model, batch_size=FIT_BATCH_SIZE, n_workers=None):
+    """
+    Fit 3D gaussians on candidate spots of the model with the CPU engine.
+    """
+
+    params = model.fit_candidate_spots_params
+    model._fit_params, model._chi_sqrs = yield from fit_candidates_batches(
+        model.data,
+        get_fit_candidates(model),
+        get_model_affine(model),
+        sigma_xy=model._sigma_xy,
+        sigma_z=model._sigma_z,
+        roi_factors=(params['roi_z_factor'], params['roi_y_factor'], params['roi_x_factor']),
+        batch_size=batch_size,
+        n_workers=n_workers,
+        )
+
+
+def iter_filter_spots(model):
+    """
+    Select fitted spots with the filtering conditions of `SpotFilter`, with the CPU engine.
+    """
+
+    params = model.spot_filter_params
+    fit_params = model._fit_params
+    sigma_xy = model._sigma_xy
+    sigma_z = model._sigma_z
+    centers = fit_params[:, 3:0:-1]
+    centers_guess = model._spot_candidates[:len(fit_params), :3]
+    dist_fit_xy = np.sqrt((centers_guess[:, 1] - centers[:, 1])**2 +
+                          (centers_guess[:, 2] - centers[:, 2])**2)
+    dist_fit_z = np.abs(centers_guess[:, 0] - centers[:, 0])
+    roi_factors = model.fit_candidate_spots_params
+    spot_filter = SpotFilter(
+        centers,
+        fit_params[:, 0],
+        fit_params[:, 4] / sigma_xy,
+        fit_params[:, 5] / sigma_z,
+        dist_fit_xy / sigma_xy,
+        dist_fit_z / sigma_z,
+        sigma_xy=sigma_xy,
+        sigma_z=sigma_z,
+        roi_xy_factor=max(roi_factors['roi_y_factor'], roi_factors['roi_x_factor']),
+        roi_z_factor=roi_factors['roi_z_factor'],
+        max_sep_xy_factor=params['min_spot_sep_xy_factor'],
+        max_sep_z_factor=params['min_spot_sep_z_factor'],
+        )
+    yield from spot_filter.iter_update(params)
+    model._to_keep = spot_filter.to_keep
+    model._conditions = spot_filter.conditions
+    model._condition_names = spot_filter.condition_names
+    # separations in physical units, like the SPOTS3D model
+    model._spot_filter_params = {
+        **params,
+        'min_spot_sep': (params['min_spot_sep_z_factor'] * sigma_z,
+                         params['min_spot_sep_xy_factor'] * sigma_xy),
+    }
+
+
+def run_deconvolution(model, n_workers=None):
+    exhaust(iter_deconvolution(model, n_workers=n_workers))
+
+
+def run_dog_filter(model, n_workers=None):
+    exhaust(iter_dog_filter(model, n_workers=n_workers))
+
+
+def run_find_candidates(model):
+    exhaust(iter_find_candidates(model))
+
+
+def run_fit_candidates(model, batch_size=FIT_BATCH_SIZE, n_workers=None):
+    exhaust(iter_fit_candidates(model, batch_size=batch_size, n_workers=n_workers))
+
+
+def run_filter_spots(model):
+    exhaust(iter_filter_spots(model))
+
+
+class SpotModel:
+    """
+    Spot localization model running all its steps on CPU, with the parameters
+    and outputs of the `SPOTS3D` model used by the widget and the batch processing.
+
+    Parameters
+    ----------
+    data : ndarray
+        3D image, it can be a memory-mapped or a dask array.
+    psf : ndarray
+        Point spread function.
+    metadata : dict
+        'pixel_size', 'scan_step' and 'wvl' (µm).
+    microscope_params : dict
+        'na', 'ri' and 'theta' (degrees).
+    n_workers : int, optional
+        Number of threads of steps, all CPUs by default.
+    """
+
+    def __init__(self, data, psf, metadata, microscope_params, n_workers=None):
+        self.data = data
+        self.psf = psf
+        self.metadata = metadata
+        self.microscope_params = microscope_params
+        self.n_workers = n_workers
+        self._image_params = {
+            'pixel_size': metadata['pixel_size'],
+            'scan_step': metadata['scan_step'],
+            'theta': microscope_params['theta'],
+        }
+        # gaussian approximations of the PSF widths
+        na = microscope_params['na']
+        wvl = metadata['wvl']
+        self._sigma_xy = 0.22 * wvl / na
+        self._sigma_z = np.sqrt(6) / np.pi * microscope_params['ri'] * wvl / na**2
+
+        self.scan_chunk_size = 128
+        self.decon_params = None
+        self.dog_filter_source_data = 'raw'
+        self.DoG_filter_params = None
+        self.find_candidates_params = None
+        self.fit_candidate_spots_params = None
+        self.spot_filter_params = None
+
+        self._decon_data = None
+        self._dog_data = None
+        self._spot_candidates = None
+        self._amps = None
+        self._fit_params = None
+        self._chi_sqrs = None
+        self._to_keep = None
+        self._conditions = None
+        self._condition_names = None
+        self._spot_filter_params = None
+
+    @property
+    def decon_data(self):
+        return self._decon_data
+
+    @property
+    def dog_data(self):
+        return self._dog_data
+
+    def run_deconvolution(self):
+        run_deconvolution(self, n_workers=self.n_workers)
+
+    def run_DoG_filter(self):
+        run_dog_filter(self, n_workers=self.n_workers)
+
+    def run_find_candidates(self):
+        run_find_candidates(self)
+
+    def run_fit_candidates(self):
+        run_fit_candidates(self, n_workers=self.n_workers)
+
+    def run_filter_spots(self):
+        run_filter_spots(self)
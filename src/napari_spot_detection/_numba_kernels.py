@@ -0,0 +1,121 @@
+"""
+JIT-compiled kernels of the graph utilities of `_image_processing`.
+
+This module requires numba, `_image_processing` falls back to its NumPy
+implementations if it can't be imported.
+"""
+
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True)
+def _find_root(parent, node):
+    # path halving
+    while parent[node] != node:
+        parent[node] = parent[parent[node]]
+        node = parent[node]
+    return node
+
+
+@njit(cache=True)
+def label_clusters_kernel(pairs, nb_nodes):
+    """
+    Label connected clusters with a union-find, clusters are numbered
+    by increasing smallest node index.
+    """
+    parent = np.arange(nb_nodes)
+    for i in range(pairs.shape[0]):
+        root_a = _find_root(parent, pairs[i, 0])
+        root_b = _find_root(parent, pairs[i, 1])
+        if root_a < root_b:
+            parent[root_b] = root_a
+        elif root_b < root_a:
+            parent[root_a] = root_b
+    labels = np.empty(nb_nodes, dtype=np.int32)
+    root_labels = np.full(nb_nodes, -1, dtype=np.int32)
+    nb_clusters = 0
+    for node in range(nb_nodes):
+        root = _find_root(parent, node)
+        if root_labels[root] == -1:
+            root_labels[root] = nb_clusters
+            nb_clusters += 1
+        labels[node] = root_labels[root]
+    return labels, nb_clusters
+
+
+@njit(cache=True)
+def weighted_centroids_kernel(coords, weights, labels, nb_clusters):
+    """
+    Weighted average of coordinates of nodes in each cluster, 
+    isolated nodes keep their exact coordinates.
+    """
+    nb_dims = coords.shape[1]
+    sums = np.zeros((nb_clusters, nb_dims))
+    tot_weight = np.zeros(nb_clusters)
+    sizes = np.zeros(nb_clusters, dtype=np.int64)
+    first_nodes = np.empty(nb_clusters, dtype=np.int64)
+    for node in range(len(labels)):
+        label = labels[node]
+        if sizes[label] == 0:
+            first_nodes[label] = node
+        sizes[label] += 1
+        tot_weight[label] += weights[node]
+        for dim in range(nb_dims):
+            sums[label, dim] += coords[node, dim] * weights[node]
+    for label in range(nb_clusters):
+        for dim in range(nb_dims):
+            if sizes[label] == 1:
+                sums[label, dim] = coords[first_nodes[label], dim]
+            else:
+                sums[label, dim] /= tot_weight[label]
+    return sums
+
+
+@njit(cache=True)
+def gather_neighbors_kernel(offsets, neighbors, nodes):
+    """
+    Concatenate neighbors of several nodes from a CSR adjacency index.
+    """
+    nb_nodes = len(offsets) - 1
+    count = 0
+    for node in nodes:
+        if node < nb_nodes:
+            count += offsets[node + 1] - offsets[node]
+    neigh = np.empty(count, dtype=neighbors.dtype)
+    pos = 0
+    for node in nodes:
+        if node < nb_nodes:
+            for i in range(offsets[node], offsets[node + 1]):
+                neigh[pos] = neighbors[i]
+                pos += 1
+    return neigh
+
+
+@njit(cache=True)
+def bfs_kernel(offsets, neighbors, n, order):
+    """
+    Breadth-first search of neighbors of a node up to a given order.
+    Returns detected nodes and their order, in order of detection.
+    """
+    nb_nodes = len(offsets) - 1
+    visited = {n: 0}
+    nodes = [n]
+    orders = [0]
+    start = 0
+    for k in range(order):
+        stop = len(nodes)
+        if stop == start:
+            break
+        for i in range(start, stop):
+            node = nodes[i]
+            if node >= nb_nodes:
+                continue
+            for j in range(offsets[node], offsets[node + 1]):
+                neigh = neighbors[j]
+                if neigh not in visited:
+                    visited[neigh] = k + 1
+                    nodes.append(neigh)
+                    orders.append(k + 1)
+        start = stop
+    return np.array(nodes), np.array(orders)
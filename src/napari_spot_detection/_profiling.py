@@ -0,0 +1,156 @@
+"""
+Instrumentation of pipeline stages: time, memory, data sizes and throughput,
+to size compute nodes and find performance regressions.
+"""
+
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+from pathlib import Path
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+def get_peak_rss():
+    """
+    Peak resident memory of the process since it started, in bytes, or None
+    if it can't be measured on this platform.
+    """
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def get_path_size(path):
+    """
+    Size in bytes of a file, or of all files of a directory like a Zarr store.
+    """
+
+    path = Path(path)
+    if path.is_dir():
+        return sum(file.stat().st_size for file in path.rglob('*') if file.is_file())
+    return path.stat().st_size
+
+
+class StageProfiler:
+    """
+    Record measurements of pipeline stages.
+
+    Each stage run is recorded with its wall time, CPU time of the process
+    (all threads), peak resident memory and, when the stage reports them,
+    input and output sizes from which throughputs are computed.
+
+    Parameters
+    ----------
+    dir_profiles : str | Path, optional
+        If given, stages are also profiled with cProfile and their statistics
+        are saved in this directory, to be opened with pstats or snakeviz.
+
+    Example
+    -------
+    >>> profiler = StageProfiler()
+    >>> with profiler.profile('DoG filter') as record:
+    ...     dog = dog_filter(img, sigmas_small, sigmas_large)
+    ...     record.update(nb_voxels=img.size, input_bytes=img.nbytes, output_bytes=dog.nbytes)
+    >>> profiler.to_json('profiling.json')
+    """
+
+    def __init__(self, dir_profiles=None):
+        self.dir_profiles = dir_profiles
+        self.records = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def profile(self, stage):
+        """
+        Measure a stage run in a `with` block.
+
+        The yielded record can be updated in the block with 'input_bytes',
+        'output_bytes', 'nb_voxels' and 'nb_spots'. Its 'status' is 'done',
+        'failed' or 'cancelled'.
+        """
+
+        record = {'stage': stage, 'start': time.time()}
+        profiler = None
+        if self.dir_profiles is not None:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # only one profiler can be active at a time, like in parallel stages
+                profiler = None
+        peak_rss = get_peak_rss()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield record
+            record['status'] = 'done'
+        except GeneratorExit:
+            record['status'] = 'cancelled'
+            raise
+        except BaseException:
+            record['status'] = 'failed'
+            raise
+        finally:
+            record['wall_time'] = time.perf_counter() - wall
+            record['cpu_time'] = time.process_time() - cpu
+            if peak_rss is not None:
+                record['peak_rss'] = get_peak_rss()
+                # the peak only grows, so 0 means the stage fitted in already used memory
+                record['peak_rss_increase'] = record['peak_rss'] - peak_rss
+            if record['wall_time'] > 0:
+                if 'nb_voxels' in record:
+                    record['voxels_per_s'] = record['nb_voxels'] / record['wall_time']
+                if 'nb_spots' in record:
+                    record['spots_per_s'] = record['nb_spots'] / record['wall_time']
+            with self._lock:
+                if profiler is not None:
+                    profiler.disable()
+                    Path(self.dir_profiles).mkdir(parents=True, exist_ok=True)
+                    path_stats = Path(self.dir_profiles) / f"{stage.replace(' ', '_')}_{len(self.records)}.prof"
+                    profiler.dump_stats(path_stats)
+                    record['profile'] = str(path_stats)
+                self.records.append(record)
+
+    def summary(self):
+        """
+        Total wall time, CPU time and number of runs of each stage.
+        """
+
+        summary = {}
+        with self._lock:
+            for record in self.records:
+                stage = summary.setdefault(record['stage'], {'runs': 0, 'wall_time': 0, 'cpu_time': 0})
+                stage['runs'] += 1
+                stage['wall_time'] += record['wall_time']
+                stage['cpu_time'] += record['cpu_time']
+        return summary
+
+    def to_json(self, path):
+        """
+        Save records and their summary in a JSON file.
+        """
+
+        with self._lock:
+            records = list(self.records)
+        report = {
+            'cpu_count': os.cpu_count(),
+            'records': records,
+            'summary': self.summary(),
+        }
+        with open(path, "w") as write_file:
+            json.dump(report, write_file, indent=4, default=float)
+
+    def clear(self):
+        with self._lock:
+            self.records.clear()
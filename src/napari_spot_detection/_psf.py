@@ -0,0 +1,255 @@
+"""
+Point spread function generation, shared by the widget and the batch processing.
+
+Generated PSFs are cached on disk, keyed by the optical parameters, so they
+are computed once per microscope setting.
+"""
+
+import argparse
+from collections import OrderedDict
+import itertools
+import json
+import os
+from pathlib import Path
+import sys
+import threading
+
+import numpy as np
+
+from ._cache import make_key
+
+
+DEFAULT_DIR_PSF = Path(os.environ.get(
+    'NAPARI_SPOT_DETECTION_PSF_DIR', Path.home() / '.cache' / 'napari-spot-detection' / 'psf'))
+
+
+def make_psf(na, ri, wvl, dc, dstage, theta, oversampling=10, nb_pixels=(15, 150, 150)):
+    """
+    Generate a PSF with a vectorial model on an oversampled grid, and bin it
+    to the camera pixel size.
+
+    Parameters
+    ----------
+    na : float
+        Numerical aperture.
+    ri : float
+        Refractive index.
+    wvl : float
+        Emission wavelength (µm).
+    dc : float
+        Pixel size (µm).
+    dstage : float
+        Frames spacing (µm).
+    theta : float
+        Angle of the tilted plane (radians), 0 for non skewed data.
+    oversampling : int
+        Oversampling of the grid in the xy plane.
+    nb_pixels : tuple
+        Number of pixels of the oversampled grid along z, y and x.
+
+    Returns
+    -------
+    psf : ndarray
+        The binned PSF.
+    """
+
+    # imported here so that cached PSFs are loaded without the PSF model
+    from localize_psf import fit_psf, camera
+
+    psf_model = fit_psf.gridded_psf_model(
+        wavelength=wvl,
+        ni=ri,
+        model_name="vectorial",
+        dc=dc / oversampling,
+        sf=1,
+        # /!\ check about theta's position!
+        angles=(0., 0., theta),  # in radians
+    )
+    # p: ["A", "cx", "cy", "cz", "na", "bg"]
+    # "amplitude", "x-coordinate center", "y-coordinate center", "z-coordinate center", "numerical aperture", and "background"
+    p = [1, 0, 0, 0, na, 0]
+    coords = fit_psf.get_psf_coords(ns=list(nb_pixels), # number of pixels
+                                    drs=[dstage, dc / oversampling, dc / oversampling])
+    psf = psf_model.model(coords, p)
+    # resample image by binning
+    bin_size_list = (1,) * (psf.ndim - 2) + (oversampling, oversampling)
+    psf = camera.bin(psf, bin_size_list, mode='sum')
+    return psf
+
+
+def get_psf_params(na, ri, wvl, dc, dstage, theta, oversampling=10, nb_pixels=(15, 150, 150)):
+    """
+    Gather the parameters of `make_psf` in a dictionary identifying a PSF.
+    """
+
+    # rounding avoids different keys for values parsed from text or computed
+    params = {
+        'na': round(float(na), 9),
+        'ri': round(float(ri), 9),
+        'wvl': round(float(wvl), 9),
+        'dc': round(float(dc), 9),
+        'dstage': round(float(dstage), 9),
+        'theta': round(float(theta), 9),
+        'oversampling': int(oversampling),
+        'nb_pixels': [int(size) for size in nb_pixels],
+    }
+    return params
+
+
+class PSFCache:
+    """
+    Cache of generated PSFs, in compressed files keyed by optical parameters.
+
+    Recently used PSFs are also kept in memory. Files are written under a
+    temporary name and renamed, so processes can share a cache directory.
+
+    Parameters
+    ----------
+    dir_cache : str | Path
+        Directory of cached PSFs.
+    max_items : int
+        Maximum number of PSFs kept in memory.
+    """
+
+    def __init__(self, dir_cache=DEFAULT_DIR_PSF, max_items=16):
+        self.dir_cache = Path(dir_cache)
+        self.max_items = max_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_path(self, key):
+        return self.dir_cache / (key + '.npz')
+
+    def get(self, params):
+        """
+        Get a cached PSF from its parameters, or None if it's not cached.
+        """
+
+        key = make_key('psf', params)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        path = self._get_path(key)
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            psf = data['psf']
+        self._put_memory(key, psf)
+        return psf
+
+    def put(self, params, psf):
+        """
+        Cache a PSF generated with given parameters.
+        """
+
+        key = make_key('psf', params)
+        psf = np.asarray(psf)
+        self._put_memory(key, psf)
+        self.dir_cache.mkdir(parents=True, exist_ok=True)
+        path = self._get_path(key)
+        path_tmp = path.with_name(f"tmp_{os.getpid()}_{threading.get_ident()}_{path.name}")
+        np.savez_compressed(path_tmp, psf=psf, params=json.dumps(params))
+        os.replace(path_tmp, path)
+
+    def _put_memory(self, key, psf):
+        with self._lock:
+            self._memory[key] = psf
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_items:
+                self._memory.popitem(last=False)
+
+    def clear(self, disk=False):
+        """
+        Empty the memory cache, and the cache directory if `disk` is True.
+        """
+
+        with self._lock:
+            self._memory.clear()
+        if disk and self.dir_cache.exists():
+            for path in self.dir_cache.glob('psf-*.npz'):
+                path.unlink()
+
+
+def get_psf(na, ri, wvl, dc, dstage, theta, oversampling=10, nb_pixels=(15, 150, 150), cache=None):
+    """
+    Get a PSF from the cache, or generate it with `make_psf` and cache it.
+
+    Parameters
+    ----------
+    na, ri, wvl, dc, dstage, theta, oversampling, nb_pixels
+        Parameters of `make_psf`.
+    cache : PSFCache, optional
+        Cache of PSFs, one in the default directory if not given.
+
+    Returns
+    -------
+    psf : ndarray
+        The binned PSF.
+    """
+
+    if cache is None:
+        cache = PSFCache()
+    params = get_psf_params(na, ri, wvl, dc, dstage, theta, oversampling, nb_pixels)
+    psf = cache.get(params)
+    if psf is None:
+        psf = make_psf(**params)
+        cache.put(params, psf)
+    return psf
+
+
+def precompute_psf_library(settings, cache=None):
+    """
+    Generate and cache the PSFs of all combinations of standard settings of a microscope.
+
+    Parameters
+    ----------
+    settings : dict
+        Parameters of `make_psf`, each one being a value or a list of values,
+        like {'na': 1.35, 'ri': 1.4, 'wvl': [0.52, 0.58, 0.67], 'dc': 0.115,
+        'dstage': 0.4, 'theta': 30}. As in detection parameters, theta is
+        in degrees.
+    cache : PSFCache, optional
+        Cache of PSFs, one in the default directory if not given.
+
+    Returns
+    -------
+    library : list
+        Parameters of PSFs of the library.
+    """
+
+    if cache is None:
+        cache = PSFCache()
+    names = list(settings.keys())
+    values = [value if isinstance(value, list) and name != 'nb_pixels' else [value]
+              for name, value in settings.items()]
+    # nb_pixels is a list itself, several grids are given as a list of lists
+    if 'nb_pixels' in settings and isinstance(settings['nb_pixels'][0], (list, tuple)):
+        values[names.index('nb_pixels')] = settings['nb_pixels']
+    library = []
+    for combination in itertools.product(*values):
+        params = dict(zip(names, combination))
+        # converted like the widget does, so that keys of the library match
+        params['theta'] = params['theta'] / 180 * np.pi
+        get_psf(**params, cache=cache)
+        library.append(get_psf_params(**params))
+    return library
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Precompute the PSFs of standard settings of a microscope.")
+    parser.add_argument('settings', help="JSON file of PSF parameters, values or lists of values, theta in degrees")
+    parser.add_argument('-d', '--dir-cache', default=str(DEFAULT_DIR_PSF),
+                        help="directory of cached PSFs")
+    args = parser.parse_args(argv)
+
+    with open(args.settings, "r") as read_file:
+        settings = json.load(read_file)
+    library = precompute_psf_library(settings, cache=PSFCache(args.dir_cache))
+    print(f"{len(library)} PSFs cached in {args.dir_cache}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""
+Export and import of tables of spots in CSV or binary columnar formats:
+Parquet, Feather (Arrow IPC) and Zarr.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+SPOTS_FORMATS = {
+    'parquet': '.parquet',
+    'feather': '.feather',
+    'zarr': '.zarr',
+    'csv': '.csv',
+}
+
+
+def get_spots_format(path):
+    """
+    Get the format of a table of spots from the extension of its path.
+    """
+
+    suffix = Path(str(path).rstrip('/\\')).suffix.lower()
+    for spots_format, ext in SPOTS_FORMATS.items():
+        if suffix == ext:
+            return spots_format
+    if suffix == '.arrow':
+        return 'feather'
+    raise ValueError(f"Unknown format of spots table {path}, "
+                     f"use one of the extensions {list(SPOTS_FORMATS.values())}")
+
+
+def _cast_column(values):
+    values = np.asarray(values)
+    # float32 precision is enough for fitted parameters and halves the file size
+    if values.dtype == np.float64:
+        values = values.astype(np.float32)
+    return values
+
+
+def _iter_chunks(columns, nb_spots, chunk_size, cast=True):
+    for start in range(0, max(nb_spots, 1), chunk_size):
+        chunk = {name: np.asarray(columns[name])[start:start + chunk_size] for name in columns}
+        if cast:
+            chunk = {name: _cast_column(values) for name, values in chunk.items()}
+        yield chunk
+
+
+def save_spots(path, columns, chunk_size=1_000_000, compression='zstd'):
+    """
+    Save a table of spots, the format is given by the extension of `path`.
+
+    Columns are written chunk by chunk, so no copy of the whole table is made.
+    Float64 columns are stored as float32 in binary formats.
+
+    Parameters
+    ----------
+    path : str | Path
+        Path of the table, with a '.parquet', '.feather', '.zarr' or '.csv' extension.
+    columns : dict | DataFrame
+        1D arrays of spots parameters of the same length, indexed by column names.
+    chunk_size : int
+        Number of spots written at once.
+    compression : str
+        Compression codec of Parquet and Feather files.
+    """
+
+    spots_format = get_spots_format(path)
+    path = str(path)
+    nb_spots = len(next(iter(columns.values()))) if isinstance(columns, dict) else len(columns)
+    chunks = _iter_chunks(columns, nb_spots, chunk_size, cast=spots_format != 'csv')
+
+    if spots_format in ['parquet', 'feather']:
+        import pyarrow as pa
+        first = pa.RecordBatch.from_pydict(next(chunks))
+        if spots_format == 'parquet':
+            import pyarrow.parquet as pq
+            writer = pq.ParquetWriter(path, first.schema, compression=compression)
+        else:
+            options = pa.ipc.IpcWriteOptions(compression=compression)
+            writer = pa.ipc.new_file(path, first.schema, options=options)
+        with writer:
+            writer.write_batch(first)
+            for chunk in chunks:
+                writer.write_batch(pa.RecordBatch.from_pydict(chunk, schema=first.schema))
+    elif spots_format == 'zarr':
+        import zarr
+        group = zarr.open_group(path, mode='w')
+        arrays = {}
+        start = 0
+        for chunk in chunks:
+            for name, values in chunk.items():
+                if name not in arrays:
+                    arrays[name] = group.zeros(name=name, shape=(nb_spots,), dtype=values.dtype,
+                                               chunks=(min(chunk_size, max(nb_spots, 1)),))
+                arrays[name][start:start + len(values)] = values
+            start += len(values)
+        group.attrs['columns'] = list(arrays.keys())
+    else:
+        for i, chunk in enumerate(chunks):
+            pd.DataFrame(chunk).to_csv(path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+
+
+def load_spots(path, columns=None):
+    """
+    Load a table of spots saved by `save_spots`.
+
+    Parquet and Feather files are memory-mapped, and only the requested
+    columns are read.
+
+    Parameters
+    ----------
+    path : str | Path
+        Path of the table.
+    columns : list, optional
+        Names of columns to load, all columns by default.
+
+    Returns
+    -------
+    spots : dict
+        1D arrays of spots parameters indexed by column names.
+    """
+
+    spots_format = get_spots_format(path)
+    path = str(path)
+    if spots_format == 'parquet':
+        import pyarrow.parquet as pq
+        table = pq.read_table(path, columns=columns, memory_map=True)
+    elif spots_format == 'feather':
+        import pyarrow.feather as feather
+        table = feather.read_table(path, columns=columns, memory_map=True)
+    elif spots_format == 'zarr':
+        import zarr
+        group = zarr.open_group(path, mode='r')
+        names = columns if columns is not None else group.attrs['columns']
+        return {name: group[name][...] for name in names}
+    else:
+        df_spots = pd.read_csv(path, usecols=columns)
+        return {name: df_spots[name].to_numpy() for name in df_spots.columns}
+    return {name: table[name].to_numpy() for name in table.column_names}
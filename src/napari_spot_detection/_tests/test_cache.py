@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+from napari_spot_detection._cache import StageCache, fingerprint_array, make_key
+
+
+def test_fingerprint_array():
+    rng = np.random.default_rng(0)
+    img = rng.random((20, 30, 40))
+    assert fingerprint_array(img) == fingerprint_array(img.copy())
+    modified = img.copy()
+    modified[0, 0, 0] += 1
+    assert fingerprint_array(img) != fingerprint_array(modified)
+    assert fingerprint_array(img) != fingerprint_array(img.astype(np.float32))
+    # arrays are hashed by blocks, without skipping any value
+    assert fingerprint_array(img, block_bytes=1000) == fingerprint_array(img)
+    assert fingerprint_array(img, block_bytes=1000) != fingerprint_array(modified, block_bytes=1000)
+    modified = img.copy()
+    modified[11, 17, 23] += 1e-9
+    assert fingerprint_array(img) != fingerprint_array(modified)
+    da = pytest.importorskip('dask.array')
+    assert fingerprint_array(da.from_array(img, chunks=5), block_bytes=1000) == fingerprint_array(img)
+
+
+def test_make_key():
+    key = make_key('dog', 'abc', {'sigma': 1, 'ratio': 2})
+    assert key.startswith('dog-')
+    assert key == make_key('dog', 'abc', {'ratio': 2, 'sigma': 1})
+    assert key != make_key('dog', 'abc', {'ratio': 2, 'sigma': 1.5})
+    assert key != make_key('fit', 'abc', {'ratio': 2, 'sigma': 1})
+
+
+def test_stage_cache_memory_eviction():
+    arr = np.zeros(100, dtype=np.float64)
+    cache = StageCache(max_bytes=2 * arr.nbytes)
+    cache.put('a', {'data': arr})
+    cache.put('b', {'data': arr + 1})
+    # access 'a' so 'b' becomes the least recently used
+    assert cache.get('a') is not None
+    cache.put('c', {'data': arr + 2})
+    assert cache.get('b') is None
+    np.testing.assert_array_equal(cache.get('a')['data'], arr)
+    np.testing.assert_array_equal(cache.get('c')['data'], arr + 2)
+    # values bigger than the budget are not kept
+    cache.put('d', {'data': np.zeros(1000)})
+    assert cache.get('d') is None
+
+
+def test_stage_cache_disk(tmp_path):
+    arr = np.arange(1000, dtype=np.float32)
+    cache = StageCache(max_bytes=0, dir_cache=tmp_path)
+    cache.put('a', {'data': arr, 'other': arr[:10]})
+    value = cache.get('a')
+    np.testing.assert_array_equal(value['data'], arr)
+    np.testing.assert_array_equal(value['other'], arr[:10])
+    # a new instance finds values of previous sessions
+    assert StageCache(dir_cache=tmp_path).get('a') is not None
+    cache.clear()
+    assert cache.get('a') is None
+
+
+def test_stage_cache_lazy_values(tmp_path):
+    da = pytest.importorskip('dask.array')
+    arr = np.arange(10_000, dtype=np.float32).reshape(100, 100)
+    lazy = da.from_array(arr, chunks=10)
+    cache = StageCache(max_bytes=1000, dir_cache=tmp_path)
+    cache.put('a', {'data': lazy, 'scalar': np.float32(2)})
+    # too big for the memory tier, the value is only written to disk
+    assert 'a' not in cache._memory
+    value = StageCache(dir_cache=tmp_path).get('a')
+    np.testing.assert_array_equal(value['data'], arr)
+    assert value['scalar'] == 2
+
+
+def test_stage_cache_disk_eviction(tmp_path):
+    rng = np.random.default_rng(0)
+    cache = StageCache(max_bytes=0, dir_cache=tmp_path, max_disk_bytes=10**6)
+    for i in range(5):
+        cache.put(f'k{i}', {'data': rng.random(50_000)})
+    kept = [cache.get(f'k{i}') is not None for i in range(5)]
+    # oldest values are evicted first
+    assert kept[-1]
+    assert not kept[0]
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from napari_spot_detection._chunking import (get_stage_footprint, plan_chunks, plan_fit_batches, format_plan,
+                                              map_chunks, exhaust,
+                                              GPU_MAX_CHUNK_SIZE, FIT_VOXEL_BYTES, FIT_BATCH_SIZE, FIT_MIN_BATCH_SIZE)
+
+
+def test_stage_footprint():
+    plane_bytes, extra_planes = get_stage_footprint('DoG filter', (100, 64, 32), np.uint16, sigmas=[2, 1, 1])
+    assert plane_bytes == 64 * 32 * (2 + 4 * 4)
+    assert extra_planes == 16
+    plane_bytes_tv, extra_planes = get_stage_footprint('deconvolution', (100, 64, 32), np.float32, 
+                                                       psf_shape=(11, 5, 5), tv_tau=0.01)
+    assert extra_planes == 2 * 11 + 2 * 5
+    assert plane_bytes_tv > get_stage_footprint('deconvolution', (100, 64, 32), np.float32, 
+                                                psf_shape=(11, 5, 5))[0]
+    with pytest.raises(ValueError):
+        get_stage_footprint('deconvolution', (100, 64, 32), np.float32)
+
+
+def test_plan_chunks():
+    shape = (1000, 256, 256)
+    plane_bytes, extra_planes = get_stage_footprint('DoG filter', shape, np.uint16, sigmas=[2, 1, 1])
+    budget = 100 * plane_bytes
+    plan = plan_chunks('DoG filter', shape, np.uint16, memory_budget=budget, sigmas=[2, 1, 1])
+    # largest chunk fitting the budget with its halo
+    assert plan['chunk_size'] == 100 - extra_planes
+    assert plan['peak_bytes'] <= budget
+    assert plan['nb_chunks'] == -(-1000 // plan['chunk_size'])
+    # workers share the budget
+    plan = plan_chunks('DoG filter', shape, np.uint16, memory_budget=budget, n_workers=2, sigmas=[2, 1, 1])
+    assert plan['chunk_size'] == 50 - extra_planes
+    assert plan['peak_bytes'] <= budget
+    # chunks are not longer than the image
+    plan = plan_chunks('find candidates', shape, np.float32, memory_budget=2**40)
+    assert plan['chunk_size'] == 1000 and plan['nb_chunks'] == 1
+    # a too small budget still gives a plan, reported as exceeding it
+    plan = plan_chunks('find candidates', shape, np.float32, memory_budget=10)
+    assert plan['chunk_size'] == 1
+    assert 'exceeds' in format_plan(plan)
+
+
+def test_plan_chunks_workers():
+    shape = (1000, 256, 256)
+    plane_bytes, extra_planes = get_stage_footprint('DoG filter', shape, np.uint16, sigmas=[2, 1, 1])
+    budget = 100 * plane_bytes
+    # workers are removed before chunks get smaller than their halo
+    plan = plan_chunks('DoG filter', shape, np.uint16, memory_budget=budget, n_workers=64, sigmas=[2, 1, 1])
+    assert plan['chunk_size'] >= extra_planes // 2
+    assert plan['n_workers'] == 100 // (extra_planes // 2 + extra_planes)
+    assert plan['peak_bytes'] <= budget
+    # the GPU cap bounds chunks whatever the budget
+    plan = plan_chunks('DoG filter', shape, np.uint16, memory_budget=2**40, sigmas=[2, 1, 1], 
+                       max_chunk_size=GPU_MAX_CHUNK_SIZE['DoG filter'])
+    assert plan['chunk_size'] == GPU_MAX_CHUNK_SIZE['DoG filter']
+
+
+def test_plan_fit_batches():
+    spot_bytes = 5 * 7 * 7 * FIT_VOXEL_BYTES
+    plan = plan_fit_batches(10**5, (5, 7, 7), memory_budget=2**40, n_workers=8)
+    assert plan['chunk_size'] == FIT_BATCH_SIZE and plan['n_workers'] == 8
+    # threads are removed before batches get smaller than the minimum
+    budget = 3 * FIT_MIN_BATCH_SIZE * spot_bytes
+    plan = plan_fit_batches(10**5, (5, 7, 7), memory_budget=budget, n_workers=8)
+    assert plan['n_workers'] == 3 and plan['chunk_size'] == FIT_MIN_BATCH_SIZE
+    assert plan['peak_bytes'] <= budget
+    # few spots are fitted in one batch
+    plan = plan_fit_batches(10, (5, 7, 7), memory_budget=2**40, n_workers=8)
+    assert plan['nb_chunks'] == 1 and plan['n_workers'] == 1
+
+
+def test_map_chunks():
+    processed = []
+    steps = map_chunks(processed.append, range(0, 100, 10), n_workers=2)
+    progress = list(steps)
+    # chunks finishing together are reported at once
+    assert progress[-1] == (10, 10)
+    assert all(nb_chunks == 10 for _, nb_chunks in progress)
+    assert np.all(np.diff([nb_done for nb_done, _ in progress]) > 0)
+    assert sorted(processed) == list(range(0, 100, 10))
+    # chunks are not started anymore once the generator isn't iterated
+    processed = []
+    steps = map_chunks(processed.append, range(0, 100, 10), n_workers=2)
+    next(steps)
+    steps.close()
+    assert len(processed) <= 3
+    # errors of chunks are raised
+    def fail(start):
+        raise ValueError("chunk failed")
+    with pytest.raises(ValueError):
+        exhaust(map_chunks(fail, range(3), n_workers=2))
@@ -0,0 +1,40 @@
+import numpy as np
+from scipy import ndimage as ndi
+from napari_spot_detection._deconvolution import make_otf, deconvolve
+
+
+def _make_psf():
+    zz, yy, xx = np.mgrid[-6:7, -6:7, -6:7]
+    psf = np.exp(-(zz**2 / (2 * 2**2) + (yy**2 + xx**2) / (2 * 1.2**2)))
+    return (psf / psf.sum()).astype(np.float32)
+
+
+def test_make_otf():
+    psf = _make_psf()
+    otf = make_otf(psf, (20, 24, 24))
+    assert otf.dtype == np.complex64
+    assert otf.shape == (20, 24, 13)
+    # the PSF is normalized and centered, its OTF is real and 1 at the origin
+    np.testing.assert_allclose(otf[0, 0, 0], 1, rtol=1e-6)
+    np.testing.assert_allclose(otf.imag, 0, atol=1e-6)
+
+
+def test_deconvolve_chunks():
+    rng = np.random.default_rng(0)
+    truth = np.zeros((60, 48, 48), dtype=np.float32)
+    centers = rng.integers([5, 5, 5], [55, 43, 43], size=(30, 3))
+    truth[tuple(centers.T)] = 100
+    psf = _make_psf()
+    img = ndi.convolve(truth, psf, mode='constant') + 1
+
+    whole = deconvolve(img, psf, iterations=20, chunk_size=60)
+    decon = deconvolve(img, psf, iterations=20, chunk_size=16, n_workers=2)
+    assert decon.dtype == np.float32
+    assert decon.min() >= 0
+    # spots are sharpened
+    assert decon[tuple(centers.T)].mean() > 2 * img[tuple(centers.T)].mean()
+    # the halo makes chunks match the deconvolution of the whole image
+    np.testing.assert_allclose(decon, whole, atol=0.02 * whole.max())
+
+    decon_tv = deconvolve(img, psf, iterations=20, tv_tau=1e-3, chunk_size=16)
+    assert np.isfinite(decon_tv).all()
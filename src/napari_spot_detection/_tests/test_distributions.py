@@ -0,0 +1,30 @@
+import numpy as np
+from napari_spot_detection._distributions import PairHistograms
+
+
+def test_pair_histograms():
+    rng = np.random.default_rng(0)
+    variables = {name: rng.random(10_000) for name in ['a', 'b', 'c']}
+    ranges = {'a': (0.1, 0.9), 'b': (0, 1), 'c': (0.2, 0.5)}
+    hists = PairHistograms(variables, ranges, bins=16)
+    for var_x, var_y in hists.pairs:
+        expected, _, _ = np.histogram2d(variables[var_x], variables[var_y], bins=16,
+                                        range=[ranges[var_x], ranges[var_y]])
+        np.testing.assert_array_equal(hists.histograms[(var_x, var_y)], expected)
+
+    # only pairs including the modified variable are updated
+    updated = hists.set_ranges({**ranges, 'c': (0, 0.3)})
+    assert updated == [('a', 'c'), ('b', 'c')]
+    expected, _, _ = np.histogram2d(variables['a'], variables['c'], bins=16,
+                                    range=[ranges['a'], (0, 0.3)])
+    np.testing.assert_array_equal(hists.histograms[('a', 'c')], expected)
+
+
+def test_pair_histograms_sample():
+    variables = {'a': np.arange(100.), 'b': np.arange(100.)}
+    hists = PairHistograms(variables, {'a': (0, 99), 'b': (0, 99)})
+    select = variables['a'] >= 50
+    indices = hists.sample(10, select=select)
+    assert len(indices) == 10
+    assert np.all(select[indices])
+    np.testing.assert_array_equal(hists.sample(1000, select=select), np.arange(50, 100))
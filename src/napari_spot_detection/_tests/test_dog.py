@@ -0,0 +1,41 @@
+import numpy as np
+from scipy import ndimage as ndi
+from napari_spot_detection._dog import get_dog_sigmas, dog_filter, dog_filter_chunks
+
+
+def test_get_dog_sigmas():
+    params = {f'sigma_{size}_{axis}_factor': value 
+              for size, value in [('small', 0.5), ('large', 2)] for axis in 'xyz'}
+    sigmas_small, sigmas_large = get_dog_sigmas(params, sigma_z=0.6, sigma_xy=0.2, 
+                                                spacing=[0.3, 0.1, 0.1])
+    np.testing.assert_allclose(sigmas_small, [1, 1, 1])
+    np.testing.assert_allclose(sigmas_large, [4, 4, 4])
+
+
+def test_dog_filter_chunks():
+    rng = np.random.default_rng(0)
+    img = rng.random((45, 32, 32))
+    sigmas_small = np.array([1.5, 1, 1])
+    sigmas_large = np.array([3, 2, 2])
+    expected = (ndi.gaussian_filter(img.astype(np.float32), sigmas_small, output=np.float32) - 
+                ndi.gaussian_filter(img.astype(np.float32), sigmas_large, output=np.float32))
+    # chunks smaller than the halo
+    dog = dog_filter(img, sigmas_small, sigmas_large, chunk_size=7, n_workers=3)
+    assert dog.dtype == np.float32
+    np.testing.assert_array_equal(dog, expected)
+
+
+def test_dog_filter_progress():
+    rng = np.random.default_rng(0)
+    img = rng.random((20, 16, 16))
+    sigmas_small = np.array([1, 1, 1])
+    sigmas_large = np.array([2, 2, 2])
+    steps = dog_filter_chunks(img, sigmas_small, sigmas_large, chunk_size=5, n_workers=2)
+    progress = []
+    try:
+        while True:
+            progress.append(next(steps))
+    except StopIteration as stop:
+        dog = stop.value
+    assert progress[-1] == (4, 4)
+    np.testing.assert_array_equal(dog, dog_filter(img, sigmas_small, sigmas_large, chunk_size=5))
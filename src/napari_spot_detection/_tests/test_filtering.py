@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+from napari_spot_detection._filtering import SpotFilter
+
+
+def make_spot_filter(rng, nb_spots=2000):
+    centers = rng.random((nb_spots, 3)) * [10, 50, 50]
+    return SpotFilter(
+        centers,
+        amplitudes=rng.random(nb_spots) * 4,
+        sigmas_xy_factors=rng.random(nb_spots) * 3,
+        sigmas_z_factors=rng.random(nb_spots) * 3,
+        dist_fit_xy_factors=rng.random(nb_spots) * 3,
+        dist_fit_z_factors=rng.random(nb_spots) * 3,
+        sigma_xy=0.2,
+        sigma_z=0.6,
+        roi_xy_factor=8,
+        roi_z_factor=6,
+        )
+
+
+PARAMS = {
+    'amp_min': 1,
+    'sigma_min_z_factor': 0.2,
+    'sigma_min_xy_factor': 0.25,
+    'sigma_max_z_factor': 2.5,
+    'sigma_max_xy_factor': 2.5,
+    'fit_dist_max_err_z_factor': 2,
+    'fit_dist_max_err_xy_factor': 2,
+    'min_spot_sep_z_factor': 2,
+    'min_spot_sep_xy_factor': 1,
+    'dist_boundary_z_factor': 0.05,
+    'dist_boundary_xy_factor': 0.05,
+    'min_sigma_ratio': 0.5,
+    'max_sigma_ratio': 6,
+}
+
+
+def test_spot_filter_incremental_update():
+    spot_filter = make_spot_filter(np.random.default_rng(0))
+    spot_filter.update(PARAMS)
+    for key, value in [('amp_min', 2), ('min_spot_sep_xy_factor', 3), ('max_sigma_ratio', 2)]:
+        params = {**PARAMS, key: value}
+        to_keep = spot_filter.update(params)
+        # same result as evaluating all conditions from scratch
+        expected = make_spot_filter(np.random.default_rng(0)).update(params)
+        np.testing.assert_array_equal(to_keep, expected)
+
+
+def test_spot_filter_min_separation():
+    spot_filter = make_spot_filter(np.random.default_rng(0))
+    params = {**PARAMS, 'min_spot_sep_z_factor': 3, 'min_spot_sep_xy_factor': 4}
+    spot_filter.update(params)
+    col = spot_filter.condition_names.index('min_spot_sep')
+    is_separated = spot_filter.conditions[:, col]
+    # brute force: a spot is rejected if a brighter spot is too close
+    centers = np.random.default_rng(0).random((2000, 3)) * [10, 50, 50]
+    amplitudes = spot_filter.amplitudes
+    dist_z = np.abs(centers[:, None, 0] - centers[None, :, 0]) / 0.6
+    dist_xy = np.linalg.norm(centers[:, None, 1:] - centers[None, :, 1:], axis=-1) / 0.2
+    is_close = (dist_z <= 3) & (dist_xy <= 4)
+    np.fill_diagonal(is_close, False)
+    has_brighter = (is_close & (amplitudes[None, :] > amplitudes[:, None])).any(axis=1)
+    np.testing.assert_array_equal(is_separated, ~has_brighter)
+
+
+def test_spot_filter_matches_model():
+    # the model is an external dependency, only available on analysis machines
+    SPOTS3D = pytest.importorskip('SPOTS3D').SPOTS3D
+    rng = np.random.default_rng(0)
+    nb_spots = 500
+    model = SPOTS3D(
+        data=np.zeros((20, 64, 64), dtype=np.uint16),
+        psf=np.ones((5, 5, 5)) / 125,
+        metadata={'pixel_size': 0.115, 'scan_step': 0.4, 'wvl': 0.58},
+        microscope_params={'na': 1.35, 'ri': 1.4, 'theta': 0},
+        )
+    sigma_xy, sigma_z = model._sigma_xy, model._sigma_z
+    centers = rng.random((nb_spots, 3)) * [8, 7, 7]
+    # candidates close to fitted centers, far from the ROI boundaries
+    candidates = centers + rng.random((nb_spots, 3)) * [0.1 * sigma_z, 0.1 * sigma_xy, 0.1 * sigma_xy]
+    amplitudes = rng.random(nb_spots) * 4
+    sigmas_xy_factors = rng.random(nb_spots) * 3
+    sigmas_z_factors = rng.random(nb_spots) * 3
+    model._spot_candidates = np.column_stack([candidates, amplitudes])
+    model._fit_params = np.column_stack([
+        amplitudes, centers[:, 2], centers[:, 1], centers[:, 0],
+        sigmas_xy_factors * sigma_xy, sigmas_z_factors * sigma_z, np.zeros(nb_spots),
+        ])
+    model._chi_sqrs = np.ones(nb_spots)
+    model.fit_candidate_spots_params = {'n_spots_to_fit': nb_spots, 'roi_z_factor': 6,
+                                        'roi_y_factor': 8, 'roi_x_factor': 8}
+    # without separation nor boundary rejection, both filters apply the same thresholds
+    params = {**PARAMS, 'min_spot_sep_z_factor': 0, 'min_spot_sep_xy_factor': 0,
+              'dist_boundary_z_factor': 0, 'dist_boundary_xy_factor': 0}
+    model.spot_filter_params = params
+    model.run_filter_spots()
+
+    dist_fit_xy = np.linalg.norm(candidates[:, 1:] - centers[:, 1:], axis=1)
+    dist_fit_z = np.abs(candidates[:, 0] - centers[:, 0])
+    spot_filter = SpotFilter(
+        centers, amplitudes, sigmas_xy_factors, sigmas_z_factors,
+        dist_fit_xy / sigma_xy, dist_fit_z / sigma_z, sigma_xy=sigma_xy, sigma_z=sigma_z,
+        roi_xy_factor=8, roi_z_factor=6,
+        )
+    np.testing.assert_array_equal(spot_filter.update(params), model._to_keep)
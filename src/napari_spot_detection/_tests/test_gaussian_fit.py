@@ -0,0 +1,37 @@
+import numpy as np
+from napari_spot_detection._gaussian_fit import fit_candidates, gaussian3d
+
+
+def test_fit_candidates():
+    rng = np.random.default_rng(0)
+    shape = (30, 64, 64)
+    spacing = np.array([0.3, 0.1, 0.1])
+    affine = np.diag([*spacing, 1])
+    # isolated spots on a grid, some of them close to the image border
+    centers = np.array([[z, y, x] for z in [1.5, 6.5] for y in [0.3, 2, 4.5] for x in [1.5, 3.5, 6]])
+    centers += rng.uniform(-0.05, 0.05, centers.shape)
+    nb_spots = len(centers)
+    true_params = np.column_stack([
+        rng.uniform(50, 100, nb_spots),
+        centers[:, 2],
+        centers[:, 1],
+        centers[:, 0],
+        rng.uniform(0.15, 0.25, nb_spots),
+        rng.uniform(0.5, 0.7, nb_spots),
+        np.full(nb_spots, 10),
+    ])
+    voxels = np.stack(np.meshgrid(*[np.arange(size) * step for size, step in zip(shape, spacing)],
+                                  indexing='ij'), axis=-1).reshape(1, -1, 3)
+    img = np.full(np.prod(shape), 10.)
+    for params in true_params:
+        params = params.copy()
+        params[6] = 0
+        img += gaussian3d(voxels, params[None])[0][0]
+    img = img.reshape(shape)
+
+    candidates = centers + rng.normal(0, 0.05, centers.shape)
+    fit_params, chi_sqrs = fit_candidates(img, candidates, affine, sigma_xy=0.2, sigma_z=0.6,
+                                          roi_factors=(4, 6, 6), batch_size=7, n_workers=2)
+    assert fit_params.shape == (nb_spots, 7)
+    assert chi_sqrs.shape == (nb_spots,)
+    np.testing.assert_allclose(fit_params, true_params, rtol=1e-3, atol=1e-3)
@@ -0,0 +1,348 @@
+import numpy as np
+import pytest
+from napari_spot_detection import _image_processing
+from napari_spot_detection._image_processing import (
+    get_tilt_vector,
+    tilted_frame_coords,
+    compute_distances,
+    compute_pair_distances,
+    cut_graph_bidistance,
+    find_close_pairs,
+    build_adjacency,
+    find_neighbors,
+    neighbors_k_order,
+    flatten_neighbors,
+    label_clusters,
+    merge_cluster_nodes,
+    sample_weights,
+    find_local_maxima,
+    select_local_maxima,
+    get_deskew_affine,
+    sample_tiles,
+    assemble_tiles,
+    filter_nearby_peaks,
+    filter_nearby_peaks_tiled,
+)
+
+
+def test_compute_distances_tilted():
+    pixel_size, scan_step, theta = 0.115, 0.4, 30
+    tilt_vector = get_tilt_vector(pixel_size, scan_step, theta)
+    rng = np.random.default_rng(0)
+    source = rng.random((100, 3)) * 20
+    target = rng.random((100, 3)) * 20
+    dist_z, dist_xy = compute_distances(source, target, method='xy_z_tilted', 
+                                        tilt_vector=tilt_vector)
+    # physical distances along the normal of the tilted plane and in this plane
+    diff = source - target
+    theta = np.deg2rad(theta)
+    normal = diff[:, 0] * scan_step * np.sin(theta)
+    tilted = diff[:, 1] * pixel_size + diff[:, 0] * scan_step * np.cos(theta)
+    np.testing.assert_allclose(dist_z * pixel_size, np.abs(normal))
+    np.testing.assert_allclose(dist_xy * pixel_size, np.hypot(tilted, diff[:, 2] * pixel_size))
+    # without tilt it's the orthogonal decomposition
+    np.testing.assert_allclose(
+        compute_distances(source, target, method='xy_z_tilted', tilt_vector=[1, 0]),
+        compute_distances(source, target))
+    # frame conversion is reversible
+    np.testing.assert_allclose(
+        tilted_frame_coords(tilted_frame_coords(source, tilt_vector), tilt_vector, inverse=True),
+        source)
+    with pytest.raises(ValueError):
+        compute_distances(source, target, method='xy_z_tilted')
+
+
+def test_compute_pair_distances():
+    rng = np.random.default_rng(0)
+    coords = rng.random((100, 3)) * 10
+    pairs = rng.integers(0, 100, size=(1000, 2))
+    dist_z, dist_xy = compute_distances(coords[pairs[:, 0]], coords[pairs[:, 1]])
+    # small blocks, results written in given arrays
+    out = (np.zeros(1000, dtype=np.float32), np.zeros(1000, dtype=np.float32))
+    res = compute_pair_distances(coords, pairs, out=out, chunk_size=64)
+    assert res is out
+    np.testing.assert_allclose(out[0], dist_z, rtol=1e-6)
+    np.testing.assert_allclose(out[1], dist_xy, rtol=1e-6)
+    dist = compute_pair_distances(coords, pairs, method='xyz', chunk_size=64)
+    np.testing.assert_allclose(dist, np.hypot(dist_z, dist_xy), rtol=1e-6)
+    # fused graph cut
+    select = compute_pair_distances(coords, pairs, max_z=3, max_xy=4, chunk_size=64)
+    np.testing.assert_array_equal(select, cut_graph_bidistance(dist_z, dist_xy, 3, 4))
+
+
+def test_cut_graph_bidistance():
+    pairs = np.array([[0, 1], [0, 2], [1, 2]])
+    select, filtered_pairs = cut_graph_bidistance(
+        np.array([1, 3, 1]), np.array([1, 1, 3]), 2, 2, pairs=pairs)
+    np.testing.assert_array_equal(select, [True, False, False])
+    np.testing.assert_array_equal(filtered_pairs, [[0, 1]])
+
+
+def test_find_close_pairs():
+    rng = np.random.default_rng(0)
+    coords = rng.random((500, 3)) * [20, 50, 50]
+    max_z, max_xy = 6, 1.5
+    pairs = find_close_pairs(coords, max_z, max_xy)
+    assert pairs.dtype == np.int32
+    # brute force cylinder test on all pairs
+    diff = np.abs(coords[:, None, :] - coords[None, :, :])
+    close = np.logical_and(diff[..., 0] <= max_z, 
+                           np.sqrt(diff[..., 1]**2 + diff[..., 2]**2) <= max_xy)
+    expected = np.argwhere(np.triu(close, k=1))
+    assert set(map(tuple, pairs.tolist())) == set(map(tuple, expected.tolist()))
+
+
+def test_find_neighbors_adjacency():
+    rng = np.random.default_rng(0)
+    pairs = rng.integers(0, 50, size=(200, 2))
+    adjacency = build_adjacency(pairs, nb_nodes=60)
+    assert adjacency[0].dtype == np.int32
+    assert adjacency[1].dtype == np.int32
+    # same neighbors as the scan of all pairs, nodes without edges included
+    for n in range(60):
+        np.testing.assert_array_equal(find_neighbors(pairs, n, adjacency=adjacency),
+                                      find_neighbors(pairs, n))
+    # a whole frontier is expanded at once
+    frontier = np.array([3, 8, 12])
+    expected = np.concatenate([find_neighbors(pairs, n) for n in frontier])
+    np.testing.assert_array_equal(find_neighbors(pairs, frontier, adjacency=adjacency), 
+                                  expected)
+
+
+def test_neighbors_k_order():
+    pairs = np.array([[0, 10],
+                      [0, 20],
+                      [0, 30],
+                      [10, 110],
+                      [10, 210],
+                      [10, 310],
+                      [20, 120],
+                      [20, 220],
+                      [20, 320],
+                      [30, 130],
+                      [30, 230],
+                      [30, 330],
+                      [10, 20],
+                      [20, 30],
+                      [30, 10],
+                      [310, 120],
+                      [320, 130],
+                      [330, 110]])
+    all_neigh = neighbors_k_order(pairs, 0, 2)
+    assert [order for neigh, order in all_neigh] == [0, 1, 2]
+    np.testing.assert_array_equal(all_neigh[1][0], [10, 20, 30])
+    np.testing.assert_array_equal(
+        flatten_neighbors(all_neigh), 
+        [0, 10, 20, 30, 110, 120, 130, 210, 220, 230, 310, 320, 330])
+    # reusing a prebuilt index gives the same neighbors
+    adjacency = build_adjacency(pairs)
+    np.testing.assert_array_equal(
+        flatten_neighbors(neighbors_k_order(pairs, 0, 2, adjacency=adjacency)),
+        flatten_neighbors(all_neigh))
+
+
+def test_label_clusters():
+    # clusters are numbered by their smallest node, isolated nodes included
+    pairs = np.array([[5, 1], [2, 4], [1, 3]])
+    labels, nb_clusters = label_clusters(pairs, 7)
+    assert nb_clusters == 4
+    np.testing.assert_array_equal(labels, [0, 1, 2, 1, 2, 1, 3])
+
+
+def test_merge_cluster_nodes():
+    coords = np.array([[0, 0, 0],
+                       [10, 10, 10],
+                       [2, -4, 8],
+                       [20, 20, 20],
+                       [11, 10, 10]], dtype=float)
+    pairs = np.array([[0, 2], [4, 1]])
+    weights = np.array([1, 1, 3, 1, 1])
+
+    merged = merge_cluster_nodes(coords, pairs, weights)
+    expected = np.array([[1.5, -3, 6],
+                         [10.5, 10, 10],
+                         [20, 20, 20]])
+    np.testing.assert_allclose(merged, expected)
+
+    # no weights means plain averaging
+    merged = merge_cluster_nodes(coords, pairs)
+    np.testing.assert_allclose(merged[0], [1, -2, 4])
+
+    with pytest.raises(ValueError):
+        merge_cluster_nodes(coords, pairs, split_big_clust=True)
+
+
+def test_merge_cluster_nodes_isolated():
+    # without edges all nodes are kept untouched
+    coords = np.arange(12).reshape(4, 3)
+    merged = merge_cluster_nodes(coords, np.empty((0, 2), dtype=int))
+    np.testing.assert_array_equal(merged, coords)
+
+
+def test_sample_weights(tmp_path):
+    rng = np.random.default_rng(0)
+    img = rng.random((10, 20, 30))
+    coords = rng.random((500, 3)) * [9, 19, 29]
+    # trilinear interpolation by hand
+    lower = np.floor(coords).astype(int)
+    frac = coords - lower
+    expected = np.zeros(len(coords))
+    for dz in [0, 1]:
+        for dy in [0, 1]:
+            for dx in [0, 1]:
+                coef = ((frac[:, 0] if dz else 1 - frac[:, 0]) * 
+                        (frac[:, 1] if dy else 1 - frac[:, 1]) * 
+                        (frac[:, 2] if dx else 1 - frac[:, 2]))
+                expected += coef * img[lower[:, 0] + dz, lower[:, 1] + dy, lower[:, 2] + dx]
+    np.testing.assert_allclose(sample_weights(img, coords, block_size=64), expected)
+    # integer and nearest pixel sampling
+    int_coords = np.round(coords).astype(int)
+    np.testing.assert_array_equal(sample_weights(img, int_coords), img[tuple(int_coords.T)])
+    np.testing.assert_array_equal(sample_weights(img, coords, order=0), img[tuple(int_coords.T)])
+    # memory-mapped image
+    np.save(tmp_path / 'img.npy', img)
+    img_mmap = np.load(tmp_path / 'img.npy', mmap_mode='r')
+    np.testing.assert_allclose(sample_weights(img_mmap, coords), expected)
+
+
+def test_sample_weights_dask():
+    da = pytest.importorskip('dask.array')
+    rng = np.random.default_rng(0)
+    img = rng.random((10, 20, 30))
+    coords = rng.random((500, 3)) * [9, 19, 29]
+    np.testing.assert_allclose(sample_weights(da.from_array(img, chunks=5), coords),
+                               sample_weights(img, coords))
+
+
+def test_filter_nearby_peaks_tiled():
+    rng = np.random.default_rng(0)
+    weight_img = rng.random((30, 100, 100))
+    coords = (rng.random((3000, 3)) * [30, 100, 100]).astype(int)
+    merged = filter_nearby_peaks(coords, 3, 2, weight_img=weight_img)
+    tiled = filter_nearby_peaks_tiled(coords, 3, 2, tile_shape=(10, 20, 30), 
+                                      weight_img=weight_img)
+    tiled = np.vstack(list(tiled))
+    # same merged peaks, in a different order
+    assert tiled.shape == merged.shape
+    np.testing.assert_array_equal(tiled[np.lexsort(tiled.T)], merged[np.lexsort(merged.T)])
+
+    with pytest.raises(ValueError):
+        next(filter_nearby_peaks_tiled(coords, 3, 2, tile_shape=2))
+
+
+def test_filter_nearby_peaks_parallel():
+    rng = np.random.default_rng(0)
+    weight_img = rng.random((30, 100, 100))
+    coords = (rng.random((3000, 3)) * [30, 100, 100]).astype(int)
+    merged = filter_nearby_peaks(coords, 3, 2, weight_img=weight_img)
+    # same peaks in the same order as the serial merge
+    merged_parallel = filter_nearby_peaks(coords, 3, 2, weight_img=weight_img, n_workers=2)
+    np.testing.assert_array_equal(merged_parallel, merged)
+    merged_parallel = filter_nearby_peaks(coords, 3, 2, weight_img=weight_img, n_workers=2,
+                                          tile_shape=(10, 25, 25))
+    np.testing.assert_array_equal(merged_parallel, merged)
+
+    # peaks in a single plane, with default tiles thinner than the halo along z
+    coords_z0 = coords.copy()
+    coords_z0[:, 0] = 0
+    np.testing.assert_array_equal(filter_nearby_peaks(coords_z0, 3, 2, n_workers=2),
+                                  filter_nearby_peaks(coords_z0, 3, 2))
+    empty = filter_nearby_peaks(np.empty((0, 3)), 3, 2, n_workers=2)
+    assert empty.shape == (0, 3)
+
+
+def test_filter_nearby_peaks_without_shared_memory(monkeypatch):
+    # Python 3.7 has no shared memory, peaks are merged serially
+    monkeypatch.setattr(_image_processing, 'shared_memory', None)
+    rng = np.random.default_rng(0)
+    coords = (rng.random((500, 3)) * [30, 100, 100]).astype(int)
+    np.testing.assert_array_equal(filter_nearby_peaks(coords, 3, 2, n_workers=2),
+                                  filter_nearby_peaks(coords, 3, 2))
+
+
+def test_filter_nearby_peaks_tilted():
+    tilt_vector = get_tilt_vector(0.115, 0.4, 30)
+    rng = np.random.default_rng(0)
+    coords = rng.random((2000, 3)) * [20, 100, 100]
+    merged = filter_nearby_peaks(coords, 3, 2, tilt_vector=tilt_vector)
+    # merging in the tilted frame and going back to skewed coordinates is the same
+    frame_merged = filter_nearby_peaks(tilted_frame_coords(coords, tilt_vector), 3, 2)
+    np.testing.assert_allclose(
+        merged, tilted_frame_coords(frame_merged, tilt_vector, inverse=True))
+    merged_parallel = filter_nearby_peaks(coords, 3, 2, tilt_vector=tilt_vector, n_workers=2)
+    np.testing.assert_allclose(merged_parallel, merged)
+
+
+@pytest.mark.parametrize('backend', ['numpy', 'numba'])
+def test_backends_identical(backend):
+    if backend == 'numba':
+        pytest.importorskip('numba')
+    rng = np.random.default_rng(0)
+    coords = rng.random((3000, 3)) * [20, 100, 100]
+    weights = rng.random(3000)
+    pairs = find_close_pairs(coords, 3, 2)
+    adjacency = build_adjacency(pairs, len(coords))
+
+    labels, nb_clusters = label_clusters(pairs, len(coords), backend=backend)
+    labels_ref, nb_clusters_ref = label_clusters(pairs, len(coords), backend='numpy')
+    assert nb_clusters == nb_clusters_ref
+    np.testing.assert_array_equal(labels, labels_ref)
+    np.testing.assert_array_equal(
+        merge_cluster_nodes(coords, pairs, weights, backend=backend),
+        merge_cluster_nodes(coords, pairs, weights, backend='numpy'))
+    frontier = np.arange(0, 3000, 7)
+    np.testing.assert_array_equal(
+        find_neighbors(pairs, frontier, adjacency=adjacency, backend=backend),
+        find_neighbors(pairs, frontier, adjacency=adjacency, backend='numpy'))
+    for n in range(0, 3000, 100):
+        for order in [1, 3, 20]:
+            all_neigh = neighbors_k_order(pairs, n, order, adjacency=adjacency, backend=backend)
+            all_neigh_ref = neighbors_k_order(pairs, n, order, adjacency=adjacency, backend='numpy')
+            assert [k for _, k in all_neigh] == [k for _, k in all_neigh_ref]
+            for (neigh, _), (neigh_ref, _) in zip(all_neigh, all_neigh_ref):
+                np.testing.assert_array_equal(neigh, neigh_ref)
+
+
+def test_find_local_maxima():
+    rng = np.random.default_rng(0)
+    img = rng.random((23, 20, 20))
+    coords, values = find_local_maxima(img, min_value=0.5)
+    # brute force comparison with the 26 neighbors of each pixel
+    padded = np.pad(img, 1, mode='edge')
+    neighbors = np.stack([padded[1 + dz:24 + dz, 1 + dy:21 + dy, 1 + dx:21 + dx]
+                          for dz in (-1, 0, 1) for dy in (-1, 0, 1) for dx in (-1, 0, 1)])
+    expected = np.argwhere((img >= neighbors.max(axis=0)) & (img > 0.5))
+    assert np.all(np.diff(values) >= 0)
+    np.testing.assert_array_equal(values, img[tuple(coords.T)])
+    assert set(map(tuple, coords)) == set(map(tuple, expected))
+    # blocks processing gives the same result
+    coords_blocks, values_blocks = find_local_maxima(img, min_value=0.5, block_size=4)
+    np.testing.assert_array_equal(coords_blocks, coords)
+    np.testing.assert_array_equal(values_blocks, values)
+
+    selected = select_local_maxima(coords, values, 0.8)
+    np.testing.assert_array_equal(selected, coords[values > 0.8])
+
+
+def test_get_deskew_affine():
+    affine = get_deskew_affine(0.115, 0.4, 30)
+    # one scan step moves along y, one camera row moves along the tilted plane
+    np.testing.assert_allclose(affine @ [1, 0, 0, 1], [0, 0.4, 0, 1])
+    np.testing.assert_allclose(affine @ [0, 1, 0, 1], [0.115 / 2, 0.115 * np.sqrt(3) / 2, 0, 1])
+    np.testing.assert_allclose(affine @ [0, 0, 1, 1], [0, 0, 0.115, 1])
+
+
+def test_sample_assemble_tiles():
+    img = np.arange(4 * 20 * 30).reshape((4, 20, 30))
+    tiles = sample_tiles(img.shape, (0, 10, 10), 4, seed=1)
+    assert len(tiles) == 4
+    assert len({str(tile) for tile in tiles}) == 4
+    for tile in tiles:
+        assert img[tile].shape == (4, 10, 10)
+    # more tiles than the grid contains
+    assert len(sample_tiles(img.shape, (0, 10, 10), 100)) == 6
+
+    mosaic = assemble_tiles(img, tiles, gap=2)
+    assert mosaic.shape == (4, 10, 4 * 12 - 2)
+    np.testing.assert_array_equal(mosaic[..., 12:22], img[tiles[1]])
+    assert np.all(mosaic[..., 10:12] == 0)
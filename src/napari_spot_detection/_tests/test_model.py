@@ -0,0 +1,87 @@
+import importlib
+
+import numpy as np
+import pytest
+from napari_spot_detection._gaussian_fit import gaussian3d
+from napari_spot_detection._model import SpotModel, import_spots3d, plan_fit, run_fit_candidates
+
+
+def make_model(theta=0):
+    rng = np.random.default_rng(0)
+    shape = (24, 48, 48)
+    metadata = {'pixel_size': 0.1, 'scan_step': 0.3, 'wvl': 0.6}
+    microscope_params = {'na': 1.0, 'ri': 1.33, 'theta': theta}
+    psf = np.ones((3, 3, 3))
+    model = SpotModel(np.zeros(shape), psf, metadata, microscope_params, n_workers=2)
+    spacing = np.array([0.3, 0.1, 0.1])
+    centers = np.array([[2.1, 1.2, 1.3], [4.5, 3.4, 1.5], [3.3, 2.5, 3.6]])
+    voxels = np.stack(np.meshgrid(*[np.arange(size) * step for size, step in zip(shape, spacing)],
+                                  indexing='ij'), axis=-1).reshape(1, -1, 3)
+    img = np.full(np.prod(shape), 10.)
+    for center in centers:
+        params = np.array([[100, center[2], center[1], center[0], model._sigma_xy, model._sigma_z, 0]])
+        img += gaussian3d(voxels, params)[0][0]
+    model.data = (img.reshape(shape) + rng.normal(0, 1, shape)).astype(np.float32)
+    return model, centers
+
+
+def test_spot_model_pipeline():
+    model, centers = make_model()
+    model.scan_chunk_size = 8
+    model.DoG_filter_params = {
+        'sigma_small_x_factor': 0.7, 'sigma_small_y_factor': 0.7, 'sigma_small_z_factor': 0.7,
+        'sigma_large_x_factor': 5, 'sigma_large_y_factor': 5, 'sigma_large_z_factor': 5,
+    }
+    model.run_DoG_filter()
+    model.find_candidates_params = {'threshold': 5, 'min_spot_xy': 2, 'min_spot_z': 2}
+    model.run_find_candidates()
+    assert len(model._spot_candidates) == len(centers)
+    # brightest candidates first
+    assert np.all(np.diff(model._spot_candidates[:, 3]) <= 0)
+    model.fit_candidate_spots_params = {
+        'n_spots_to_fit': 100, 'roi_z_factor': 4, 'roi_y_factor': 6, 'roi_x_factor': 6,
+    }
+    # small budget, candidates are fitted by several batches
+    plan = plan_fit(model, memory_budget=2**20, n_workers=2)
+    assert plan['chunk_size'] >= 1
+    run_fit_candidates(model, batch_size=plan['chunk_size'], n_workers=plan['n_workers'])
+    fitted = model._fit_params[:, 3:0:-1]
+    dist = np.linalg.norm(fitted[:, None, :] - centers[None, :, :], axis=-1).min(axis=1)
+    assert np.all(dist < 0.05)
+    # only the brightest candidates are fitted
+    model.fit_candidate_spots_params['n_spots_to_fit'] = 2
+    model.run_fit_candidates()
+    assert len(model._fit_params) == 2
+    model.fit_candidate_spots_params['n_spots_to_fit'] = 100
+    model.run_fit_candidates()
+    model.spot_filter_params = {
+        'amp_min': 50,
+        'sigma_min_z_factor': 0.5, 'sigma_max_z_factor': 2,
+        'sigma_min_xy_factor': 0.5, 'sigma_max_xy_factor': 2,
+        'fit_dist_max_err_z_factor': 2, 'fit_dist_max_err_xy_factor': 2,
+        'min_spot_sep_z_factor': 0, 'min_spot_sep_xy_factor': 0,
+        'dist_boundary_z_factor': 0, 'dist_boundary_xy_factor': 0,
+        'min_sigma_ratio': 0, 'max_sigma_ratio': 100,
+    }
+    model.run_filter_spots()
+    assert model._to_keep.all()
+    assert model._conditions.shape == (len(centers), len(model._condition_names))
+
+
+def test_spot_model_deconvolution():
+    model, _ = make_model()
+    model.scan_chunk_size = 8
+    model.decon_params = {'iterations': 2, 'tv_tau': 0}
+    model.run_deconvolution()
+    assert model.decon_data.shape == model.data.shape
+    assert model.decon_data.dtype == np.float32
+
+
+def test_widget_without_spots3d():
+    # the plugin loads without the GPU stack, stages then run on the CPU model
+    if import_spots3d() is not None:
+        pytest.skip("SPOTS3D is installed")
+    pytest.importorskip('napari')
+    pytest.importorskip('qtpy.QtWidgets')
+    widget = importlib.import_module('napari_spot_detection._widget')
+    assert widget.SpotModel is SpotModel
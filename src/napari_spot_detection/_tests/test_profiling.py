@@ -0,0 +1,42 @@
+import json
+import numpy as np
+import pytest
+from napari_spot_detection._profiling import StageProfiler, get_path_size
+
+
+def test_stage_profiler(tmp_path):
+    profiler = StageProfiler()
+    img = np.ones((20, 30, 40), dtype=np.float32)
+    with profiler.profile('DoG filter') as record:
+        out = img * 2
+        record.update(nb_voxels=img.size, input_bytes=img.nbytes, output_bytes=out.nbytes)
+    with pytest.raises(RuntimeError):
+        with profiler.profile('fit spots') as record:
+            record['nb_spots'] = 10
+            raise RuntimeError
+
+    dog, fit = profiler.records
+    assert dog['status'] == 'done' and fit['status'] == 'failed'
+    assert dog['wall_time'] >= 0 and dog['cpu_time'] >= 0
+    assert dog['output_bytes'] == img.nbytes
+    assert dog['voxels_per_s'] == pytest.approx(img.size / dog['wall_time'])
+    assert 'spots_per_s' in fit
+
+    path = tmp_path / 'profiling.json'
+    profiler.to_json(path)
+    with open(path) as read_file:
+        report = json.load(read_file)
+    assert len(report['records']) == 2
+    assert report['summary']['DoG filter']['runs'] == 1
+    profiler.clear()
+    assert profiler.records == []
+
+
+def test_cprofile_hook(tmp_path):
+    profiler = StageProfiler(dir_profiles=tmp_path / 'profiles')
+    with profiler.profile('deconvolution'):
+        np.fft.rfftn(np.ones((8, 8, 8)))
+    record = profiler.records[0]
+    assert 'profile' in record
+    assert get_path_size(record['profile']) > 0
+    assert get_path_size(tmp_path) == get_path_size(record['profile'])
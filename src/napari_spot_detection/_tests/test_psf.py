@@ -0,0 +1,36 @@
+import numpy as np
+from napari_spot_detection._psf import PSFCache, get_psf_params, get_psf, precompute_psf_library
+
+
+def test_psf_cache(tmp_path):
+    cache = PSFCache(tmp_path)
+    params = get_psf_params(1.35, 1.4, 0.58, 0.115, 0.4, 30 / 180 * np.pi)
+    assert cache.get(params) is None
+    psf = np.random.default_rng(0).random((15, 15, 15)).astype(np.float32)
+    cache.put(params, psf)
+    assert len(list(tmp_path.glob('psf-*.npz'))) == 1
+    # values computed differently give the same key
+    same_params = get_psf_params(1.35, 1.4, 0.58, 0.115, 0.4, np.deg2rad(30))
+    np.testing.assert_array_equal(cache.get(same_params), psf)
+    # a new session loads the PSF from disk
+    np.testing.assert_array_equal(PSFCache(tmp_path).get(params), psf)
+    other_params = get_psf_params(1.35, 1.4, 0.67, 0.115, 0.4, 30 / 180 * np.pi)
+    assert cache.get(other_params) is None
+
+    cache.clear()
+    np.testing.assert_array_equal(cache.get(params), psf)
+    cache.clear(disk=True)
+    assert cache.get(params) is None
+
+
+def test_psf_library(tmp_path):
+    cache = PSFCache(tmp_path, max_items=1)
+    settings = {'na': 1.35, 'ri': 1.4, 'wvl': [0.52, 0.58], 'dc': 0.115, 'dstage': 0.4, 'theta': 30}
+    # PSFs already in the cache, with theta converted as in the widget, are not generated again
+    for wvl in settings['wvl']:
+        cache.put(get_psf_params(1.35, 1.4, wvl, 0.115, 0.4, 30 / 180 * np.pi), np.full((3, 3, 3), wvl))
+    library = precompute_psf_library(settings, cache=cache)
+    assert [params['wvl'] for params in library] == [0.52, 0.58]
+    assert library[0]['theta'] == round(np.deg2rad(30), 9)
+    psf = get_psf(1.35, 1.4, 0.52, 0.115, 0.4, np.deg2rad(30), cache=cache)
+    np.testing.assert_array_equal(psf, np.full((3, 3, 3), 0.52))
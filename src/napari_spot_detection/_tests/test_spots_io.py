@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from napari_spot_detection._spots_io import save_spots, load_spots
+
+
+@pytest.mark.parametrize('ext', ['parquet', 'feather', 'zarr', 'csv'])
+def test_save_load_spots(tmp_path, ext):
+    rng = np.random.default_rng(0)
+    nb_spots = 1000
+    columns = {name: rng.random(nb_spots) for name in ['amplitudes', 'z', 'y', 'x', 'sigmas_xy']}
+    columns['spot_select'] = rng.random(nb_spots) > 0.5
+    path = tmp_path / f'spots.{ext}'
+    save_spots(path, columns, chunk_size=300)
+
+    spots = load_spots(path)
+    assert list(spots.keys()) == list(columns.keys())
+    for name, values in columns.items():
+        if values.dtype == np.float64:
+            np.testing.assert_allclose(spots[name], values, rtol=1e-6)
+        else:
+            np.testing.assert_array_equal(spots[name], values)
+    # binary formats keep float32 and boolean dtypes
+    if ext != 'csv':
+        assert spots['x'].dtype == np.float32
+        assert spots['spot_select'].dtype == bool
+
+    spots = load_spots(path, columns=['x', 'amplitudes'])
+    assert set(spots.keys()) == {'x', 'amplitudes'}
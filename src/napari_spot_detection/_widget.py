@@ -23,24 +23,48 @@ from qtpy.QtWidgets import (
     QFileDialog, 
     QScrollArea, 
     QSizePolicy,
+    QProgressBar,
+    QTableWidget,
+    QTableWidgetItem,
 )
 from superqt import QLabeledDoubleRangeSlider, QLabeledDoubleSlider
 import numpy as np
 import matplotlib.pyplot as plt
-import pandas as pd
+from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg
+from matplotlib.figure import Figure
 import tifffile
-from localize_psf import fit_psf, camera
-import itertools
 import json
 import warnings
 import napari
+from napari.qt.threading import create_worker
 from pathlib import Path
-import sys
-
-if '/home/alexis/Postdoc_ASU/Projects/opm-merfish-analysis/src/' not in sys.path:
-    sys.path.append('/home/alexis/Postdoc_ASU/Projects/opm-merfish-analysis/src/')
-from SPOTS3D import SPOTS3D
-from _imageprocessing import deskew
+import os
+
+from ._psf import PSFCache, get_psf_params, make_psf
+from ._cache import StageCache, fingerprint_array, make_key
+from ._image_processing import (
+    find_local_maxima, 
+    select_local_maxima, 
+    get_deskew_affine, 
+    sample_tiles, 
+    assemble_tiles,
+)
+from ._filtering import SpotFilter
+from ._distributions import PairHistograms
+from ._chunking import plan_chunks, format_plan, GPU_MAX_CHUNK_SIZE
+from ._profiling import StageProfiler, get_path_size
+from ._dog import get_dog_sigmas
+from ._model import (
+    SpotModel, 
+    import_spots3d, 
+    plan_fit, 
+    iter_deconvolution, 
+    iter_dog_filter, 
+    iter_find_candidates, 
+    iter_fit_candidates, 
+    iter_filter_spots,
+)
+from ._spots_io import SPOTS_FORMATS, save_spots, load_spots
 
 
 
@@ -93,13 +117,188 @@ class FullSlider(QWidget):
         self._convert_value()
 
 
+class PairPlotPanel(QWidget):
+    """
+    Grid of 2D histograms of pairs of fitted parameters, embedded in the viewer.
+    Random subsets of points can be overlaid on histograms.
+    """
+
+    def __init__(self, pair_histograms, *args, **kwargs):
+        super(PairPlotPanel, self).__init__(*args, **kwargs)
+
+        self.hists = pair_histograms
+        self.figure = Figure(figsize=(10, 10), constrained_layout=True)
+        self.canvas = FigureCanvasQTAgg(self.figure)
+        layout = QVBoxLayout()
+        layout.addWidget(self.canvas)
+        self.setLayout(layout)
+
+        # lower triangle of the grid: x variables in columns, y variables in rows
+        var_labels = list(self.hists.variables.keys())
+        nb_vars = len(var_labels)
+        axes = self.figure.subplots(nb_vars - 1, nb_vars - 1, squeeze=False)
+        for ax in axes.ravel():
+            ax.set_visible(False)
+        self._axes = {}
+        self._images = {}
+        self._overlays = {}
+        for var_x, var_y in self.hists.pairs:
+            col = var_labels.index(var_x)
+            row = var_labels.index(var_y) - 1
+            ax = axes[row, col]
+            ax.set_visible(True)
+            self._axes[(var_x, var_y)] = ax
+            self._images[(var_x, var_y)] = ax.imshow(
+                np.zeros((self.hists.bins, self.hists.bins)), origin='lower', aspect='auto', 
+                interpolation='nearest', cmap='viridis')
+            self._overlays[(var_x, var_y)] = ax.scatter([], [], s=1, marker='.', c='r')
+            if row == nb_vars - 2:
+                ax.set_xlabel(var_x, fontsize=8)
+            if col == 0:
+                ax.set_ylabel(var_y, fontsize=8)
+            ax.tick_params(labelsize=6)
+        self.update_histograms(self.hists.pairs)
+
+    def update_histograms(self, pairs):
+        for pair in pairs:
+            x_range = self.hists.ranges[pair[0]]
+            y_range = self.hists.ranges[pair[1]]
+            image = self._images[pair]
+            # log scale makes sparse regions visible
+            counts = np.log1p(self.hists.histograms[pair].T)
+            image.set_data(counts)
+            image.set_clim(0, max(counts.max(), 1))
+            image.set_extent((*x_range, *y_range))
+            self._axes[pair].set_xlim(x_range)
+            self._axes[pair].set_ylim(y_range)
+        if len(pairs) > 0:
+            self.canvas.draw_idle()
+
+    def set_overlay(self, indices):
+        """
+        Display points of given indices over histograms.
+        """
+        for (var_x, var_y), overlay in self._overlays.items():
+            overlay.set_offsets(np.column_stack([
+                self.hists.variables[var_x][indices], 
+                self.hists.variables[var_y][indices],
+                ]))
+        self.canvas.draw_idle()
+
+
+class ProfilingPanel(QWidget):
+    """
+    Table of measurements of pipeline stages, exportable in JSON.
+    """
+
+    columns = {
+        'stage': ('stage', 1),
+        'status': ('status', 1),
+        'wall_time': ('wall (s)', 1),
+        'cpu_time': ('CPU (s)', 1),
+        'peak_rss': ('peak RSS (MB)', 2**20),
+        'input_bytes': ('input (MB)', 2**20),
+        'output_bytes': ('output (MB)', 2**20),
+        'voxels_per_s': ('Mvoxels/s', 1e6),
+        'spots_per_s': ('spots/s', 1),
+    }
+
+    def __init__(self, profiler, *args, **kwargs):
+        super(ProfilingPanel, self).__init__(*args, **kwargs)
+
+        self.profiler = profiler
+        self.table = QTableWidget(0, len(self.columns))
+        self.table.setHorizontalHeaderLabels([label for label, _ in self.columns.values()])
+        self.chk_cprofile = QCheckBox('cProfile stages')
+        self.chk_cprofile.setChecked(self.profiler.dir_profiles is not None)
+        self.chk_cprofile.toggled.connect(self._set_cprofile)
+        self.but_export = QPushButton()
+        self.but_export.setText('Export JSON')
+        self.but_export.clicked.connect(self._export)
+        self.but_clear = QPushButton()
+        self.but_clear.setText('Clear')
+        self.but_clear.clicked.connect(self._clear)
+
+        buttonsLayout = QHBoxLayout()
+        buttonsLayout.addWidget(self.chk_cprofile)
+        buttonsLayout.addWidget(self.but_export)
+        buttonsLayout.addWidget(self.but_clear)
+        layout = QVBoxLayout()
+        layout.addWidget(self.table)
+        layout.addLayout(buttonsLayout)
+        self.setLayout(layout)
+        self.update_table()
+
+    def update_table(self):
+        records = list(self.profiler.records)
+        self.table.setRowCount(len(records))
+        for row, record in enumerate(records):
+            for col, (name, (_, unit)) in enumerate(self.columns.items()):
+                value = record.get(name, '')
+                if isinstance(value, (int, float)):
+                    value = f"{value / unit:.4g}"
+                self.table.setItem(row, col, QTableWidgetItem(str(value)))
+
+    def _set_cprofile(self, checked):
+        dir_profiles = None
+        if checked:
+            dir_profiles = QFileDialog.getExistingDirectory(self, "Directory of cProfile statistics")
+            if dir_profiles == '':
+                self.chk_cprofile.setChecked(False)
+                return
+        self.profiler.dir_profiles = dir_profiles
+
+    def _export(self):
+        path_save = QFileDialog.getSaveFileName(self, 'Export profiling report', "", "JSON Files (*.json)")[0]
+        if path_save != '':
+            if not path_save.endswith('.json'):
+                path_save = path_save + '.json'
+            self.profiler.to_json(path_save)
+            print("profiling report saved in", path_save)
+
+    def _clear(self):
+        self.profiler.clear()
+        self.update_table()
+
+
 class SpotDetection(QWidget):
     def __init__(self, napari_viewer):
         super().__init__()
         self.viewer = napari_viewer
         # automatic adaptation of parameters when steps complete, False when loading parameters
         self.auto_params = True 
-        self.spots3d = None
+        self._spots3d = None
+        # background worker running a pipeline stage
+        self._worker = None
+        # stages run one after the other when applying parameters to the full dataset
+        self._pipeline_queue = []
+        # layer from which tuning sub-volumes are extracted
+        self._tuning_source_layer = None
+        # outputs of pipeline stages, and cache keys of the last run of each stage
+        self._cache = StageCache(max_bytes=4 * 2**30)
+        self._stage_keys = {}
+        # chunk plans of the last run of each stage, with the workers of CPU engines
+        self._chunk_plans = {}
+        # generated PSFs, kept on disk across sessions
+        self._psf_cache = PSFCache()
+        # measurements of pipeline stages
+        self._profiler = StageProfiler()
+        self._profiling_panel = None
+        # local maxima of the DoG sorted by value, for the threshold preview
+        self._dog_maxima = None
+        # fitted sigmas and distances relative to the expected spot size of the model
+        self._sigmas_xy_factors = None
+        self._sigmas_z_factors = None
+        self._dist_fit_xy_factors = None
+        self._dist_fit_z_factors = None
+        # cached filtering conditions of fitted spots, for live filtering
+        self._spot_filter = None
+        # selection previewed while sliders move, exported spots use the model selection
+        self._spot_preview = None
+        # histograms of fitted parameters displayed in a dock widget
+        self._pair_plot = None
+        # percentile ranges of fitted parameters, computed once per fit or percentiles change
+        self._percentile_ranges = None
         
         self.setLayout(QVBoxLayout())
         self.layout().setSpacing(0)
@@ -121,8 +320,14 @@ class SpotDetection(QWidget):
         wdg_layout.setContentsMargins(10, 10, 10, 10)
         wdg.setLayout(wdg_layout)
         
+        self.progress_groupBox = self._create_progress_groupBox()
+        wdg_layout.addWidget(self.progress_groupBox)
+
         self.spot_size_groupBox = self._create_spot_size_groupBox()
         wdg_layout.addWidget(self.spot_size_groupBox)
+
+        self.tuning_groupBox = self._create_tuning_groupBox()
+        wdg_layout.addWidget(self.tuning_groupBox)
         
         self.deconv_groupBox = self._create_deconv_groupBox()
         wdg_layout.addWidget(self.deconv_groupBox)
@@ -142,9 +347,143 @@ class SpotDetection(QWidget):
         self.save_groupBox = self._create_save_groupBox()
         wdg_layout.addWidget(self.save_groupBox)
 
+        # buttons disabled while a stage runs in the background
+        self._pipeline_buttons = [
+            self.but_make_psf,
+            self.but_load_psf,
+            self.but_load_model,
+            self.but_apply_full,
+            self.but_run_deconvolution,
+            self.but_auto_sigmas,
+            self.but_dog,
+            self.but_find_peaks,
+            self.but_merge_peaks,
+            self.but_fit,
+            self.but_plot_fitted,
+            self.but_plot_fitted_2D,
+            self.but_filter,
+            self.but_inspect,
+            self.but_save_spots,
+            self.but_load_spots,
+            self.but_save_parameters,
+            self.but_load_parameters,
+        ]
+
         return wdg
     
 
+    def _create_progress_groupBox(self):
+        group = QGroupBox(title="Progress")
+        group.setCheckable(False)
+        group.setSizePolicy(QSizePolicy(QSizePolicy.Minimum, QSizePolicy.Minimum))
+        group_layout = QVBoxLayout()
+        group.setLayout(group_layout)
+
+        self.lab_stage = QLabel('idle')
+        self.pgb_stage = QProgressBar()
+        self.pgb_stage.setRange(0, 1)
+        self.pgb_stage.setValue(0)
+        self.but_cancel_stage = QPushButton()
+        self.but_cancel_stage.setText('Cancel')
+        self.but_cancel_stage.setEnabled(False)
+        self.but_cancel_stage.clicked.connect(self._cancel_stage)
+        self.but_profiling = QPushButton()
+        self.but_profiling.setText('Profiling')
+        self.but_profiling.clicked.connect(self._show_profiling)
+
+        # computing engine of pipeline stages
+        self.lab_engine = QLabel('compute on')
+        self.cbx_engine = QComboBox()
+        self.cbx_engine.addItems(['GPU', 'CPU'])
+        if import_spots3d() is None:
+            # without the GPU stack of opm-merfish-analysis all stages run on CPU
+            self.cbx_engine.setCurrentText('CPU')
+            self.cbx_engine.model().item(0).setEnabled(False)
+        # memory budget used to choose the size of chunks of stages
+        self.lab_chunk_budget = QLabel('chunk memory (GB)')
+        self.txt_chunk_budget = QLineEdit()
+        self.txt_chunk_budget.setText('4')
+
+        # layout for progress of pipeline stages
+        engineLayout = QHBoxLayout()
+        engineLayout.addWidget(self.lab_engine)
+        engineLayout.addWidget(self.cbx_engine)
+        engineLayout.addWidget(self.lab_chunk_budget)
+        engineLayout.addWidget(self.txt_chunk_budget)
+        group_layout.addLayout(engineLayout)
+        progressLayout = QHBoxLayout()
+        progressLayout.addWidget(self.lab_stage)
+        progressLayout.addWidget(self.pgb_stage)
+        progressLayout.addWidget(self.but_cancel_stage)
+        progressLayout.addWidget(self.but_profiling)
+        group_layout.addLayout(progressLayout)
+
+        # cache of stages outputs
+        self.lab_cache_size = QLabel('cache size (GB)')
+        self.txt_cache_size = QLineEdit()
+        self.txt_cache_size.setText('4')
+        self.txt_cache_size.editingFinished.connect(self._set_cache_size)
+        self.but_cache_dir = QPushButton()
+        self.but_cache_dir.setText('Disk cache directory')
+        self.but_cache_dir.clicked.connect(self._set_cache_dir)
+        self.but_clear_cache = QPushButton()
+        self.but_clear_cache.setText('Clear cache')
+        self.but_clear_cache.clicked.connect(self._clear_cache)
+
+        # layout for cache
+        cacheLayout = QHBoxLayout()
+        cacheLayout.addWidget(self.lab_cache_size)
+        cacheLayout.addWidget(self.txt_cache_size)
+        cacheLayout.addWidget(self.but_cache_dir)
+        cacheLayout.addWidget(self.but_clear_cache)
+        group_layout.addLayout(cacheLayout)
+
+        return group
+
+
+    def _create_tuning_groupBox(self):
+        group = QGroupBox(title="Tuning data")
+        group.setCheckable(False)
+        group.setSizePolicy(QSizePolicy(QSizePolicy.Minimum, QSizePolicy.Minimum))
+        group_layout = QVBoxLayout()
+        group.setLayout(group_layout)
+
+        # sub-volumes on which parameters are tuned
+        self.lab_tuning_source = QLabel('run pipeline on')
+        self.cbx_tuning_source = QComboBox()
+        self.cbx_tuning_source.addItems(['full image', 'random tiles', 'current view', 'drawn box'])
+        self.lab_nb_tiles = QLabel('nb tiles')
+        self.txt_nb_tiles = QLineEdit()
+        self.txt_nb_tiles.setText('4')
+        self.lab_tile_size = QLabel('tile size (z / y / x, 0 for full axis)')
+        self.txt_tile_z = QLineEdit()
+        self.txt_tile_z.setText('0')
+        self.txt_tile_y = QLineEdit()
+        self.txt_tile_y.setText('256')
+        self.txt_tile_x = QLineEdit()
+        self.txt_tile_x.setText('256')
+        self.but_apply_full = QPushButton()
+        self.but_apply_full.setText('Apply to full dataset')
+        self.but_apply_full.clicked.connect(self._apply_to_full_dataset)
+
+        # layout for tuning data
+        tuningSourceLayout = QHBoxLayout()
+        tuningSourceLayout.addWidget(self.lab_tuning_source)
+        tuningSourceLayout.addWidget(self.cbx_tuning_source)
+        tuningSourceLayout.addWidget(self.lab_nb_tiles)
+        tuningSourceLayout.addWidget(self.txt_nb_tiles)
+        group_layout.addLayout(tuningSourceLayout)
+        tileSizeLayout = QHBoxLayout()
+        tileSizeLayout.addWidget(self.lab_tile_size)
+        tileSizeLayout.addWidget(self.txt_tile_z)
+        tileSizeLayout.addWidget(self.txt_tile_y)
+        tileSizeLayout.addWidget(self.txt_tile_x)
+        group_layout.addLayout(tileSizeLayout)
+        group_layout.addWidget(self.but_apply_full)
+
+        return group
+
+
     def _create_spot_size_groupBox(self):
         group = QGroupBox(title="Physical parameters")
         group.setCheckable(False)
@@ -341,6 +680,7 @@ class SpotDetection(QWidget):
         self.sld_dog_thresh = QLabeledDoubleSlider(Qt.Orientation.Horizontal)
         self.sld_dog_thresh.setRange(0, 500)
         self.sld_dog_thresh.setValue(50)
+        self.sld_dog_thresh.valueChanged.connect(self._preview_dog_threshold)
         # self.sld_dog_thresh.setBarIsRigid(False) not implemented for QLabeledDoubleSlider :'(
         self.lab_dog_choice = QLabel('run DoG on:')
         self.cbx_dog_choice = QComboBox()
@@ -362,6 +702,9 @@ class SpotDetection(QWidget):
         self.sld_min_spot_z_factor = QLabeledDoubleSlider(Qt.Orientation.Horizontal)
         self.sld_min_spot_z_factor.setRange(0, 10)
         self.sld_min_spot_z_factor.setValue(2.5)
+        self.lab_deskew_display = QLabel('display skewed data with')
+        self.cbx_deskew_display = QComboBox()
+        self.cbx_deskew_display.addItems(['affine transform (no copy)', 'deskewed copy'])
         self.but_find_peaks = QPushButton()
         self.but_find_peaks.setText('Find peaks')
         self.but_find_peaks.clicked.connect(self._find_peaks)
@@ -397,6 +740,10 @@ class SpotDetection(QWidget):
         dogThreshLayout.addWidget(self.lab_dog_thresh)
         dogThreshLayout.addWidget(self.sld_dog_thresh)
         group_layout.addLayout(dogThreshLayout)
+        deskewDisplayLayout = QHBoxLayout()
+        deskewDisplayLayout.addWidget(self.lab_deskew_display)
+        deskewDisplayLayout.addWidget(self.cbx_deskew_display)
+        group_layout.addLayout(deskewDisplayLayout)
         group_layout.addWidget(self.but_find_peaks)
         mergePeaksLayout = QHBoxLayout()
         mergePeaksLayout.addWidget(self.lab_merge_peaks)
@@ -444,6 +791,8 @@ class SpotDetection(QWidget):
         self.txt_filter_percentile_min.setText('0')
         self.txt_filter_percentile_max = QLineEdit()
         self.txt_filter_percentile_max.setText('100')
+        self.txt_filter_percentile_min.editingFinished.connect(self._reset_percentile_ranges)
+        self.txt_filter_percentile_max.editingFinished.connect(self._reset_percentile_ranges)
 
         self.but_plot_fitted = QPushButton()
         self.but_plot_fitted.setText('Plot fitted parameters')
@@ -451,6 +800,10 @@ class SpotDetection(QWidget):
         self.but_plot_fitted_2D = QPushButton()
         self.but_plot_fitted_2D.setText('Plot 2D distributions')
         self.but_plot_fitted_2D.clicked.connect(self._plot_fitted_params_2D)
+        self.lab_plot_overlay = QLabel('overlaid filtered spots')
+        self.txt_plot_overlay = QLineEdit()
+        self.txt_plot_overlay.setText('0')
+        self.txt_plot_overlay.editingFinished.connect(self._update_pair_plot_overlay)
 
         # layout for fitting gaussian spots
         nspotsLayout = QHBoxLayout()
@@ -468,6 +821,10 @@ class SpotDetection(QWidget):
         plotFittedLayout.addWidget(self.but_plot_fitted)
         plotFittedLayout.addWidget(self.but_plot_fitted_2D)
         group_layout.addLayout(plotFittedLayout)
+        plotOverlayLayout = QHBoxLayout()
+        plotOverlayLayout.addWidget(self.lab_plot_overlay)
+        plotOverlayLayout.addWidget(self.txt_plot_overlay)
+        group_layout.addLayout(plotOverlayLayout)
         percentileLayout = QHBoxLayout()
         percentileLayout.addWidget(self.lab_filter_percentile)
         percentileLayout.addWidget(self.txt_filter_percentile_min)
@@ -555,6 +912,27 @@ class SpotDetection(QWidget):
         self.but_inspect= QPushButton()
         self.but_inspect.setText('Inspect filtering')
         self.but_inspect.clicked.connect(self._inspect_filtering)
+        # update filtered spots while sliders move
+        for slider in [
+            self.sld_filter_amplitude_range,
+            self.sld_filter_sigma_xy_factor,
+            self.sld_filter_sigma_z_factor,
+            self.sld_filter_sigma_ratio_range,
+            self.sld_fit_dist_max_err_z_factor,
+            self.sld_fit_dist_max_err_xy_factor,
+            self.sld_min_spot_sep_z_factor,
+            self.sld_min_spot_sep_xy_factor,
+            self.sld_dist_boundary_z_factor,
+            self.sld_dist_boundary_xy_factor,
+            ]:
+            slider.valueChanged.connect(self._live_filter_spots)
+        for slider in [
+            self.sld_filter_amplitude_range,
+            self.sld_filter_sigma_xy_factor,
+            self.sld_filter_sigma_z_factor,
+            self.sld_filter_sigma_ratio_range,
+            ]:
+            slider.valueChanged.connect(self._update_pair_plot)
 
         # layout for filtering gaussian spots
         filterLayout = QGridLayout()
@@ -671,28 +1049,20 @@ class SpotDetection(QWidget):
 
     def _make_psf(self):
 
-        oversampling = 10
         na, ri, wvl, dc, dstage, theta = self._get_phy_params(theta_as_rad=True)
-        psf_model = fit_psf.gridded_psf_model(
-            wavelength=wvl,
-            ni=ri,
-            model_name="vectorial",
-            dc=dc / oversampling,
-            sf=1,
-            # /!\ check about theta's position!
-            angles=(0., 0., theta),  # in radians
-        )
-        # p: ["A", "cx", "cy", "cz", "na", "bg"]
-        # "amplitude", "x-coordinate center", "y-coordinate center", "z-coordinate center", "numerical aperture", and "background"
-        p = [1, 0, 0, 0, na, 0]
-        coords = fit_psf.get_psf_coords(ns=[15, 150, 150], # number of pixels
-                                        drs=[dstage, dc / oversampling, dc / oversampling])
-        psf = psf_model.model(coords, p)
-        # resample image by binning
-        bin_size_list = (1,) * (psf.ndim - 2) + (oversampling, oversampling)
-        self.psf = camera.bin(psf, bin_size_list, mode='sum')
+        psf_params = get_psf_params(na, ri, wvl, dc, dstage, theta)
+        psf = self._psf_cache.get(psf_params)
+        if psf is None:
+            with self._profiler.profile('PSF generation') as record:
+                self.psf = make_psf(**psf_params)
+                record.update(nb_voxels=self.psf.size, output_bytes=self.psf.nbytes)
+            self._update_profiling()
+            self._psf_cache.put(psf_params, self.psf)
+            print("PSF generated")
+        else:
+            self.psf = psf
+            print("PSF restored from cache")
         self._psf_origin = 'generated'
-        print("PSF generated")
 
 
     def _load_psf(self):
@@ -706,19 +1076,16 @@ class SpotDetection(QWidget):
             print("PSF loaded")
 
 
-    def _get_selected_image(self):
+    def _get_selected_layer(self):
         if len(self.viewer.layers) == 0:
             print("Open an image first")
         else:
             if len(self.viewer.layers.selection) == 0:
-                img = self.viewer.layers[0].data
-                scale = self.viewer.layers[0].scale
+                layer = self.viewer.layers[0]
             else:
                 # selection is a set, we need some wrangle to get the first element
-                first_selected_layer = next(iter(self.viewer.layers.selection))
-                img = first_selected_layer.data
-                scale = first_selected_layer.scale
-            return img, scale
+                layer = next(iter(self.viewer.layers.selection))
+            return layer
 
     def _add_image(self, data, name=None, **kwargs):
         """
@@ -744,13 +1111,244 @@ class SpotDetection(QWidget):
             else:
                 self.viewer.layers[name].data = data
 
+    def _start_stage(self, name, compute, on_done=None, measure=None):
+        """
+        Run a pipeline stage in a background worker to keep the viewer responsive.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage displayed in the progress panel.
+        compute : callable
+            Generator function performing the computation. It yields `(step, nb_steps)`
+            to report progress, the stage can be cancelled at each yield.
+        on_done : callable, optional
+            Function called in the main thread with the value returned by `compute`
+            when it finishes, used to update layers and widgets.
+        measure : callable, optional
+            Function returning sizes of inputs and outputs of the stage, like
+            'nb_voxels' or 'nb_spots', added to its profiling record.
+        """
+
+        if self._worker is not None:
+            print(f"Wait for {self.lab_stage.text()} to finish")
+            return
+        print(f"starting {name}")
+        self.lab_stage.setText(name)
+        # busy indicator until the first progress report
+        self.pgb_stage.setRange(0, 0)
+        for button in self._pipeline_buttons:
+            button.setEnabled(False)
+        self.but_cancel_stage.setEnabled(True)
+
+        def report_progress(progress):
+            step, nb_steps = progress
+            self.pgb_stage.setRange(0, nb_steps)
+            self.pgb_stage.setValue(step)
+
+        def finish_stage(result):
+            print(f"finished {name}")
+            if on_done is not None:
+                on_done(result)
+
+        def report_error(error):
+            print(f"{name} failed: {error}")
+            self._pipeline_queue.clear()
+
+        def report_abort():
+            print(f"{name} cancelled")
+            self._pipeline_queue.clear()
+
+        def profiled_compute():
+            with self._profiler.profile(name) as record:
+                result = yield from compute()
+                if measure is not None:
+                    record.update(measure())
+            return result
+
+        self._worker = create_worker(profiled_compute, _start_thread=False)
+        self._worker.yielded.connect(report_progress)
+        self._worker.returned.connect(finish_stage)
+        self._worker.errored.connect(report_error)
+        self._worker.aborted.connect(report_abort)
+        self._worker.finished.connect(self._end_stage)
+        self._worker.start()
+
+    def _end_stage(self):
+        self._worker = None
+        self.lab_stage.setText('idle')
+        self.pgb_stage.setRange(0, 1)
+        self.pgb_stage.setValue(0)
+        self.but_cancel_stage.setEnabled(False)
+        for button in self._pipeline_buttons:
+            button.setEnabled(True)
+        self._update_profiling()
+        if len(self._pipeline_queue) > 0:
+            self._run_queued(self._pipeline_queue.pop(0))
+
+    def _show_profiling(self):
+        """
+        Display measurements of pipeline stages in a dock widget.
+        """
+        if self._profiling_panel is None:
+            self._profiling_panel = ProfilingPanel(self._profiler)
+            self.viewer.window.add_dock_widget(self._profiling_panel, name='Profiling', area='right')
+        self._profiling_panel.update_table()
+
+    def _update_profiling(self):
+        if self._profiling_panel is not None:
+            self._profiling_panel.update_table()
+
+    def _cancel_stage(self):
+        """
+        Stop the running stage at its next progress report.
+        """
+        if self._worker is not None:
+            self.lab_stage.setText(f"cancelling {self.lab_stage.text()}")
+            self._worker.quit()
+
+    def _set_cache_size(self):
+        self._cache.max_bytes = int(float(self.txt_cache_size.text()) * 2**30)
+
+    def _set_cache_dir(self):
+        dir_cache = QFileDialog.getExistingDirectory(self, "Select a directory for the disk cache")
+        if dir_cache != '':
+            self._cache.dir_cache = Path(dir_cache)
+            print("stages outputs are also cached in", dir_cache)
+
+    def _clear_cache(self):
+        self._cache.clear()
+        # PSFs files are kept, they only depend on the microscope
+        self._psf_cache.clear()
+        print("cache cleared")
+
+    def _run_cached(self, stage, key, run, attributes):
+        """
+        Run a step of the model, or restore its outputs if they are cached.
+        It yields the progress of steps run by chunks, to be used with `yield from`
+        in stages.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage, used to chain cache keys of following stages.
+        key : str | None
+            Cache key made from the inputs and parameters of the stage,
+            None disables caching.
+        run : callable
+            Function running the step of the model. CPU steps return a generator
+            of progress reports, run until its end.
+        attributes : list
+            Names of the model attributes computed by the step.
+        """
+
+        cached = None if key is None else self._cache.get(key)
+        if cached is None:
+            steps = run()
+            if steps is not None:
+                yield from steps
+            if key is not None:
+                self._cache.put(key, {name: getattr(self._spots3d, name) for name in attributes})
+        else:
+            for name, value in cached.items():
+                setattr(self._spots3d, name, value)
+            print(f"{stage} outputs restored from cache")
+        self._stage_keys[stage] = key
+
+    def _get_tuning_image(self):
+        """
+        Get the selected image, or the sub-volumes chosen in the tuning panel
+        so that parameters are tuned on a small part of big acquisitions.
+        """
+        layer = self._get_selected_layer()
+        if layer is None:
+            return None, None
+        if layer.name == 'tuning data' and self._tuning_source_layer is not None:
+            layer = self._tuning_source_layer
+        self._tuning_source_layer = layer
+        img, scale = layer.data, layer.scale
+
+        source = self.cbx_tuning_source.currentText()
+        if source == 'random tiles':
+            tile_shape = [int(self.txt_tile_z.text()), int(self.txt_tile_y.text()), int(self.txt_tile_x.text())]
+            tiles = sample_tiles(img.shape, tile_shape, int(self.txt_nb_tiles.text()))
+            img = assemble_tiles(img, tiles, gap=self._get_tiles_gap())
+        elif source == 'current view':
+            # corners of the displayed region, full range along non-displayed axes
+            corners = np.asarray(layer.corner_pixels)
+            view = tuple(slice(int(start), int(stop) + 1) if axis in self.viewer.dims.displayed else slice(None)
+                         for axis, (start, stop) in enumerate(corners.T))
+            img = np.asarray(img[view])
+        elif source == 'drawn box':
+            if 'tuning box' not in self.viewer.layers or len(self.viewer.layers['tuning box'].data) == 0:
+                if 'tuning box' not in self.viewer.layers:
+                    self.viewer.add_shapes(name='tuning box', ndim=img.ndim, edge_color='yellow', face_color=[0, 0, 0, 0])
+                print("Draw a box in the 'tuning box' layer first")
+                return None, None
+            box = self.viewer.layers['tuning box'].data[-1] / scale
+            lower = np.clip(np.floor(box.min(axis=0)).astype(int), 0, img.shape)
+            upper = np.clip(np.ceil(box.max(axis=0)).astype(int) + 1, 0, img.shape)
+            # the box is drawn on a slice, it covers the full range along other axes
+            view = tuple(slice(start, stop) if axis in self.viewer.dims.displayed else slice(None)
+                         for axis, (start, stop) in enumerate(zip(lower, upper)))
+            img = np.asarray(img[view])
+        if source != 'full image':
+            print(f"tuning on sub-volume of shape {img.shape}")
+            self._add_image(img, name='tuning data', scale=scale)
+        return img, scale
+
+    def _get_tiles_gap(self):
+        """
+        Gap between assembled tiles, wider than the support of the DoG filter
+        and the fit ROIs along x so that tiles don't bleed into each other.
+        """
+        na, _, wvl, dc, _, _ = self._get_phy_params()
+        # gaussian approximation of the PSF width in pixels, the model isn't built yet
+        sigma_xy = 0.22 * wvl / na / dc
+        # gaussian filters are truncated at 4 sigmas
+        dog_support = 4 * self.sld_dog_sigma_x_factor.value()[1] * sigma_xy
+        roi_size = float(self.txt_roi_x_factor.text()) * sigma_xy
+        return int(np.ceil(max(dog_support, roi_size, 1)))
+
+    def _run_queued(self, stage):
+        """
+        Start a stage of the pipeline queue, and clear the queue if the stage
+        doesn't start, like when its inputs are missing.
+        """
+        try:
+            stage()
+        finally:
+            if self._worker is None:
+                self._pipeline_queue.clear()
+
+    def _apply_to_full_dataset(self):
+        """
+        Run the whole pipeline with current parameters on the full image.
+        """
+        self.cbx_tuning_source.setCurrentIndex(0)
+        if self._tuning_source_layer is not None:
+            self.viewer.layers.selection.active = self._tuning_source_layer
+        self._get_spot3d()
+        if self._spots3d is None:
+            return
+        if self.cbx_dog_choice.currentIndex() == 0:
+            self._pipeline_queue = [self._compute_dog, self._find_peaks, self._fit_spots, self._filter_spots]
+            self._run_queued(self._run_deconvolution)
+        else:
+            self._pipeline_queue = [self._find_peaks, self._fit_spots, self._filter_spots]
+            self._run_queued(self._compute_dog)
+
     def _get_spot3d(self):
         """
         Create an instance of the `SPOT3D` class.
         It includes the image and parameters for analysis.
         Some paramaters will be updated by following steps. 
         """
-        img, self.scale = self._get_selected_image()
+        img, self.scale = self._get_tuning_image()
+        if img is None:
+            # don't run following stages on the image of a previous model
+            self._spots3d = None
+            return
         na, ri, wvl, dc, dstage, theta = self._get_phy_params()
         metadata = {'pixel_size' : dc,
                     'scan_step' : dstage,
@@ -759,26 +1357,109 @@ class SpotDetection(QWidget):
                              'ri' : ri,
                              'theta' : theta}
 
-        self._spots3d = SPOTS3D(
+        # the CPU model runs all stages without the GPU stack
+        model_class = import_spots3d() or SpotModel
+        self._spots3d = model_class(
             data = img,
             psf = self.psf, 
             metadata= metadata,
             microscope_params=microscope_params,
             )
+        # downstream cache keys derive from the image and PSF fingerprints
+        self._stage_keys = {
+            'data': make_key('data', fingerprint_array(img), fingerprint_array(self.psf),
+                             metadata, microscope_params),
+        }
         print("model instanciated")
 
 
     def _run_deconvolution(self):
-        print("starting deconvolution")
         new_decon_params = {
             'iterations' : int(self.txt_deconv_iter.text()),
             'tv_tau' : float(self.txt_deconv_tvtau.text()),
         }
         self._spots3d.decon_params = new_decon_params
-        self._spots3d.scan_chunk_size = 128 # GPU out-of-memory on OPM PC if > 128
-        self._spots3d.run_deconvolution()
-        print("finished deconvolution")
-        self._add_image(data=self._spots3d.decon_data, name='deconv', scale=self.scale)
+        self._plan_chunks('deconvolution', self._spots3d.data, 
+                          psf_shape=self.psf.shape, tv_tau=new_decon_params['tv_tau'])
+        engine = self.cbx_engine.currentText()
+        if engine == 'CPU':
+            run = self._run_decon_cpu
+        else:
+            run = self._spots3d.run_deconvolution
+        key = make_key('deconvolution', self._stage_keys['data'], new_decon_params, engine)
+
+        def compute():
+            yield 0, 1
+            yield from self._run_cached('deconvolution', key, run, ['_decon_data'])
+            yield 1, 1
+
+        def show(_):
+            self._add_image(data=self._spots3d.decon_data, name='deconv', scale=self.scale)
+
+        def measure():
+            return {
+                'nb_voxels': self._spots3d.data.size,
+                'input_bytes': self._spots3d.data.nbytes,
+                'output_bytes': self._spots3d._decon_data.nbytes,
+            }
+
+        self._start_stage('deconvolution', compute, show, measure)
+
+    def _get_spacing(self):
+        """
+        Pixel spacing of the model image along z, y and x.
+        """
+        return [self._spots3d._image_params['scan_step'], 
+                self._spots3d._image_params['pixel_size'], 
+                self._spots3d._image_params['pixel_size']]
+
+    def _plan_chunks(self, stage, img, **kwargs):
+        """
+        Set the chunk size of the model to the largest one fitting the memory budget.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage, see `plan_chunks`.
+        img : ndarray
+            Image processed by the stage.
+        kwargs : dict
+            Parameters of the stage footprint, like the PSF shape or DoG sigmas.
+        """
+        memory_budget = int(float(self.txt_chunk_budget.text()) * 2**30)
+        # CPU engines process chunks in parallel, the GPU one by one and
+        # within the limits of its own memory
+        if self.cbx_engine.currentText() == 'CPU':
+            n_workers, max_chunk_size = os.cpu_count(), None
+        else:
+            n_workers, max_chunk_size = 1, GPU_MAX_CHUNK_SIZE[stage]
+        plan = plan_chunks(stage, img.shape, img.dtype, memory_budget=memory_budget, 
+                           n_workers=n_workers, max_chunk_size=max_chunk_size, **kwargs)
+        print(format_plan(plan))
+        self._chunk_plans[stage] = plan
+        self._spots3d.scan_chunk_size = plan['chunk_size']
+
+    def _profiled_deskew(self, data):
+        """
+        Deskew the whole model image, for the 'deskewed copy' display.
+        """
+        # from opm-merfish-analysis, imported here so the plugin loads without it
+        from _imageprocessing import deskew
+        with self._profiler.profile('deskew') as record:
+            deskewed = deskew(
+                data, 
+                self._spots3d._image_params['pixel_size'], 
+                self._spots3d._image_params['scan_step'], 
+                self._spots3d._image_params['theta'],
+                )
+            record.update(nb_voxels=data.size, input_bytes=data.nbytes, output_bytes=deskewed.nbytes)
+        return deskewed
+
+    def _run_decon_cpu(self):
+        """
+        Deconvolve the image with the CPU engine, by chunks whose progress is yielded.
+        """
+        return iter_deconvolution(self._spots3d, n_workers=self._chunk_plans['deconvolution']['n_workers'])
 
     def _run_adaptive_histogram(self):
         print('Not implemented yet')
@@ -813,22 +1494,95 @@ class SpotDetection(QWidget):
         if self._spots3d is None:
             print("Setup the spot localization model first.")
         else:
-            print("starting DoG filter")
             if self.cbx_dog_choice.currentIndex() == 0:
                 self._spots3d.dog_filter_source_data = 'decon'
             else:
                 self._spots3d.dog_filter_source_data = 'raw'
-            # add choice of chunk size in GUI?
-            self._spots3d.scan_chunk_size = 64 # GPU out-of-memory on OPM PC if > 64
-            self._spots3d.run_DoG_filter()
-            print("finished DoG filter")
-            self._add_image(
-                data=self._spots3d.dog_data, 
-                name='DoG', 
-                scale=self.scale,
-                # Remark: use _dog_data instead to get the Dask format?
-                contrast_limits=[0, self._spots3d.dog_data.max()],
+            self._spots3d.DoG_filter_params = {
+                'sigma_small_x_factor' : self.sld_dog_sigma_x_factor.value()[0],
+                'sigma_small_y_factor' : self.sld_dog_sigma_y_factor.value()[0],
+                'sigma_small_z_factor' : self.sld_dog_sigma_z_factor.value()[0],
+                'sigma_large_x_factor' : self.sld_dog_sigma_x_factor.value()[1],
+                'sigma_large_y_factor' : self.sld_dog_sigma_y_factor.value()[1],
+                'sigma_large_z_factor' : self.sld_dog_sigma_z_factor.value()[1],
+            }
+            if self._spots3d.dog_filter_source_data == 'decon':
+                img = self._spots3d._decon_data
+            else:
+                img = self._spots3d.data
+            _, sigmas_large = get_dog_sigmas(
+                self._spots3d.DoG_filter_params, 
+                sigma_z=self._spots3d._sigma_z, 
+                sigma_xy=self._spots3d._sigma_xy, 
+                spacing=self._get_spacing(),
                 )
+            self._plan_chunks('DoG filter', img, sigmas=sigmas_large)
+            engine = self.cbx_engine.currentText()
+            if engine == 'CPU':
+                run = self._run_dog_cpu
+            else:
+                run = self._spots3d.run_DoG_filter
+            if self._spots3d.dog_filter_source_data == 'decon':
+                source_key = self._stage_keys.get('deconvolution')
+            else:
+                source_key = self._stage_keys['data']
+            key = None if source_key is None else make_key(
+                'DoG filter', source_key, self._spots3d.dog_filter_source_data,
+                self._spots3d.DoG_filter_params, engine)
+
+            def compute():
+                yield 0, 3
+                yield from self._run_cached('DoG filter', key, run, ['_dog_data'])
+                yield 1, 3
+                dog_max = self._spots3d.dog_data.max()
+                yield 2, 3
+                # index of all local maxima, so the threshold can be previewed instantly
+                coords, values = find_local_maxima(self._spots3d.dog_data)
+                self._dog_maxima = (coords * np.asarray(self.scale), values)
+                yield 3, 3
+                return dog_max
+
+            def show(dog_max):
+                self._add_image(
+                    data=self._spots3d.dog_data, 
+                    name='DoG', 
+                    scale=self.scale,
+                    # Remark: use _dog_data instead to get the Dask format?
+                    contrast_limits=[0, dog_max],
+                    )
+                self._preview_dog_threshold(self.sld_dog_thresh.value())
+
+            def measure():
+                return {
+                    'nb_voxels': img.size,
+                    'input_bytes': img.nbytes,
+                    'output_bytes': self._spots3d._dog_data.nbytes,
+                }
+
+            self._start_stage('DoG filter', compute, show, measure)
+
+
+    def _run_dog_cpu(self):
+        """
+        Compute the DoG filter with the CPU engine, by chunks whose progress is yielded.
+        """
+        return iter_dog_filter(self._spots3d, n_workers=self._chunk_plans['DoG filter']['n_workers'])
+
+    def _preview_dog_threshold(self, threshold):
+        """
+        Display local maxima of the DoG above the threshold while the slider moves,
+        before peaks are found and merged with 'Find peaks'.
+        """
+        if self._dog_maxima is None:
+            return
+        coords, values = self._dog_maxima
+        self._add_points(
+            select_local_maxima(coords, values, threshold), 
+            name='local maxis',
+            blending='additive', 
+            size=0.25, 
+            face_color='r',
+            )
 
 
     def _find_peaks(self):
@@ -838,40 +1592,79 @@ class SpotDetection(QWidget):
         if 'DoG' not in self.viewer.layers:
             print("Run a DoG filter on an image first")
         else:
-            print("starting find candidates")
             self._spots3d.find_candidates_params = {
                 'threshold' : self.sld_dog_thresh.value(),
                 'min_spot_xy' : self.sld_min_spot_xy_factor.value(),
                 'min_spot_z' : self.sld_min_spot_z_factor.value(),
                 }
-            self._spots3d.scan_chunk_size = 64 # GPU timeout on OPM if > 64. Will change registry settings for TDM timeout.
-            self._spots3d.run_find_candidates()
-            print("finished find candidates")
-
-            # # used variables for gaussian fit if peaks are not merged
-            # self._peaks_merged = False
-            # self._use_centers = self._spots3d._spot_candidates
-            # self._use_amps = self._spots3d._amps
-            # print(self._spots3d._spot_candidates)
-            # print(self._spots3d._spot_candidates.shape) # debug
-        
+            self._plan_chunks('find candidates', self._spots3d._dog_data)
             theta = self._spots3d._image_params['theta'] 
-            if (theta > 0) and ('deskewed' not in self.viewer.layers):
-                pixel_size = self._spots3d._image_params['pixel_size'] 
-                scan_step = self._spots3d._image_params['scan_step'] 
-                # deskewed_data = deskew(np.array(self._spots3d._decon_data), pixel_size, scan_step, theta)
-                deskewed_data = deskew(self._spots3d.data, pixel_size, scan_step, theta)
-                self._add_image(deskewed_data, name='deskewed', scale=[pixel_size, pixel_size, pixel_size])
+            pixel_size = self._spots3d._image_params['pixel_size'] 
+            scan_step = self._spots3d._image_params['scan_step'] 
+            need_deskew = (theta > 0) and ('deskewed' not in self.viewer.layers)
+            use_affine = self.cbx_deskew_display.currentIndex() == 0
+            engine = self.cbx_engine.currentText()
+            if engine == 'CPU':
+                run = self._run_find_candidates_cpu
+            else:
+                run = self._spots3d.run_find_candidates
+            dog_key = self._stage_keys.get('DoG filter')
+            key = None if dog_key is None else make_key(
+                'find candidates', dog_key, self._spots3d.find_candidates_params, engine)
+
+            def compute():
+                yield 0, 2
+                yield from self._run_cached('find candidates', key, run, ['_spot_candidates'])
+                yield 1, 2
+
+                # # used variables for gaussian fit if peaks are not merged
+                # self._peaks_merged = False
+                # self._use_centers = self._spots3d._spot_candidates
+                # self._use_amps = self._spots3d._amps
+                # print(self._spots3d._spot_candidates)
+                # print(self._spots3d._spot_candidates.shape) # debug
+            
+                deskewed_data = None
+                if need_deskew and not use_affine:
+                    # deskewed_data = deskew(np.array(self._spots3d._decon_data), pixel_size, scan_step, theta)
+                    # the full volume is deskewed, the affine display avoids this copy
+                    deskewed_data = self._profiled_deskew(np.asarray(self._spots3d.data))
+                yield 2, 2
+                return deskewed_data
+
+            def show(deskewed_data):
+                if need_deskew and use_affine:
+                    # raw data displayed in the deskewed frame, without copy
+                    self._add_image(self._spots3d.data, name='deskewed', 
+                                    affine=get_deskew_affine(pixel_size, scan_step, theta))
+                elif deskewed_data is not None:
+                    self._add_image(deskewed_data, name='deskewed', scale=[pixel_size, pixel_size, pixel_size])
+
+                self._add_points(
+                    self._spots3d._spot_candidates[:, :3], 
+                    name='local maxis',
+                    blending='additive', 
+                    size=0.25, 
+                    face_color='r',
+                    )
+
+            def measure():
+                return {
+                    'nb_voxels': self._spots3d._dog_data.size,
+                    'nb_spots': len(self._spots3d._spot_candidates),
+                    'input_bytes': self._spots3d._dog_data.nbytes,
+                    'output_bytes': self._spots3d._spot_candidates.nbytes,
+                }
 
-            self._add_points(
-                self._spots3d._spot_candidates[:, :3], 
-                name='local maxis',
-                blending='additive', 
-                size=0.25, 
-                face_color='r',
-                )
+            self._start_stage('find candidates', compute, show, measure)
 
 
+    def _run_find_candidates_cpu(self):
+        """
+        Find candidate spots with the CPU engine, yielding its progress.
+        """
+        return iter_find_candidates(self._spots3d)
+
     def _merge_peaks(self):
         """
         Merge peaks that are close to each other.
@@ -908,13 +1701,71 @@ class SpotDetection(QWidget):
             'roi_y_factor' : float(self.txt_roi_y_factor.text()),
             'roi_x_factor' : float(self.txt_roi_x_factor.text()),
         }
-        print("starting fit spots")
-        self._spots3d.run_fit_candidates()
-        print("finished fit spots")
+
+        engine = self.cbx_engine.currentText()
+        if engine == 'CPU':
+            # planned here as Qt widgets are read on the main thread only
+            self._plan_fit()
+            run = self._run_fit_cpu
+        else:
+            run = self._spots3d.run_fit_candidates
+        candidates_key = self._stage_keys.get('find candidates')
+        key = None if candidates_key is None else make_key(
+            'fit spots', candidates_key, self._spots3d.fit_candidate_spots_params, engine)
+        # sliders are read here, not from the worker thread
+        max_sep_xy_factor = self.sld_min_spot_sep_xy_factor.maximum()
+        max_sep_z_factor = self.sld_min_spot_sep_z_factor.maximum()
+
+        def compute():
+            yield 0, 3
+            yield from self._run_cached('fit spots', key, run, ['_fit_params', '_chi_sqrs'])
+            yield 1, 3
+            self._process_fit_results()
+            yield 2, 3
+            self._spot_preview = None
+            self._spot_filter = self._make_spot_filter(
+                self._spots3d.fit_candidate_spots_params, max_sep_xy_factor, max_sep_z_factor)
+            yield 3, 3
+
+        def show(_):
+            self._add_points(self._centers, name='fitted spots', blending='additive', size=0.25, face_color='g')
+            print(f"Fitted {len(self._spots3d._fit_params)} spots")
+            self._update_filter_ranges()
+
+        def measure():
+            return {
+                'nb_spots': len(self._spots3d._fit_params),
+                'input_bytes': self._spots3d._spot_candidates.nbytes,
+                'output_bytes': self._spots3d._fit_params.nbytes + self._spots3d._chi_sqrs.nbytes,
+            }
+
+        self._start_stage('fit spots', compute, show, measure)
+
+    def _plan_fit(self):
+        """
+        Set the batches of gaussian fits of the CPU engine from the memory budget.
+        """
+        plan = plan_fit(
+            self._spots3d, 
+            memory_budget=int(float(self.txt_chunk_budget.text()) * 2**30), 
+            n_workers=os.cpu_count(),
+            )
+        print(format_plan(plan))
+        self._chunk_plans['fit spots'] = plan
+
+    def _run_fit_cpu(self):
+        """
+        Fit gaussians on candidate spots with the CPU engine, by batches whose progress is yielded.
+        """
+        plan = self._chunk_plans['fit spots']
+        return iter_fit_candidates(self._spots3d, batch_size=plan['chunk_size'], n_workers=plan['n_workers'])
+
+    def _process_fit_results(self):
+        """
+        Extract fitted parameters and derived quantities used for spot filtering.
+        """
 
         self._centers = self._spots3d._fit_params[:, 3:0:-1]
-        self._add_points(self._centers, name='fitted spots', blending='additive', size=0.25, face_color='g')
-        print(f"Fitted {len(self._spots3d._fit_params)} spots")
 
         # process all the results
         self._amplitudes = self._spots3d._fit_params[:, 0]
@@ -923,7 +1774,8 @@ class SpotDetection(QWidget):
         self._offsets = self._spots3d._fit_params[:, 6]
         self._chi_squared = self._spots3d._chi_sqrs
 
-        centers_guess = self._spots3d._spot_candidates[:, :3]
+        # only the first `n_spots_to_fit` candidates are fitted
+        centers_guess = self._spots3d._spot_candidates[:len(self._centers), :3]
         self._dist_fit_xy  = np.sqrt((centers_guess[:, 1] - self._centers[:, 1])**2 +
                                      (centers_guess[:, 2] - self._centers[:, 2])**2) 
         self._dist_fit_z  = np.abs(centers_guess[:, 0] - self._centers[:, 0]) 
@@ -937,6 +1789,48 @@ class SpotDetection(QWidget):
         self._sigmas_z_factors = self._sigmas_z / sigma_z
         self._dist_fit_xy_factors = self._dist_fit_xy / sigma_xy
         self._dist_fit_z_factors = self._dist_fit_z / sigma_z
+        self._percentile_ranges = None
+
+    def _make_spot_filter(self, fit_params, max_sep_xy_factor, max_sep_z_factor):
+        """
+        Cache the filtering conditions of fitted spots for live filtering.
+
+        Parameters
+        ----------
+        fit_params : dict
+            Parameters of the gaussian fit, with the ROI size factors.
+        max_sep_xy_factor, max_sep_z_factor : float
+            Largest separations set by the sliders, read from the main thread.
+        """
+        return SpotFilter(
+            self._centers, 
+            self._amplitudes, 
+            self._sigmas_xy_factors, 
+            self._sigmas_z_factors, 
+            self._dist_fit_xy_factors, 
+            self._dist_fit_z_factors, 
+            sigma_xy=self._spots3d._sigma_xy, 
+            sigma_z=self._spots3d._sigma_z, 
+            roi_xy_factor=max(fit_params['roi_y_factor'], fit_params['roi_x_factor']), 
+            roi_z_factor=fit_params['roi_z_factor'], 
+            max_sep_xy_factor=max_sep_xy_factor, 
+            max_sep_z_factor=max_sep_z_factor,
+            )
+
+    def _has_factors(self):
+        """
+        Check that fitted parameters are available relative to the expected spot size.
+        """
+        if self._sigmas_xy_factors is None:
+            print("Spots loaded without a model have no parameters relative to the spot size, "
+                  "create the model to filter them or plot their distributions.")
+            return False
+        return True
+
+    def _update_filter_ranges(self):
+        """
+        Adapt the range of filtering sliders to the distributions of fitted parameters.
+        """
 
         # update range of filters
         p_mini = float(self.txt_filter_percentile_min.text())
@@ -961,6 +1855,8 @@ class SpotDetection(QWidget):
         appropriate threshold values for spot filtering.
         """
 
+        if not self._has_factors():
+            return
         p_mini = float(self.txt_filter_percentile_min.text())
         p_maxi = float(self.txt_filter_percentile_max.text())
 
@@ -996,62 +1892,92 @@ class SpotDetection(QWidget):
         plt.show()
     
 
-    def _plot_fitted_params_2D(self):
+    def _get_percentile_ranges(self):
         """
-        Generate 2D distribution plots of fitted parameters to help selecting
-        appropriate threshold values for spot filtering.
+        Ranges of variables without filtering slider, from the percentiles fields.
+        They only change with fit results or percentiles, so they are computed once.
         """
-
-        p_mini = float(self.txt_filter_percentile_min.text())
-        p_maxi = float(self.txt_filter_percentile_max.text())
-
-        distrib = {
-            'amplitudes': {'data': self._amplitudes, 
-                           'range': self.sld_filter_amplitude_range.value()},
-            'sigmas_xy_factors': {'data': self._sigmas_xy_factors, 
-                                  'range': self.sld_filter_sigma_xy_factor.value()},
-            'sigmas_z_factors': {'data': self._sigmas_z_factors, 
-                                 'range': self.sld_filter_sigma_z_factor.value()},
-            'sigma_ratios': {'data': self._sigma_ratios, 
-                             'range': self.sld_filter_sigma_ratio_range.value()},
-            'chi_squared': {'data': self._chi_squared, 
-                            'range': (np.percentile(self._chi_squared, p_mini), 
-                                      np.percentile(self._chi_squared, p_maxi))},
-            'dist_fit_xy_factors': {'data': self._dist_fit_xy_factors, 
-                                    'range': (np.percentile(self._dist_fit_xy_factors, p_mini), 
-                                              np.percentile(self._dist_fit_xy_factors, p_maxi))},
-            'dist_fit_z_factors': {'data': self._dist_fit_z_factors, 
-                                   'range': (np.percentile(self._dist_fit_z_factors, p_mini), 
-                                             np.percentile(self._dist_fit_z_factors, p_maxi))},
+        if self._percentile_ranges is None:
+            p_mini = float(self.txt_filter_percentile_min.text())
+            p_maxi = float(self.txt_filter_percentile_max.text())
+            self._percentile_ranges = {
+                name: tuple(np.percentile(values, [p_mini, p_maxi]))
+                for name, values in [
+                    ('chi_squared', self._chi_squared), 
+                    ('dist_fit_xy_factors', self._dist_fit_xy_factors), 
+                    ('dist_fit_z_factors', self._dist_fit_z_factors),
+                    ]
+            }
+        return self._percentile_ranges
+
+    def _reset_percentile_ranges(self):
+        self._percentile_ranges = None
+        self._update_pair_plot()
+
+    def _get_distributions_ranges(self):
+        ranges = {
+            'amplitudes': self.sld_filter_amplitude_range.value(),
+            'sigmas_xy_factors': self.sld_filter_sigma_xy_factor.value(),
+            'sigmas_z_factors': self.sld_filter_sigma_z_factor.value(),
+            'sigma_ratios': self.sld_filter_sigma_ratio_range.value(),
         }
-        
-        var_labels = list(distrib.keys())
-        var_combi = itertools.combinations(var_labels, 2)
-        for var_x, var_y in var_combi:
-            x_mini, x_maxi = distrib[var_x]['range']
-            y_mini, y_maxi = distrib[var_y]['range']
-            x_select = np.logical_and(distrib[var_x]['data'] >= x_mini, distrib[var_x]['data'] <= x_maxi)
-            y_select = np.logical_and(distrib[var_y]['data'] >= y_mini, distrib[var_y]['data'] <= y_maxi)
-            select = np.logical_and(x_select, y_select)
-            x_data = distrib[var_x]['data'][select]
-            y_data = distrib[var_y]['data'][select]
-
-            plt.figure()
-            plt.scatter(x_data, y_data, s=10, marker='.', c='b', alpha=0.5)
-            plt.title(f"Distributions of {var_x} and {var_y}")
-            plt.xlabel(var_x)
-            plt.ylabel(var_y)
-            plt.show()
+        ranges.update(self._get_percentile_ranges())
+        return ranges
 
+    def _plot_fitted_params_2D(self):
+        """
+        Display 2D distributions of pairs of fitted parameters in a dock widget
+        to help selecting appropriate threshold values for spot filtering.
+        """
 
-    def _filter_spots(self):
+        if not self._has_factors():
+            return
+        variables = {
+            'amplitudes': self._amplitudes, 
+            'sigmas_xy_factors': self._sigmas_xy_factors, 
+            'sigmas_z_factors': self._sigmas_z_factors, 
+            'sigma_ratios': self._sigma_ratios, 
+            'chi_squared': self._chi_squared, 
+            'dist_fit_xy_factors': self._dist_fit_xy_factors, 
+            'dist_fit_z_factors': self._dist_fit_z_factors, 
+        }
+        hists = PairHistograms(variables, self._get_distributions_ranges())
+        if self._pair_plot is not None:
+            self.viewer.window.remove_dock_widget(self._pair_plot)
+        self._pair_plot = PairPlotPanel(hists)
+        self.viewer.window.add_dock_widget(self._pair_plot, name='Fitted parameters', area='right')
+        self._update_pair_plot_overlay()
+
+    def _update_pair_plot(self):
         """
-        Filter out spots based on gaussian fit results.
+        Update histograms of the variables whose filtering range changed.
         """
+        if self._pair_plot is None:
+            return
+        updated = self._pair_plot.hists.set_ranges(self._get_distributions_ranges())
+        self._pair_plot.update_histograms(updated)
+
+    def _update_pair_plot_overlay(self):
+        if self._pair_plot is None:
+            return
+        try:
+            nb_points = int(self.txt_plot_overlay.text())
+        except ValueError:
+            print("The number of overlaid spots has to be an integer")
+            self.txt_plot_overlay.setText('0')
+            nb_points = 0
+        select = self._spot_preview
+        if select is None:
+            select = getattr(self, '_spot_select', None)
+        if nb_points > 0 and select is not None:
+            select = np.asarray(select, dtype=bool)
+            indices = self._pair_plot.hists.sample(nb_points, select=select)
+        else:
+            indices = np.empty(0, dtype=int)
+        self._pair_plot.set_overlay(indices)
 
-        # list of boolean filters for all spots thresholds
-        selectors = []
 
+    def _get_spot_filter_params(self):
         spot_filter_params = {
             'amp_min' : self.sld_filter_amplitude_range.value()[0],
             'sigma_min_z_factor' : self.sld_filter_sigma_z_factor.value()[0],
@@ -1067,18 +1993,68 @@ class SpotDetection(QWidget):
             'min_sigma_ratio' : self.sld_filter_sigma_ratio_range.value()[0],
             'max_sigma_ratio' : self.sld_filter_sigma_ratio_range.value()[1],
         }
-        self._spots3d.spot_filter_params = spot_filter_params
-        print("starting filter spots")
-        self._spots3d.run_filter_spots()
-        print("finished filter spots")
+        return spot_filter_params
 
-        self._spot_select = self._spots3d._to_keep
-        self._centers_fit_masked = self._centers[self._spot_select, :]
-        nb_kept = self._spots3d._to_keep.sum()
-        print(f"Selected {nb_kept} spots out of {len(self._spots3d._to_keep)} candidates")
-        self._add_points(self._centers_fit_masked, name='filtered spots', blending='additive', size=0.25, face_color='b')
+    def _live_filter_spots(self):
+        """
+        Preview filtered spots when a filtering slider moves, only the
+        conditions whose parameters changed are evaluated again.
+        The preview approximates the boundary and separation conditions of
+        the model, so the exported selection is only set by 'Filter spots'.
+        """
+        if self._spot_filter is None or self._worker is not None:
+            return
+        self._spot_preview = self._spot_filter.update(self._get_spot_filter_params())
+        self._add_points(self._centers[self._spot_preview, :], name='filter preview', 
+                         blending='additive', size=0.25, face_color='c')
+        self._update_pair_plot_overlay()
+
+    def _filter_spots(self):
+        """
+        Filter out spots based on gaussian fit results.
+        """
+
+        self._spots3d.spot_filter_params = self._get_spot_filter_params()
+        if self.cbx_engine.currentText() == 'CPU':
+            run = self._run_filter_cpu
+        else:
+            run = self._spots3d.run_filter_spots
+
+        def compute():
+            yield 0, 1
+            steps = run()
+            if steps is not None:
+                yield from steps
+            yield 1, 1
+
+        def show(_):
+            self._spot_select = self._spots3d._to_keep
+            self._centers_fit_masked = self._centers[self._spot_select, :]
+            # the model selection replaces the preview
+            self._spot_preview = None
+            if 'filter preview' in self.viewer.layers:
+                self.viewer.layers.remove('filter preview')
+            nb_kept = self._spots3d._to_keep.sum()
+            print(f"Selected {nb_kept} spots out of {len(self._spots3d._to_keep)} candidates")
+            self._add_points(self._centers_fit_masked, name='filtered spots', blending='additive', size=0.25, face_color='b')
+            self._update_pair_plot_overlay()
+
+        def measure():
+            return {
+                'nb_spots': len(self._spots3d._to_keep),
+                'input_bytes': self._spots3d._fit_params.nbytes,
+                'output_bytes': self._spots3d._to_keep.nbytes,
+            }
+
+        self._start_stage('filter spots', compute, show, measure)
 
         
+    def _run_filter_cpu(self):
+        """
+        Select fitted spots with the CPU engine, yielding progress after each condition.
+        """
+        return iter_filter_spots(self._spots3d)
+
     def _inspect_filtering(self):
 
         if self._centers_fit_masked is None:
@@ -1090,7 +2066,7 @@ class SpotDetection(QWidget):
             condition_names = self._spots3d._condition_names
             conditions_beads = self._spots3d._conditions
             to_keep_beads = self._spots3d._to_keep
-            init_params_beads = self._spots3d._spot_candidates[:, :3]
+            init_params_beads = self._spots3d._spot_candidates[:len(to_keep_beads), :3]
             roi_inds = np.arange(len(to_keep_beads))
 
             strs = ["\n".join([condition_names[aa] for aa, c in enumerate(cs) if not c])
@@ -1123,70 +2099,103 @@ class SpotDetection(QWidget):
 
     def _save_spots(self):
 
-            # save the results
-            if not hasattr(self, '_spot_select'):
-                self._spot_select = np.full(len(self._centers), np.nan)
-            if self._centers.shape[1] == 3:
-                df_spots = pd.DataFrame({
-                    'amplitudes': self._amplitudes,
-                    'z': self._centers[:,0],
-                    'y': self._centers[:,1],
-                    'x': self._centers[:,2],
-                    'sigmas_xy': self._sigmas_xy,
-                    'sigmas_z': self._sigmas_z,
-                    'offsets': self._offsets,
-                    'chi_squareds': self._chi_squared,
-                    'dist_fit_xy': self._dist_fit_xy,
-                    'dist_fit_z': self._dist_fit_z,
-                    'spot_select': self._spot_select,
-                })
-            else:
-                df_spots = pd.DataFrame({
-                    'amplitudes': self._amplitudes,
-                    'y': self._centers[:,1],
-                    'x': self._centers[:,2],
-                    'sigmas_xy': self._sigmas_xy,
-                    'sigmas_z': self._sigmas_z,
-                    'offsets': self._offsets,
-                    'chi_squareds': self._chi_squared,
-                    'dist_fit_xy': self._dist_fit_xy,
-                    'dist_fit_z': self._dist_fit_z,
-                    'spot_select': self._spot_select,
-                })
-
-            path_save = QFileDialog.getSaveFileName(self, 'Export spots data')[0]
-            if path_save != '':
-                if not path_save.endswith('.csv'):
-                    path_save = path_save + '.csv'
-                df_spots.to_csv(path_save, index=False)
+        # save the results
+        if not hasattr(self, '_spot_select'):
+            self._spot_select = np.full(len(self._centers), np.nan)
+        columns = {'amplitudes': self._amplitudes}
+        if self._centers.shape[1] == 3:
+            columns['z'] = self._centers[:, 0]
+        columns.update({
+            'y': self._centers[:, -2],
+            'x': self._centers[:, -1],
+            'sigmas_xy': self._sigmas_xy,
+            'sigmas_z': self._sigmas_z,
+            'offsets': self._offsets,
+            'chi_squareds': self._chi_squared,
+            'dist_fit_xy': self._dist_fit_xy,
+            'dist_fit_z': self._dist_fit_z,
+            'spot_select': self._spot_select,
+        })
+
+        file_filters = ";;".join(f"{name.capitalize()} (*{ext})" for name, ext in SPOTS_FORMATS.items())
+        path_save, file_filter = QFileDialog.getSaveFileName(self, 'Export spots data', "", file_filters)
+        if path_save != '':
+            ext = file_filter[file_filter.index('*') + 1:-1] if file_filter else '.csv'
+            if Path(path_save).suffix not in SPOTS_FORMATS.values():
+                path_save = path_save + ext
+            with self._profiler.profile('export') as record:
+                save_spots(path_save, columns)
+                record.update(
+                    nb_spots=len(self._centers), 
+                    input_bytes=sum(np.asarray(values).nbytes for values in columns.values()),
+                    output_bytes=get_path_size(path_save),
+                    )
+            self._update_profiling()
+            print("spots saved in", path_save)
 
 
     def _load_spots(self):
 
-        path_load = QFileDialog.getOpenFileName(self,"Load spots data","","CSV Files (*.csv);;All Files (*)")[0]
+        file_filters = "Spots tables (*.parquet *.feather *.zarr *.csv);;All Files (*)"
+        path_load = QFileDialog.getOpenFileName(self, "Load spots data", "", file_filters)[0]
         if path_load != '':
-            df_spots = pd.read_csv(path_load)
-            self._amplitudes = df_spots['amplitudes']
-            self._sigmas_xy = df_spots['sigmas_xy']
-            self._offsets = df_spots['offsets']
-            self._chi_squareds = df_spots['chi_squareds']
-            self._dist_center = df_spots['dist_center']
-            self._spot_select = df_spots['spot_select']
-            if 'z' in df_spots.columns:
-                self._centers = np.zeros((len(df_spots['x']), 3))
-                self._centers[:, 0] = df_spots['z']
-                self._centers[:, 1] = df_spots['y']
-                self._centers[:, 2] = df_spots['x']
-                self._sigmas_z = df_spots['sigmas_z']
-                self._sigma_ratios = self._sigmas_z / self._sigmas_xy
+            spots = load_spots(path_load)
+            self._percentile_ranges = None
+            self._amplitudes = spots['amplitudes']
+            self._sigmas_xy = spots['sigmas_xy']
+            self._sigmas_z = spots['sigmas_z']
+            self._offsets = spots['offsets']
+            self._chi_squared = spots['chi_squareds']
+            self._dist_fit_xy = spots['dist_fit_xy']
+            self._dist_fit_z = spots['dist_fit_z']
+            self._spot_select = spots['spot_select']
+            self._sigma_ratios = self._sigmas_z / self._sigmas_xy
+            if 'z' in spots:
+                self._centers = np.column_stack([spots['z'], spots['y'], spots['x']])
             else:
-                self._centers = np.zeros((len(df_spots['x']), 2))
-                self._centers[:, 0] = df_spots['y']
-                self._centers[:, 1] = df_spots['x']
+                self._centers = np.column_stack([spots['y'], spots['x']])
+            # previews and histograms of previous spots don't apply to loaded ones
+            self._spot_preview = None
+            if 'filter preview' in self.viewer.layers:
+                self.viewer.layers.remove('filter preview')
+            if self._pair_plot is not None:
+                self.viewer.window.remove_dock_widget(self._pair_plot)
+                self._pair_plot = None
+            if self._spots3d is not None:
+                # factors are relative to the expected spot size of the current model
+                sigma_xy = self._spots3d._sigma_xy
+                sigma_z = self._spots3d._sigma_z
+                self._sigmas_xy_factors = self._sigmas_xy / sigma_xy
+                self._sigmas_z_factors = self._sigmas_z / sigma_z
+                self._dist_fit_xy_factors = self._dist_fit_xy / sigma_xy
+                self._dist_fit_z_factors = self._dist_fit_z / sigma_z
+                if self._centers.shape[1] == 3:
+                    fit_params = {
+                        'roi_z_factor' : float(self.txt_roi_z_factor.text()),
+                        'roi_y_factor' : float(self.txt_roi_y_factor.text()),
+                        'roi_x_factor' : float(self.txt_roi_x_factor.text()),
+                    }
+                    self._spot_filter = self._make_spot_filter(
+                        fit_params, 
+                        self.sld_min_spot_sep_xy_factor.maximum(), 
+                        self.sld_min_spot_sep_z_factor.maximum(),
+                        )
+                else:
+                    # separation conditions need 3D centers
+                    self._spot_filter = None
+                self._update_filter_ranges()
+            else:
+                # factor-based filtering and plots are disabled until a model is created
+                self._sigmas_xy_factors = None
+                self._sigmas_z_factors = None
+                self._dist_fit_xy_factors = None
+                self._dist_fit_z_factors = None
+                self._spot_filter = None
+                print("Loaded spots can't be filtered without a model, create it to filter them.")
             
             self._add_points(self._centers, name='fitted spots', blending='additive', size=0.25, face_color='g')
             # display filtered spots if there was a filtering
-            if ~np.all(self._spot_select.isna()):
+            if self._spot_select.dtype == bool:
                 self._add_points(self._centers[self._spot_select], name='filtered spots', blending='additive', size=0.25, face_color='b')
 
 
@@ -1202,6 +2211,7 @@ class SpotDetection(QWidget):
             'fit_candidate_spots_params': self._spots3d.fit_candidate_spots_params,
             'spot_filter_params': self._spots3d.spot_filter_params,
             'psf_origin': self._psf_origin,
+            'engine': self.cbx_engine.currentText(),
         }
 
         path_save = QFileDialog.getSaveFileName(self, 'Export detection parameters')[0]
@@ -1210,6 +2220,11 @@ class SpotDetection(QWidget):
                 path_save = path_save + '.json'
             with open(path_save, "w") as write_file:
                 json.dump(detection_parameters, write_file, indent=4)
+            if len(self._profiler.records) > 0:
+                # measurements of the run that produced these parameters
+                path_profiling = path_save[:-len('.json')] + '_profiling.json'
+                self._profiler.to_json(path_profiling)
+                print("profiling report saved in", path_profiling)
 
 
     def _load_parameters(self):
@@ -1234,6 +2249,11 @@ class SpotDetection(QWidget):
             else:
                 self.chk_skewed.setChecked(False)
             
+            # the GPU engine is disabled without SPOTS3D
+            engine = detection_parameters.get('engine', 'GPU')
+            if self.cbx_engine.model().item(self.cbx_engine.findText(engine)).isEnabled():
+                self.cbx_engine.setCurrentText(engine)
+
             if detection_parameters['psf_origin'] == 'generated':
                 self._make_psf()
                 self._psf_origin = 'generated'
@@ -1300,5 +2320,5 @@ if __name__ == "__main__":
 #   - all functions compatible with 2D data
 #   - add raw estimation of spots parameters by drawing box around one spot and estimating (fitting gaussian?) parameters
 #   - add check on individual ROIs
-#   - add panel to select data from big images, random tile, specific channel, etc...
+#   - add specific channel selection to the tuning data panel
 #   - add manual annotation and automatic training for filtering parameters
\ No newline at end of file